@@ -0,0 +1,133 @@
+'''
+Асинхронный фасад над Database для бота на asyncio.
+
+Методы Database блокирующие, поэтому AsyncDatabase выполняет их в отдельных
+потоках: записи - в одном потоке-писателе (по порядку, без борьбы за блокировку
+SQLite), чтения - в пуле читателей. Очередь ожидающих вызовов ограничена:
+при переполнении корутина ждёт свободного места, а не копит задачи в памяти.
+Пул соединений и кэши общие с синхронным Database.
+
+Пример:
+    adb = AsyncDatabase(db, cache=compat_cache)
+    user = await adb.get_user(user_id)
+    is_mutual = await adb.add_like(user_id, target_id)
+    async for row in adb.iter_users(('user_id', 'city')):
+        ...
+
+Какие методы пишут, отмечено на самом Database (декоратор writes).
+'''
+import asyncio
+import functools
+import inspect
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+from database import Database
+
+# Методы, которые нельзя выполнять в другом потоке: соединение привязано к потоку
+THREAD_BOUND_METHODS = {'connection', 'get_connection'}
+# Строк итератора (iter_users и т.п.), забираемых из потока за один раз
+ITER_BATCH_SIZE = 500
+
+
+def _next_batch(iterator, size: int) -> list:
+    return list(itertools.islice(iterator, size))
+
+
+class AsyncDatabase:
+    """
+    Тот же API, что у Database, но каждый метод - корутина:
+    await adb.get_user(...), await adb.get_users_by_filters(...) и т.д.
+    Потоковые методы (iter_users и т.п.) - асинхронные итераторы: async for.
+    """
+
+    def __init__(self, db: Database, cache=None, readers: Optional[int] = None,
+                 max_pending: int = 256):
+        self.db = db
+        self.cache = cache
+        # Одно соединение пула оставляем писателю
+        readers = readers or max(1, db.pool.size - 1)
+        self._readers = ThreadPoolExecutor(readers, thread_name_prefix='db-read')
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='db-write')
+        self._max_pending = max_pending
+        self._slots = None  # asyncio.Semaphore, создаётся в цикле событий
+        self._pending = 0
+        self._methods = {}
+
+    async def _run(self, executor, func, *args, **kwargs):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_pending)
+        self._pending += 1
+        try:
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+        finally:
+            self._pending -= 1
+
+    async def _flush_likes(self):
+        # Чтения лайков сначала дописывают очередь LikeWriter - пусть это
+        # сделает поток-писатель, а не поток-читатель
+        like_writer = self.db.like_writer
+        if like_writer is not None and like_writer.pending:
+            await self._run(self._writer, self.db.flush_likes)
+
+    async def _iterate(self, method, args, kwargs):
+        # Генератор Database продвигается в потоке-читателе пачками:
+        # запросы страниц не выполняются в цикле событий
+        await self._flush_likes()
+        iterator = await self._run(self._readers, lambda: iter(method(*args, **kwargs)))
+        while True:
+            batch = await self._run(self._readers, _next_batch, iterator, ITER_BATCH_SIZE)
+            for item in batch:
+                yield item
+            if len(batch) < ITER_BATCH_SIZE:
+                return
+
+    def __getattr__(self, name):
+        if name in THREAD_BOUND_METHODS:
+            raise AttributeError(
+                f"AsyncDatabase.{name}() недоступен: соединение привязано к потоку. "
+                f"Используйте методы AsyncDatabase или db.{name}() внутри одного потока"
+            )
+        method = getattr(self.db, name)
+        if name.startswith('_') or not callable(method):
+            return method
+
+        if name not in self._methods:
+            if inspect.isgeneratorfunction(method):
+                @functools.wraps(method)
+                def wrapper(*args, **kwargs):
+                    return self._iterate(method, args, kwargs)
+            elif getattr(method, 'writes', False):
+                @functools.wraps(method)
+                async def wrapper(*args, **kwargs):
+                    return await self._run(self._writer, method, *args, **kwargs)
+            else:
+                @functools.wraps(method)
+                async def wrapper(*args, **kwargs):
+                    await self._flush_likes()
+                    return await self._run(self._readers, method, *args, **kwargs)
+
+            self._methods[name] = wrapper
+        return self._methods[name]
+
+    async def get_compatibility(self, date1: str, date2: str) -> Dict:
+        """Совместимость через общий CompatibilityCache"""
+        if self.cache is None:
+            raise RuntimeError("AsyncDatabase создан без кэша совместимости")
+        return await self._run(self._readers, self.cache.get_compatibility, date1, date2)
+
+    def stats(self) -> Dict[str, Any]:
+        """Ожидающие вызовы и состояние общего пула соединений"""
+        return {
+            'pending': self._pending,
+            'max_pending': self._max_pending,
+            'pool': self.db.pool.stats(),
+        }
+
+    def shutdown(self, wait: bool = True):
+        """Останавливает потоки; соединения закрывает владелец Database (db.close())"""
+        self._writer.shutdown(wait=wait)
+        self._readers.shutdown(wait=wait)
@@ -0,0 +1,271 @@
+'''
+Микро-бенчмарки движка совместимости.
+
+Запуск:
+    python benchmark.py                   # замеры + проверка эталонов
+    python benchmark.py --output bench.json
+    python benchmark.py --update-golden   # пересчитать эталонные ответы
+
+Для каждой функции считается время одного вызова (нс) и память, выделяемая
+за вызов (по tracemalloc). Даты рождения берутся из распределения, похожего
+на пользователей бота, с фиксированным seed, поэтому ответы можно сверять
+с эталоном в benchmark_golden.json. Результаты пишутся в JSON для сравнения
+между версиями.
+'''
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+from components.real_match import (
+    calculate_age,
+    calculate_compatibility,
+    calculate_elements,
+    calculate_elements_compatibility,
+    calculate_individual_matrix,
+    calculate_key_numbers_compatibility,
+    calculate_matrix_compatibility,
+    get_zodiac_sign,
+    sum_digits,
+)
+from components.profiles import get_individual_matrix, load_profile_table
+from components.batch import calculate_compatibility_batch, dates_to_indices
+from components.classes import class_compatibility, get_date_class, load_class_tables
+from components.strategies import DEFAULT_STRATEGY, set_active_strategy
+
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_golden.json')
+
+SEED = 20240101
+SAMPLE_SIZE = 2000
+BATCH_SIZE = 10000
+# Возраст считаем от фиксированного года, чтобы выборка не менялась со временем
+REFERENCE_DATE = date(2025, 1, 1)
+
+
+def realistic_birthdays(count, seed=SEED):
+    """
+    Даты рождения пользователей бота: в основном 18-35 лет с хвостом до 60,
+    день года - равномерно.
+    """
+    rnd = random.Random(seed)
+    dates = []
+    for _ in range(count):
+        age = min(max(rnd.gauss(26, 6), 18), 60)
+        birthday = REFERENCE_DATE - timedelta(days=int(age * 365.25) + rnd.randrange(365))
+        dates.append(birthday.strftime('%d.%m.%Y'))
+    return dates
+
+
+def _digest(values):
+    """Короткий отпечаток списка ответов для сравнения с эталоном"""
+    data = json.dumps(values, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _time_per_op(func, args_list, repeat):
+    """Лучшее из repeat прогонов: наносекунды на один вызов"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for args in args_list:
+            func(*args)
+        elapsed = time.perf_counter_ns() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(args_list)
+
+
+def _alloc_per_op(func, args_list):
+    """Пиковая память за вызов (байт) и число блоков, оставшихся после вызовов"""
+    sample = args_list[:200]
+    tracemalloc.start()
+    try:
+        peak_total = 0
+        before = tracemalloc.take_snapshot()
+        for args in sample:
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            func(*args)
+            peak_total += tracemalloc.get_traced_memory()[1] - current
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    retained_blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return peak_total / len(sample), retained_blocks / len(sample)
+
+
+def bench(name, func, args_list, repeat=5, per_op=1):
+    """
+    Замер одной функции. per_op - сколько пар считает один вызов
+    (для пакетных путей), время и память делятся на него.
+    """
+    results = [func(*args) for args in args_list]
+    ns_per_call = _time_per_op(func, args_list, repeat)
+    alloc_bytes, retained_blocks = _alloc_per_op(func, args_list)
+    return {
+        'name': name,
+        'calls': len(args_list),
+        'items_per_call': per_op,
+        'ns_per_op': round(ns_per_call / per_op, 1),
+        'alloc_bytes_per_op': round(alloc_bytes / per_op, 2),
+        'retained_blocks_per_call': round(retained_blocks, 3),
+    }, results
+
+
+def _split(date_str):
+    day, month, year = map(int, date_str.split('.'))
+    return day, month, year
+
+
+def _reference_age(birth_date, today):
+    birth = datetime.strptime(birth_date, "%d.%m.%Y").date()
+    return today.year - birth.year - ((today.month, today.day) < (birth.month, birth.day))
+
+
+def run_benchmarks(sample_size=SAMPLE_SIZE, batch_size=BATCH_SIZE, repeat=5):
+    """Все замеры; возвращает (список замеров, отпечатки ответов, ошибки сверки)"""
+    set_active_strategy(DEFAULT_STRATEGY)
+    load_profile_table()
+    load_class_tables()
+
+    dates = realistic_birthdays(sample_size)
+    partners = realistic_birthdays(sample_size, seed=SEED + 1)
+    pairs = list(zip(dates, partners))
+    people = [(calculate_individual_matrix(d),) for d in dates]
+    people_pairs = [(p1[0], p2[0]) for p1, p2 in zip(people, people[1:] + people[:1])]
+
+    numbers = random.Random(SEED).choices(range(1, 10000), k=sample_size)
+
+    rows = []
+    digests = {}
+    mismatches = []
+
+    def record(name, func, args_list, **kwargs):
+        row, results = bench(name, func, args_list, repeat=repeat, **kwargs)
+        rows.append(row)
+        digests[name] = _digest(results)
+        return results
+
+    # Скалярные функции
+    record('sum_digits', sum_digits, [(n,) for n in numbers])
+    record('calculate_elements', calculate_elements, [_split(d) for d in dates])
+    scalar_people = record('calculate_individual_matrix', calculate_individual_matrix, [(d,) for d in dates])
+    record('get_individual_matrix', get_individual_matrix, [(d,) for d in dates])
+    record('calculate_matrix_compatibility', calculate_matrix_compatibility,
+           [(p1['matrix'], p2['matrix']) for p1, p2 in people_pairs])
+    record('calculate_elements_compatibility', calculate_elements_compatibility,
+           [(p1['elements'], p2['elements']) for p1, p2 in people_pairs])
+    record('calculate_key_numbers_compatibility', calculate_key_numbers_compatibility, people_pairs)
+    scalar_results = record('calculate_compatibility', calculate_compatibility, pairs)
+    record('get_zodiac_sign', get_zodiac_sign, [_split(d)[:2] for d in dates])
+
+    # Возраст зависит от текущей даты, поэтому сверяем не с эталоном, а с расчётом
+    ages = record('calculate_age', calculate_age, [(d,) for d in dates])
+    del digests['calculate_age']
+    today = datetime.now().date()
+    if ages != [_reference_age(d, today) for d in dates]:
+        mismatches.append('calculate_age: расхождение с расчётом по календарю')
+
+    # Таблица профилей должна давать тот же профиль, что и прямой расчёт
+    if digests['get_individual_matrix'] != _digest(scalar_people):
+        mismatches.append('get_individual_matrix: расхождение с calculate_individual_matrix')
+
+    # Пакетные пути: один против batch_size кандидатов
+    candidates = realistic_birthdays(batch_size, seed=SEED + 2)
+    indices = dates_to_indices(candidates)
+    batch_dates = dates[:20]
+    batch = record('calculate_compatibility_batch[dates]', calculate_compatibility_batch,
+                   [(d, candidates) for d in batch_dates], per_op=batch_size)
+    record('calculate_compatibility_batch[indices]', calculate_compatibility_batch,
+           [(d, indices) for d in batch_dates], per_op=batch_size)
+    digests['calculate_compatibility_batch[dates]'] = _digest([b.tolist() for b in batch])
+    digests['calculate_compatibility_batch[indices]'] = digests['calculate_compatibility_batch[dates]']
+
+    class_pairs = [(get_date_class(d1), get_date_class(d2)) for d1, d2 in pairs]
+    class_results = record('class_compatibility', class_compatibility, class_pairs)
+
+    # Сверка пакетных путей со скалярным
+    expected = [r['percentage'] for r in scalar_results]
+    if class_results != expected:
+        mismatches.append('class_compatibility: расхождение с calculate_compatibility')
+    for d, percentages in zip(batch_dates[:3], batch[:3]):
+        if percentages.tolist() != [calculate_compatibility(d, c)['percentage'] for c in candidates]:
+            mismatches.append(f'calculate_compatibility_batch: расхождение для {d}')
+
+    return rows, digests, mismatches
+
+
+def check_golden(digests, golden_file=GOLDEN_FILE):
+    """Сравнение отпечатков ответов с эталоном; возвращает список расхождений"""
+    if not os.path.exists(golden_file):
+        return [f'нет файла эталонов {golden_file} (запустите с --update-golden)']
+    with open(golden_file, encoding='utf-8') as f:
+        golden = json.load(f)
+    mismatches = []
+    for name, digest in digests.items():
+        if name not in golden:
+            mismatches.append(f'{name}: нет эталона')
+        elif golden[name] != digest:
+            mismatches.append(f'{name}: ответы отличаются от эталона')
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарки движка совместимости')
+    parser.add_argument('--output', help='куда записать результаты в JSON')
+    parser.add_argument('--sample', type=int, default=SAMPLE_SIZE, help='дат в скалярных замерах')
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE, help='кандидатов в пакетных замерах')
+    parser.add_argument('--repeat', type=int, default=5, help='повторов каждого замера')
+    parser.add_argument('--update-golden', action='store_true', help='перезаписать эталонные ответы')
+    args = parser.parse_args(argv)
+
+    if args.update_golden and (args.sample != SAMPLE_SIZE or args.batch != BATCH_SIZE):
+        print("❌ Эталон пишется только для размеров выборки по умолчанию")
+        return 1
+
+    rows, digests, mismatches = run_benchmarks(args.sample, args.batch, args.repeat)
+
+    if args.update_golden:
+        with open(GOLDEN_FILE, 'w', encoding='utf-8') as f:
+            json.dump(digests, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"✅ Эталон записан в {GOLDEN_FILE}")
+    elif args.sample == SAMPLE_SIZE and args.batch == BATCH_SIZE:
+        mismatches.extend(check_golden(digests))
+
+    print(f"{'функция':<42} {'нс/оп':>12} {'байт/оп':>12}")
+    for row in rows:
+        print(f"{row['name']:<42} {row['ns_per_op']:>12.1f} {row['alloc_bytes_per_op']:>12.2f}")
+
+    for mismatch in mismatches:
+        print(f"❌ {mismatch}")
+    if not mismatches:
+        print("✅ Ответы совпадают с эталоном")
+
+    if args.output:
+        report = {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'sample_size': args.sample,
+            'batch_size': args.batch,
+            'strategy': DEFAULT_STRATEGY,
+            'benchmarks': rows,
+            'golden_ok': not mismatches,
+            'mismatches': mismatches,
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {args.output}")
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
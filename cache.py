@@ -0,0 +1,202 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from components import calculate_compatibility, get_individual_matrix
+from components.strategies import ab_percentages, get_active_strategy
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с ограничением размера и необязательным TTL"""
+    
+    def __init__(self, maxsize: int = 10000, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        """Получить значение (default, если ключа нет или он устарел)"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+    
+    def set(self, key, value):
+        """Сохранить значение, вытесняя самые старые записи"""
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def delete(self, key):
+        """Удалить значение"""
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def clear(self):
+        """Очистить кэш"""
+        with self._lock:
+            self._data.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Счётчики попаданий и промахов"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+def normalize_date(date_str: str) -> str:
+    """Приводит дату к виду 'DD.MM.YYYY' с ведущими нулями"""
+    day, month, year = map(int, date_str.strip().split('.'))
+    return f"{day:02d}.{month:02d}.{year}"
+
+
+class CompatibilityCache:
+    """
+    Кэш результатов calculate_compatibility: LRU в памяти поверх таблицы SQLite.
+    Ключ - пара нормализованных дат и версия формулы активной стратегии (она
+    берётся при каждом обращении), поэтому после set_active_strategy старые
+    результаты не используются, а при запуске удаляются.
+    """
+    
+    def __init__(self, db, maxsize: int = 10000, formula_version: str = None):
+        self.db = db
+        self._formula_version = formula_version  # None - версия активной стратегии
+        self.memory = LRUCache(maxsize)
+        self.db_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        
+        self.init_table()
+    
+    @property
+    def formula_version(self) -> str:
+        """Версия формулы: заданная явно или активной стратегии на момент вызова"""
+        return self._formula_version or get_active_strategy().formula_version
+    
+    def init_table(self):
+        """Создаёт таблицу кэша и удаляет результаты старых версий формулы"""
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS compatibility_cache (
+                    date1 TEXT NOT NULL,
+                    date2 TEXT NOT NULL,
+                    formula_version TEXT NOT NULL,
+                    percentage REAL NOT NULL,
+                    matrix_score REAL NOT NULL,
+                    elements_score REAL NOT NULL,
+                    key_numbers_score REAL NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (date1, date2, formula_version)
+                ) WITHOUT ROWID
+            ''')
+            cursor.execute(
+                'DELETE FROM compatibility_cache WHERE formula_version != ?',
+                (self.formula_version,)
+            )
+            
+            conn.commit()
+    
+    def get_compatibility(self, date1: str, date2: str) -> Dict:
+        """То же, что calculate_compatibility, но с кэшированием результата"""
+        key = (normalize_date(date1), normalize_date(date2), self.formula_version)
+        
+        scores = self.memory.get(key)
+        if scores is None:
+            scores = self._load(key)
+            if scores is not None:
+                with self._lock:
+                    self.db_hits += 1
+            else:
+                with self._lock:
+                    self.misses += 1
+                result = calculate_compatibility(key[0], key[1])
+                scores = (result['percentage'], result['details'])
+                self._store(key, scores)
+            self.memory.set(key, scores)
+        
+        percentage, details = scores
+        result = {
+            'percentage': percentage,
+            'details': dict(details),
+            'person1': get_individual_matrix(key[0]),
+            'person2': get_individual_matrix(key[1])
+        }
+        
+        alternatives = ab_percentages(details)
+        if alternatives:
+            result['ab_percentages'] = alternatives
+        
+        return result
+    
+    def _load(self, key):
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT percentage, matrix_score, elements_score, key_numbers_score
+                FROM compatibility_cache
+                WHERE date1 = ? AND date2 = ? AND formula_version = ?
+            ''', key)
+            row = cursor.fetchone()
+            if not row:
+                return None
+            return (row[0], {
+                'matrix_score': row[1],
+                'elements_score': row[2],
+                'key_numbers_score': row[3]
+            })
+    
+    def _store(self, key, scores):
+        percentage, details = scores
+        try:
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT OR REPLACE INTO compatibility_cache
+                    (date1, date2, formula_version, percentage, matrix_score,
+                     elements_score, key_numbers_score, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    key[0], key[1], key[2], percentage,
+                    details['matrix_score'], details['elements_score'], details['key_numbers_score'],
+                    datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                ))
+                conn.commit()
+        except Exception as e:
+            print(f"Ошибка сохранения совместимости {key[0]} / {key[1]}: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        """Счётчики кэша: попадания в память, в базу и промахи"""
+        memory_stats = self.memory.stats()
+        with self._lock:
+            total = memory_stats['hits'] + self.db_hits + self.misses
+            return {
+                'formula_version': self.formula_version,
+                'memory_size': memory_stats['size'],
+                'memory_hits': memory_stats['hits'],
+                'db_hits': self.db_hits,
+                'misses': self.misses,
+                'hit_rate': (memory_stats['hits'] + self.db_hits) / total if total else 0.0
+            }
@@ -1 +1,6 @@
-from .real_match import *
\ No newline at end of file
+from .real_match import *
+from .profiles import load_profile_table, get_individual_matrix
+from .strategies import set_active_strategy, get_active_strategy, set_ab_strategies, list_strategies
+from .batch import calculate_compatibility_batch, compare_strategies_batch, dates_to_indices
+from .classes import load_class_tables, get_date_class, class_compatibility, compatibility_percentage
+from .distribution import CompatibilityDistribution
\ No newline at end of file
@@ -0,0 +1,141 @@
+'''
+Пакетный расчёт совместимости одной даты со многими кандидатами.
+
+Профили берутся из таблицы profiles, баллы пар чисел - из двумерных
+таблиц подстановки, поэтому N кандидатов считаются без цикла на Python.
+Результаты совпадают с calculate_compatibility до последнего бита.
+'''
+import numpy as np
+
+from .real_match import (
+    MATRIX_COMPATIBILITY,
+    KEY_NUMBERS_COMPATIBILITY,
+    calculate_individual_matrix,
+    element_pair_score,
+)
+from .profiles import (
+    PROFILE_WIDTH,
+    date_index,
+    get_profile_table,
+    profile_to_row,
+)
+from .strategies import (
+    ELEMENTS_PERCENT,
+    KEY_PERCENT,
+    MATRIX_PERCENT,
+    get_strategy,
+)
+
+# Числа в профиле: 1-9 и мастер-числа 11, 22, 33
+MAX_NUMBER = 33
+
+# Колонки строки профиля (см. profiles.py)
+MATRIX_COLUMNS = slice(0, 9)
+ELEMENT_COLUMNS = slice(13, 17)
+# Судьба, Личность, Кармические задачи - в порядке calculate_key_numbers_compatibility
+KEY_COLUMNS = [10, 9, 12]
+
+
+def _pair_table(score):
+    table = np.zeros((MAX_NUMBER + 1, MAX_NUMBER + 1), dtype=np.uint8)
+    for a in range(MAX_NUMBER + 1):
+        for b in range(MAX_NUMBER + 1):
+            table[a, b] = score(a, b)
+    return table
+
+
+# Баллы (0-10) для пары чисел
+MATRIX_SCORES = _pair_table(lambda a, b: MATRIX_COMPATIBILITY.get((a, b), 5))
+ELEMENT_SCORES = _pair_table(element_pair_score)
+KEY_SCORES = _pair_table(
+    lambda a, b: KEY_NUMBERS_COMPATIBILITY.get((a, b), KEY_NUMBERS_COMPATIBILITY['default'])
+)
+
+
+def profile_array():
+    """Таблица профилей как массив (число дат, PROFILE_WIDTH) без копирования"""
+    return np.frombuffer(get_profile_table(), dtype=np.uint8).reshape(-1, PROFILE_WIDTH)
+
+
+def dates_to_indices(dates):
+    """Индексы дат в таблице профилей (-1 для дат вне диапазона)"""
+    indices = np.empty(len(dates), dtype=np.int32)
+    for i, date_str in enumerate(dates):
+        index = date_index(date_str)
+        indices[i] = -1 if index is None else index
+    return indices
+
+
+def _profile_rows(dates):
+    """Строки профилей для списка дат 'DD.MM.YYYY' или массива индексов"""
+    if isinstance(dates, np.ndarray) and dates.dtype.kind in 'iu':
+        # -1 из dates_to_indices взял бы последнюю строку таблицы: дату
+        # вне таблицы по индексу не посчитать, такие даты передаются строками
+        if dates.size and dates.min() < 0:
+            raise ValueError(
+                "Индекс -1: дата вне таблицы профилей, передайте даты строками"
+            )
+        return profile_array()[dates]
+
+    indices = dates_to_indices(dates)
+    rows = profile_array()[np.maximum(indices, 0)]
+    # Редкие даты вне таблицы считаем напрямую
+    for i in np.flatnonzero(indices < 0):
+        rows[i] = profile_to_row(calculate_individual_matrix(dates[i]))
+    return rows
+
+
+def score_totals(profile, rows):
+    """
+    Суммы баллов одного профиля против строк кандидатов.
+    Возвращает (матрица 0-90, стихии 0-40, ключевые числа 0-30).
+    """
+    matrix_total = MATRIX_SCORES[profile[MATRIX_COLUMNS], rows[:, MATRIX_COLUMNS]].sum(axis=1, dtype=np.int32)
+    elements_total = ELEMENT_SCORES[profile[ELEMENT_COLUMNS], rows[:, ELEMENT_COLUMNS]].sum(axis=1, dtype=np.int32)
+    key_total = KEY_SCORES[profile[KEY_COLUMNS], rows[:, KEY_COLUMNS]].sum(axis=1, dtype=np.int32)
+    return matrix_total, elements_total, key_total
+
+
+def calculate_compatibility_batch(date, candidates, details=False, strategy=None):
+    """
+    Совместимость даты date ('DD.MM.YYYY') с каждым из кандидатов.
+    candidates - список дат 'DD.MM.YYYY' или массив индексов из dates_to_indices
+    (индексы быстрее: не нужно разбирать строки; индексов -1 в массиве
+    быть не должно - ValueError).
+    strategy - имя стратегии подсчёта (по умолчанию активная).
+    Возвращает массив процентов как result['percentage'] у calculate_compatibility,
+    а при details=True - словарь {'percentage': ..., 'details': {...}} с массивами
+    matrix_score, elements_score и key_numbers_score.
+    """
+    profile = _profile_rows([date])[0]
+    rows = _profile_rows(candidates)
+
+    totals = score_totals(profile, rows)
+    percentage = get_strategy(strategy).percentages(*totals)
+
+    if not details:
+        return percentage
+
+    return {
+        'percentage': percentage,
+        'details': totals_to_details(*totals)
+    }
+
+
+def compare_strategies_batch(date, candidates, strategies):
+    """
+    A/B режим: проценты нескольких стратегий за один проход по профилям.
+    Возвращает {имя стратегии: массив процентов}.
+    """
+    profile = _profile_rows([date])[0]
+    totals = score_totals(profile, _profile_rows(candidates))
+    return {name: get_strategy(name).percentages(*totals) for name in strategies}
+
+
+def totals_to_details(matrix_total, elements_total, key_total):
+    """Суммы баллов -> показатели в процентах, как в result['details']"""
+    return {
+        'matrix_score': MATRIX_PERCENT[matrix_total],
+        'elements_score': ELEMENTS_PERCENT[elements_total],
+        'key_numbers_score': KEY_PERCENT[key_total]
+    }
@@ -0,0 +1,160 @@
+'''
+Классы профилей и таблица совместимости класс x класс.
+
+Разные даты рождения часто дают одинаковые матрицу, ключевые числа и стихии.
+Все даты сводятся к компактному номеру класса, а для каждой пары классов
+заранее считаются суммы баллов. Таблицы сохраняются в .npy и открываются
+через memory map, поэтому все процессы бота делят одну копию в памяти.
+'''
+import hashlib
+import os
+
+import numpy as np
+
+from .batch import (
+    ELEMENT_SCORES,
+    KEY_SCORES,
+    MATRIX_SCORES,
+    profile_array,
+    score_totals,
+    totals_to_details,
+)
+from .profiles import date_index
+from .real_match import calculate_compatibility
+from .strategies import get_strategy
+
+# Индексы первой оси таблицы баллов
+MATRIX_TOTAL = 0
+ELEMENTS_TOTAL = 1
+KEY_TOTAL = 2
+
+_date_classes = None  # индекс даты -> номер класса
+_class_scores = None  # (3, классов, классов): суммы баллов пары классов
+
+
+def tables_fingerprint():
+    """Отпечаток профилей и таблиц баллов: меняется вместе с формулой"""
+    digest = hashlib.sha1()
+    for table in (profile_array(), MATRIX_SCORES, ELEMENT_SCORES, KEY_SCORES):
+        digest.update(table.tobytes())
+    return digest.hexdigest()[:12]
+
+
+def build_class_tables():
+    """Считает номера классов для всех дат и таблицу баллов класс x класс"""
+    class_rows, date_classes = np.unique(profile_array(), axis=0, return_inverse=True)
+    date_classes = date_classes.reshape(-1).astype(np.uint16)
+
+    class_count = len(class_rows)
+    class_scores = np.empty((3, class_count, class_count), dtype=np.uint8)
+    for cls in range(class_count):
+        totals = score_totals(class_rows[cls], class_rows)
+        for axis, total in enumerate(totals):
+            class_scores[axis, cls] = total
+
+    return date_classes, class_scores
+
+
+def _table_paths(path_prefix):
+    fingerprint = tables_fingerprint()
+    return (
+        f"{path_prefix}.{fingerprint}.classes.npy",
+        f"{path_prefix}.{fingerprint}.scores.npy",
+    )
+
+
+def load_class_tables(path_prefix=None):
+    """
+    Загружает таблицы классов.
+    С path_prefix таблицы открываются из файлов через memory map, а если файлов
+    для текущей формулы ещё нет - строятся и сохраняются.
+    """
+    global _date_classes, _class_scores
+
+    if not path_prefix:
+        _date_classes, _class_scores = build_class_tables()
+        return _date_classes, _class_scores
+
+    classes_file, scores_file = _table_paths(path_prefix)
+    if not (os.path.exists(classes_file) and os.path.exists(scores_file)):
+        date_classes, class_scores = build_class_tables()
+        try:
+            directory = os.path.dirname(classes_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Пишем во временные файлы, чтобы другие процессы не открыли недописанные
+            for filename, data in ((classes_file, date_classes), (scores_file, class_scores)):
+                tmp_file = f"{filename}.{os.getpid()}.tmp"
+                with open(tmp_file, 'wb') as f:
+                    np.save(f, data)
+                os.replace(tmp_file, filename)
+        except Exception as e:
+            print(f"Ошибка сохранения таблиц классов {path_prefix}: {e}")
+            _date_classes, _class_scores = date_classes, class_scores
+            return _date_classes, _class_scores
+
+    _date_classes = np.load(classes_file, mmap_mode='r')
+    _class_scores = np.load(scores_file, mmap_mode='r')
+    return _date_classes, _class_scores
+
+
+def get_class_tables():
+    """Таблицы классов (строятся при первом обращении)"""
+    if _class_scores is None:
+        load_class_tables()
+    return _date_classes, _class_scores
+
+
+def get_class_count():
+    """Количество различных классов профилей"""
+    return get_class_tables()[1].shape[1]
+
+
+def get_date_class(date_str):
+    """Номер класса профиля для даты 'DD.MM.YYYY' или None вне диапазона"""
+    index = date_index(date_str)
+    if index is None:
+        return None
+    return int(get_class_tables()[0][index])
+
+
+def class_totals(class1, class2):
+    """Суммы баллов (матрица, стихии, ключевые числа) для пары классов"""
+    class_scores = get_class_tables()[1]
+    return tuple(int(class_scores[axis, class1, class2]) for axis in (MATRIX_TOTAL, ELEMENTS_TOTAL, KEY_TOTAL))
+
+
+def class_compatibility(class1, class2, details=False, strategy=None):
+    """
+    Совместимость двух классов: процент как у calculate_compatibility,
+    при details=True - ещё и словарь с тремя показателями.
+    """
+    totals = class_totals(class1, class2)
+    percentage = float(get_strategy(strategy).percentages(*totals))
+
+    if not details:
+        return percentage
+
+    return {
+        'percentage': percentage,
+        'details': {key: float(value) for key, value in totals_to_details(*totals).items()}
+    }
+
+
+def class_percentages(user_class, strategy=None):
+    """Проценты совместимости класса user_class со всеми классами (массив)"""
+    class_scores = get_class_tables()[1]
+    return get_strategy(strategy).percentages(
+        class_scores[MATRIX_TOTAL, user_class],
+        class_scores[ELEMENTS_TOTAL, user_class],
+        class_scores[KEY_TOTAL, user_class]
+    )
+
+
+def compatibility_percentage(date1, date2):
+    """Процент совместимости двух дат через таблицу классов"""
+    class1 = get_date_class(date1)
+    class2 = get_date_class(date2)
+    if class1 is None or class2 is None:
+        return calculate_compatibility(date1, date2)['percentage']
+    return class_compatibility(class1, class2)
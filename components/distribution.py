@@ -0,0 +1,112 @@
+'''
+Распределение совместимости по всей базе пользователей.
+
+Вместо перебора всех пар (O(N²)) храним число пользователей в каждом классе
+профиля и гистограмму процентов по всем парам пользователей. При регистрации
+пользователя класса c гистограмма дополняется его парами со всеми остальными -
+это одна строка таблицы класс x класс, O(числа классов).
+Процент округлён до 0.1, поэтому корзины гистограммы точные (0.0 ... 100.0).
+'''
+import threading
+
+import numpy as np
+
+from .classes import class_percentages, get_class_count
+from .strategies import get_strategy
+
+# Корзины по 0.1%: 0.0, 0.1, ..., 100.0
+BIN_COUNT = 1001
+
+
+def percentage_bin(percentage):
+    """Номер корзины для процента (числа или массива)"""
+    return np.rint(np.asarray(percentage) * 10).astype(np.int16)
+
+
+class CompatibilityDistribution:
+    """
+    Гистограмма процентов совместимости по всем парам пользователей.
+    Обновляется инкрементально через add_user / remove_user.
+    """
+
+    def __init__(self, class_counts=None, strategy=None):
+        self.strategy = get_strategy(strategy)
+        self._lock = threading.Lock()
+        self._class_counts = np.zeros(get_class_count(), dtype=np.int64)
+        self._histogram = np.zeros(BIN_COUNT, dtype=np.int64)
+        self._at_least = None  # пар с процентом не ниже корзины (считается по запросу)
+        if class_counts:
+            self.rebuild(class_counts)
+
+    def _class_bins(self, profile_class):
+        return percentage_bin(class_percentages(profile_class, self.strategy.name))
+
+    def rebuild(self, class_counts):
+        """
+        Полный пересчёт по числу пользователей в классах {класс: количество}.
+        Работает по таблице класс x класс, без перебора пользователей.
+        """
+        counts = np.zeros(get_class_count(), dtype=np.int64)
+        for profile_class, count in class_counts.items():
+            if profile_class is not None:
+                counts[int(profile_class)] += count
+
+        histogram = np.zeros(BIN_COUNT, dtype=np.int64)
+        for cls in np.flatnonzero(counts):
+            bins = self._class_bins(cls)
+            # Пары с пользователями других классов и внутри класса (без пары с собой)
+            weights = counts[cls] * counts
+            weights[cls] = counts[cls] * (counts[cls] - 1)
+            histogram += np.bincount(bins, weights=weights, minlength=BIN_COUNT).astype(np.int64)
+        # Каждая пара посчитана дважды
+        histogram //= 2
+
+        with self._lock:
+            self._class_counts = counts
+            self._histogram = histogram
+            self._at_least = None
+
+    def add_user(self, profile_class):
+        """Учитывает нового пользователя: его пары со всеми остальными"""
+        if profile_class is None:
+            return
+        bins = self._class_bins(profile_class)
+        with self._lock:
+            self._histogram += np.bincount(bins, weights=self._class_counts, minlength=BIN_COUNT).astype(np.int64)
+            self._class_counts[profile_class] += 1
+            self._at_least = None
+
+    def remove_user(self, profile_class):
+        """Убирает пользователя и все его пары"""
+        if profile_class is None:
+            return
+        bins = self._class_bins(profile_class)
+        with self._lock:
+            if self._class_counts[profile_class] == 0:
+                return
+            self._class_counts[profile_class] -= 1
+            self._histogram -= np.bincount(bins, weights=self._class_counts, minlength=BIN_COUNT).astype(np.int64)
+            self._at_least = None
+
+    @property
+    def user_count(self):
+        return int(self._class_counts.sum())
+
+    @property
+    def pair_count(self):
+        return int(self._histogram.sum())
+
+    def top_percent(self, percentage):
+        """
+        Доля пар (в процентах), у которых совместимость не ниже percentage:
+        «вы в топ N%». None, если пар в базе ещё нет.
+        """
+        with self._lock:
+            if self._at_least is None:
+                self._at_least = np.cumsum(self._histogram[::-1])[::-1]
+            at_least = self._at_least
+        total = int(at_least[0])
+        if total == 0:
+            return None
+        index = min(max(int(percentage_bin(percentage)), 0), BIN_COUNT - 1)
+        return int(at_least[index]) / total * 100
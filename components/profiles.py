@@ -0,0 +1,152 @@
+'''
+Таблица профилей по датам рождения.
+
+Матрица, ключевые числа и стихии зависят только от даты, поэтому считаем их
+один раз для каждого дня диапазона и дальше берём готовую строку по индексу.
+'''
+import hashlib
+import os
+from array import array
+from datetime import date
+
+from . import real_match
+from .real_match import calculate_individual_matrix
+
+# Диапазон совпадает с validate_date в боте (1900-2100)
+FIRST_DATE = date(1900, 1, 1)
+LAST_DATE = date(2100, 12, 31)
+FIRST_ORDINAL = FIRST_DATE.toordinal()
+TABLE_SIZE = LAST_DATE.toordinal() - FIRST_ORDINAL + 1
+
+# Раскладка строки таблицы: 9 ячеек матрицы, 4 ключевых числа, 4 стихии
+KEY_NUMBERS = ('personality', 'destiny', 'golden_alchemist', 'karmic_tasks')
+ELEMENTS = ('fire', 'earth', 'air', 'water')
+PROFILE_WIDTH = 9 + len(KEY_NUMBERS) + len(ELEMENTS)
+
+_profile_table = None
+
+
+def date_index(date_str):
+    """Индекс даты 'DD.MM.YYYY' в таблице или None, если даты нет в диапазоне"""
+    try:
+        day, month, year = map(int, date_str.split('.'))
+        ordinal = date(year, month, day).toordinal()
+    except ValueError:
+        return None
+    index = ordinal - FIRST_ORDINAL
+    if 0 <= index < TABLE_SIZE:
+        return index
+    return None
+
+
+def index_to_date(index):
+    """Обратное преобразование индекса в строку 'DD.MM.YYYY'"""
+    return date.fromordinal(FIRST_ORDINAL + index).strftime('%d.%m.%Y')
+
+
+def profile_to_row(person):
+    """Профиль из calculate_individual_matrix в виде строки таблицы"""
+    row = list(person['matrix'])
+    row.extend(person[key] for key in KEY_NUMBERS)
+    row.extend(person['elements'][key] for key in ELEMENTS)
+    return row
+
+
+def _row_to_profile(row):
+    return {
+        'matrix': list(row[:9]),
+        'personality': row[9],
+        'destiny': row[10],
+        'golden_alchemist': row[11],
+        'karmic_tasks': row[12],
+        'elements': dict(zip(ELEMENTS, row[13:17]))
+    }
+
+
+def formula_fingerprint():
+    """
+    Отпечаток формулы профиля: исходник real_match, диапазон дат и раскладка
+    строки. Таблица из файла с другим отпечатком посчитана старой формулой.
+    """
+    digest = hashlib.sha1()
+    with open(real_match.__file__, 'rb') as f:
+        digest.update(f.read())
+    digest.update(f"{FIRST_ORDINAL}:{TABLE_SIZE}:{PROFILE_WIDTH}".encode())
+    return digest.hexdigest()[:12]
+
+
+def _table_path(cache_file):
+    # profile_table.bin -> profile_table.<отпечаток>.bin, как у таблиц классов
+    root, extension = os.path.splitext(cache_file)
+    return f"{root}.{formula_fingerprint()}{extension}"
+
+
+def build_profile_table():
+    """Считает профили для всех дат диапазона (около секунды)"""
+    table = array('B')
+    for index in range(TABLE_SIZE):
+        person = calculate_individual_matrix(index_to_date(index))
+        table.extend(profile_to_row(person))
+    return table
+
+
+def load_profile_table(cache_file=None):
+    """
+    Загружает таблицу профилей в память.
+    Если указан cache_file, таблица читается из файла для текущей формулы
+    (имя с отпечатком formula_fingerprint), а при отсутствии или повреждении
+    файла строится заново и сохраняется туда.
+    """
+    global _profile_table
+
+    expected_size = TABLE_SIZE * PROFILE_WIDTH
+    if cache_file:
+        cache_file = _table_path(cache_file)
+    if cache_file and os.path.exists(cache_file):
+        try:
+            if os.path.getsize(cache_file) == expected_size:
+                table = array('B')
+                with open(cache_file, 'rb') as f:
+                    table.fromfile(f, expected_size)
+                _profile_table = table
+                return _profile_table
+        except Exception as e:
+            print(f"Ошибка чтения таблицы профилей {cache_file}: {e}")
+
+    _profile_table = build_profile_table()
+
+    if cache_file:
+        try:
+            # Через временный файл: другой процесс не прочитает недописанную таблицу
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'wb') as f:
+                _profile_table.tofile(f)
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            print(f"Ошибка сохранения таблицы профилей {cache_file}: {e}")
+
+    return _profile_table
+
+
+def get_profile_table():
+    """Таблица профилей (строится при первом обращении)"""
+    if _profile_table is None:
+        load_profile_table()
+    return _profile_table
+
+
+def get_profile_row(index):
+    """Строка таблицы для индекса даты: PROFILE_WIDTH чисел"""
+    offset = index * PROFILE_WIDTH
+    return get_profile_table()[offset:offset + PROFILE_WIDTH]
+
+
+def get_individual_matrix(date_str):
+    """
+    То же, что calculate_individual_matrix, но из готовой таблицы.
+    Даты вне диапазона считаются напрямую.
+    """
+    index = date_index(date_str)
+    if index is None:
+        return calculate_individual_matrix(date_str)
+    return _row_to_profile(get_profile_row(index))
@@ -74,84 +74,108 @@ def calculate_individual_matrix(date_str):
         'elements': calculate_elements(day, month, year)
     }
 
+# Баллы совместимости чисел в ячейках матрицы (число1, число2): балл (0-10)
+MATRIX_COMPATIBILITY = {
+    (1, 1): 10, (2, 2): 10, (3, 3): 10, (4, 4): 10, (5, 5): 10,
+    (6, 6): 10, (7, 7): 10, (8, 8): 10, (9, 9): 10,
+    
+    # Гармоничные сочетания
+    (1, 4): 9, (1, 7): 9, (4, 1): 9, (7, 1): 9,
+    (2, 5): 9, (2, 8): 9, (5, 2): 9, (8, 2): 9,
+    (3, 6): 9, (3, 9): 9, (6, 3): 9, (9, 3): 9,
+    
+    (1, 8): 8, (8, 1): 8,  # лидер + организатор
+    (2, 6): 8, (6, 2): 8,  # дипломат + миротворец
+    (4, 7): 8, (7, 4): 8,  # практик + аналитик
+    
+    # Нейтральные (добавлены для покрытия)
+    (1, 2): 6, (1, 3): 6, (1, 5): 6, (1, 6): 6, (1, 9): 6,
+    (2, 1): 6, (2, 3): 6, (2, 4): 6, (2, 7): 6, (2, 9): 6,
+    (3, 1): 6, (3, 2): 6, (3, 4): 6, (3, 5): 6, (3, 7): 6, (3, 8): 6,
+    (4, 2): 6, (4, 3): 6, (4, 5): 6, (4, 6): 6, (4, 8): 6, (4, 9): 6,
+    (5, 1): 6, (5, 3): 6, (5, 4): 6, (5, 6): 6, (5, 7): 6, (5, 9): 6,
+    (6, 1): 6, (6, 4): 6, (6, 5): 6, (6, 7): 6, (6, 8): 6, (6, 9): 6,
+    (7, 2): 6, (7, 3): 6, (7, 5): 6, (7, 6): 6, (7, 8): 6, (7, 9): 6,
+    (8, 3): 6, (8, 4): 6, (8, 6): 6, (8, 7): 6, (8, 9): 6,
+    (9, 1): 6, (9, 2): 6, (9, 4): 6, (9, 5): 6, (9, 6): 6, (9, 7): 6, (9, 8): 6,
+    
+    # Сложные сочетания
+    (4, 5): 4, (5, 4): 4,  # стабильность vs перемены
+    (1, 7): 4, (7, 1): 4,  # практик vs аналитик (конфликт)
+    (8, 9): 4, (9, 8): 4,  # материя vs духовность
+}
+
+# Баллы совместимости стихий
+ELEMENTS_COMPATIBILITY = {
+    'identical': 10,      # одинаковые значения
+    'harmonious': 8,      # разница 1-2
+    'neutral': 6,         # разница 3-4
+    'challenging': 4,     # разница 5+
+    'opposite': 2         # противоположные (1 и 9, 2 и 8 и т.д.)
+}
+
+# Таблица совместимости ключевых чисел
+KEY_NUMBERS_COMPATIBILITY = {
+    # Числа Судьбы
+    (1, 1): 9, (2, 2): 9, (3, 3): 9, (4, 4): 9, (5, 5): 9,
+    (6, 6): 9, (7, 7): 9, (8, 8): 9, (9, 9): 9,
+    
+    (1, 4): 8, (1, 7): 8, (4, 1): 8, (7, 1): 8,
+    (1, 8): 9, (8, 1): 9,  # идеальное деловое партнёрство
+    (2, 6): 8, (6, 2): 8,
+    (3, 9): 8, (9, 3): 8,
+    (4, 7): 8, (7, 4): 8,
+    
+    # Числа Личности
+    (2, 9): 7, (9, 2): 7,  # дополнение
+    (1, 2): 6, (2, 1): 6,
+    
+    # По умолчанию
+    'default': 5
+}
+
 def calculate_matrix_compatibility(matrix1, matrix2):
     """
     Сравнивает 9 ячеек матриц.
     Возвращает процент 0-100%
     """
-    compatibility_matrix = {
-        # (число1, число2): балл (0-10)
-        (1, 1): 10, (2, 2): 10, (3, 3): 10, (4, 4): 10, (5, 5): 10,
-        (6, 6): 10, (7, 7): 10, (8, 8): 10, (9, 9): 10,
-        
-        # Гармоничные сочетания
-        (1, 4): 9, (1, 7): 9, (4, 1): 9, (7, 1): 9,
-        (2, 5): 9, (2, 8): 9, (5, 2): 9, (8, 2): 9,
-        (3, 6): 9, (3, 9): 9, (6, 3): 9, (9, 3): 9,
-        
-        (1, 8): 8, (8, 1): 8,  # лидер + организатор
-        (2, 6): 8, (6, 2): 8,  # дипломат + миротворец
-        (4, 7): 8, (7, 4): 8,  # практик + аналитик
-        
-        # Нейтральные (добавлены для покрытия)
-        (1, 2): 6, (1, 3): 6, (1, 5): 6, (1, 6): 6, (1, 9): 6,
-        (2, 1): 6, (2, 3): 6, (2, 4): 6, (2, 7): 6, (2, 9): 6,
-        (3, 1): 6, (3, 2): 6, (3, 4): 6, (3, 5): 6, (3, 7): 6, (3, 8): 6,
-        (4, 2): 6, (4, 3): 6, (4, 5): 6, (4, 6): 6, (4, 8): 6, (4, 9): 6,
-        (5, 1): 6, (5, 3): 6, (5, 4): 6, (5, 6): 6, (5, 7): 6, (5, 9): 6,
-        (6, 1): 6, (6, 4): 6, (6, 5): 6, (6, 7): 6, (6, 8): 6, (6, 9): 6,
-        (7, 2): 6, (7, 3): 6, (7, 5): 6, (7, 6): 6, (7, 8): 6, (7, 9): 6,
-        (8, 3): 6, (8, 4): 6, (8, 6): 6, (8, 7): 6, (8, 9): 6,
-        (9, 1): 6, (9, 2): 6, (9, 4): 6, (9, 5): 6, (9, 6): 6, (9, 7): 6, (9, 8): 6,
-        
-        # Сложные сочетания
-        (4, 5): 4, (5, 4): 4,  # стабильность vs перемены
-        (1, 7): 4, (7, 1): 4,  # практик vs аналитик (конфликт)
-        (8, 9): 4, (9, 8): 4,  # материя vs духовность
-    }
     
     total_score = 0
     for i in range(9):
         pair = (matrix1[i], matrix2[i])
         # Если нет в таблице, используем нейтральный балл 5
-        score = compatibility_matrix.get(pair, 5)
+        score = MATRIX_COMPATIBILITY.get(pair, 5)
         total_score += score
     
     # Переводим в процент: 9 ячеек * макс 10 баллов = 90
     return (total_score / 90) * 100
 
+def element_pair_score(val1, val2):
+    """Балл (0-10) для пары значений одной стихии"""
+    diff = abs(val1 - val2)
+    
+    if val1 == val2:
+        return ELEMENTS_COMPATIBILITY['identical']
+    elif diff <= 2:
+        return ELEMENTS_COMPATIBILITY['harmonious']
+    elif diff <= 4:
+        return ELEMENTS_COMPATIBILITY['neutral']
+    elif diff >= 6 and (val1 + val2 == 10 or diff >= 8):
+        return ELEMENTS_COMPATIBILITY['opposite']
+    else:
+        return ELEMENTS_COMPATIBILITY['challenging']
+
 def calculate_elements_compatibility(elem1, elem2):
     """
     Сравнивает 4 стихии.
     Возвращает процент 0-100%
     """
-    elements_compatibility = {
-        'identical': 10,      # одинаковые значения
-        'harmonious': 8,      # разница 1-2
-        'neutral': 6,         # разница 3-4
-        'challenging': 4,     # разница 5+
-        'opposite': 2         # противоположные (1 и 9, 2 и 8 и т.д.)
-    }
     
     total_score = 0
     elements = ['fire', 'earth', 'air', 'water']
     
     for elem in elements:
-        val1, val2 = elem1[elem], elem2[elem]
-        diff = abs(val1 - val2)
-        
-        if val1 == val2:
-            score = elements_compatibility['identical']
-        elif diff <= 2:
-            score = elements_compatibility['harmonious']
-        elif diff <= 4:
-            score = elements_compatibility['neutral']
-        elif diff >= 6 and (val1 + val2 == 10 or abs(val1 - val2) >= 8):
-            score = elements_compatibility['opposite']
-        else:
-            score = elements_compatibility['challenging']
-        
-        total_score += score
+        total_score += element_pair_score(elem1[elem], elem2[elem])
     
     # 4 стихии * макс 10 баллов = 40
     return (total_score / 40) * 100
@@ -161,37 +185,18 @@ def calculate_key_numbers_compatibility(person1, person2):
     Сравнивает ключевые числа.
     Возвращает процент 0-100%
     """
-    # Таблица совместимости ключевых чисел
-    key_numbers_comp = {
-        # Числа Судьбы
-        (1, 1): 9, (2, 2): 9, (3, 3): 9, (4, 4): 9, (5, 5): 9,
-        (6, 6): 9, (7, 7): 9, (8, 8): 9, (9, 9): 9,
-        
-        (1, 4): 8, (1, 7): 8, (4, 1): 8, (7, 1): 8,
-        (1, 8): 9, (8, 1): 9,  # идеальное деловое партнёрство
-        (2, 6): 8, (6, 2): 8,
-        (3, 9): 8, (9, 3): 8,
-        (4, 7): 8, (7, 4): 8,
-        
-        # Числа Личности
-        (2, 9): 7, (9, 2): 7,  # дополнение
-        (1, 2): 6, (2, 1): 6,
-        
-        # По умолчанию
-        'default': 5
-    }
     
     # 1. Совместимость Чисел Судьбы
     destiny_pair = (person1['destiny'], person2['destiny'])
-    destiny_score = key_numbers_comp.get(destiny_pair, key_numbers_comp['default'])
+    destiny_score = KEY_NUMBERS_COMPATIBILITY.get(destiny_pair, KEY_NUMBERS_COMPATIBILITY['default'])
     
     # 2. Совместимость Чисел Личности
     personality_pair = (person1['personality'], person2['personality'])
-    personality_score = key_numbers_comp.get(personality_pair, key_numbers_comp['default'])
+    personality_score = KEY_NUMBERS_COMPATIBILITY.get(personality_pair, KEY_NUMBERS_COMPATIBILITY['default'])
     
     # 3. Совместимость Кармических Задач
     karmic_pair = (person1['karmic_tasks'], person2['karmic_tasks'])
-    karmic_score = key_numbers_comp.get(karmic_pair, key_numbers_comp['default'])
+    karmic_score = KEY_NUMBERS_COMPATIBILITY.get(karmic_pair, KEY_NUMBERS_COMPATIBILITY['default'])
     
     # Средний балл по трём параметрам
     avg_score = (destiny_score + personality_score + karmic_score) / 3
@@ -205,9 +210,12 @@ def calculate_compatibility(date1, date2):
     date1, date2 в формате 'DD.MM.YYYY'
     """
     
-    # 1. Рассчитываем индивидуальные данные
-    person1 = calculate_individual_matrix(date1)
-    person2 = calculate_individual_matrix(date2)
+    from .profiles import get_individual_matrix
+    from .strategies import ab_percentages, get_active_strategy
+    
+    # 1. Берём индивидуальные данные из таблицы профилей
+    person1 = get_individual_matrix(date1)
+    person2 = get_individual_matrix(date2)
     
     # 2. Совместимость по матрице (9 ячеек)
     matrix_score = calculate_matrix_compatibility(
@@ -224,20 +232,27 @@ def calculate_compatibility(date1, date2):
     # 4. Совместимость по ключевым числам
     key_numbers_score = calculate_key_numbers_compatibility(person1, person2)
     
-    # 5. Итоговый процент
-    # final_percentage = (matrix_score + elements_score + key_numbers_score) / 3
-    final_percentage = matrix_score
+    # 5. Итоговый процент по активной стратегии (см. strategies.py)
+    details = {
+        'matrix_score': matrix_score,
+        'elements_score': elements_score,
+        'key_numbers_score': key_numbers_score
+    }
+    final_percentage = get_active_strategy().percentage(matrix_score, elements_score, key_numbers_score)
     
-    return {
-        'percentage': round(final_percentage, 1),
-        'details': {
-            'matrix_score': matrix_score,
-            'elements_score': elements_score,
-            'key_numbers_score': key_numbers_score
-        },
+    result = {
+        'percentage': final_percentage,
+        'details': details,
         'person1': person1,
         'person2': person2
     }
+    
+    # В A/B режиме добавляем проценты других стратегий по тем же показателям
+    alternatives = ab_percentages(details)
+    if alternatives:
+        result['ab_percentages'] = alternatives
+    
+    return result
 
 
 # components.py
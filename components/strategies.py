@@ -0,0 +1,134 @@
+'''
+Реестр стратегий подсчёта итогового процента совместимости.
+
+Все стратегии работают поверх одних и тех же трёх показателей (матрица,
+стихии, ключевые числа), которые считаются один раз из таблицы профилей.
+Стратегия только сводит их в итоговый процент, поэтому несколько стратегий
+(A/B режим) обходятся почти в ту же цену, что и одна.
+'''
+import numpy as np
+
+# Показатели по сумме баллов - теми же операциями, что и в скалярных функциях real_match
+MATRIX_PERCENT = np.array([(total / 90) * 100 for total in range(9 * 10 + 1)])
+ELEMENTS_PERCENT = np.array([(total / 40) * 100 for total in range(4 * 10 + 1)])
+KEY_PERCENT = np.array([((total / 3) / 10) * 100 for total in range(3 * 10 + 1)])
+
+DEFAULT_STRATEGY = 'matrix'
+
+_strategies = {}
+_active_strategy = DEFAULT_STRATEGY
+_ab_strategies = ()
+
+
+class ScoringStrategy:
+    """Именованная версия формулы итогового процента"""
+
+    def __init__(self, name, version, combine):
+        self.name = name
+        self.version = version
+        self.combine = combine
+        self.description = (combine.__doc__ or '').strip()
+        self._percent_table = None
+
+    @property
+    def formula_version(self):
+        """Ключ версии для кэшей: имя и номер версии"""
+        return f"{self.name}-{self.version}"
+
+    def percentage(self, matrix_score, elements_score, key_numbers_score):
+        """Итоговый процент, округлённый как в calculate_compatibility"""
+        return round(self.combine(matrix_score, elements_score, key_numbers_score), 1)
+
+    def percent_table(self):
+        """
+        Итоговые проценты для всех сочетаний сумм баллов (91 x 41 x 31).
+        Считается обычной арифметикой Python, поэтому совпадает со скалярным путём.
+        """
+        if self._percent_table is None:
+            matrix = MATRIX_PERCENT.tolist()
+            elements = ELEMENTS_PERCENT.tolist()
+            key = KEY_PERCENT.tolist()
+            table = np.empty((len(matrix), len(elements), len(key)))
+            for m, matrix_score in enumerate(matrix):
+                for e, elements_score in enumerate(elements):
+                    table[m, e] = [
+                        self.percentage(matrix_score, elements_score, key_score)
+                        for key_score in key
+                    ]
+            self._percent_table = table
+        return self._percent_table
+
+    def percentages(self, matrix_total, elements_total, key_total):
+        """Итоговые проценты по суммам баллов (числа или массивы numpy)"""
+        return self.percent_table()[matrix_total, elements_total, key_total]
+
+
+def register_strategy(name, version):
+    """Декоратор: регистрирует функцию (matrix, elements, key) -> процент"""
+    def decorator(combine):
+        _strategies[name] = ScoringStrategy(name, version, combine)
+        return combine
+    return decorator
+
+
+def get_strategy(name=None):
+    """Стратегия по имени (по умолчанию - активная)"""
+    if name is None:
+        name = _active_strategy
+    if name not in _strategies:
+        raise ValueError(f"Неизвестная стратегия совместимости: {name}")
+    return _strategies[name]
+
+
+def get_active_strategy():
+    """Активная стратегия"""
+    return get_strategy(_active_strategy)
+
+
+def set_active_strategy(name):
+    """Выбирает активную стратегию (например, из настроек бота)"""
+    global _active_strategy
+    get_strategy(name)
+    _active_strategy = name
+
+
+def list_strategies():
+    """Все зарегистрированные стратегии"""
+    return list(_strategies.values())
+
+
+def set_ab_strategies(names):
+    """Стратегии, которые считаются вместе с активной для сравнения (A/B)"""
+    global _ab_strategies
+    for name in names:
+        get_strategy(name)
+    _ab_strategies = tuple(names)
+
+
+def get_ab_strategies():
+    """Стратегии A/B режима"""
+    return [get_strategy(name) for name in _ab_strategies]
+
+
+def ab_percentages(details):
+    """Проценты всех стратегий A/B режима по уже посчитанным показателям"""
+    return {
+        strategy.name: strategy.percentage(
+            details['matrix_score'],
+            details['elements_score'],
+            details['key_numbers_score']
+        )
+        for strategy in get_ab_strategies()
+    }
+
+
+@register_strategy('matrix', version=1)
+def matrix_strategy(matrix_score, elements_score, key_numbers_score):
+    """Главный показатель - только матрица (текущая формула бота)"""
+    return matrix_score
+
+
+@register_strategy('average', version=1)
+def average_strategy(matrix_score, elements_score, key_numbers_score):
+    """Среднее трёх показателей (формула из components/match.py)"""
+    return (matrix_score + elements_score + key_numbers_score) / 3
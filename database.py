@@ -1,108 +1,673 @@
 import sqlite3
 import threading
 import os
+import queue
+import re
 import shutil
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from functools import lru_cache, wraps
+from typing import BinaryIO, Dict, Iterator, List, Optional, Any, Tuple, Union
+
+import numpy as np
+
+from cache import LRUCache
+from photo_store import PhotoStore
+from components.batch import calculate_compatibility_batch
+from components.classes import class_percentages, get_date_class, tables_fingerprint
+
+# Настройки SQLite для каждого соединения пула
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',        # читатели не блокируют писателя
+    'synchronous': 'NORMAL',      # в режиме WAL достаточно, fsync только на checkpoint
+    'cache_size': -16000,         # 16 МБ кэша страниц на соединение
+    'mmap_size': 268435456,       # 256 МБ файла читаются через mmap
+    'temp_store': 'MEMORY',
+    'busy_timeout': 10000,        # мс ожидания блокировки вместо "database is locked"
+    'foreign_keys': 'OFF',
+}
+
+
+# Строк в одной странице потоковых запросов (iter_users)
+USER_PAGE_SIZE = 1000
+
+# Ключи пользователей - INTEGER (Telegram ID, у фейков отрицательные).
+# Наружу Database отдаёт их строками, как раньше, а строковые параметры
+# SQLite сам приводит к INTEGER по типу колонки.
+USER_ID_COLUMNS = frozenset({
+    'user_id', 'from_user_id', 'to_user_id', 'user1_id', 'user2_id', 'banned_by',
+    'reported_user_id', 'reporter_user_id',
+})
+# Начало обхода по user_id (меньше любого Telegram ID)
+MIN_USER_ID = -(1 << 63)
+
+TABLE_SCHEMAS = {
+    # Таблица пользователей
+    'users': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            user_id INTEGER PRIMARY KEY,
+            balance INTEGER DEFAULT 3,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            name TEXT NOT NULL,
+            gender TEXT NOT NULL,
+            birthday TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            photo_id TEXT,  -- Telegram file_id (для совместимости)
+            photo_path TEXT,  -- Локальный путь к фото
+            bio TEXT NOT NULL,
+            zodiac TEXT NOT NULL,
+            city TEXT,
+            is_fake INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_hidden INTEGER DEFAULT 0,
+            profile_class INTEGER,
+            photo_thumb_path TEXT  -- Уменьшенная копия фото для ленты анкет
+        )
+    ''',
+    # Таблица лайков: пара ID и есть ключ, отдельный rowid не нужен
+    'likes': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            from_user_id INTEGER NOT NULL,
+            to_user_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (from_user_id, to_user_id),
+            FOREIGN KEY (from_user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+            FOREIGN KEY (to_user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''',
+    # Таблица взаимных симпатий (user1_id < user2_id)
+    'mutual_likes': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            user1_id INTEGER NOT NULL,
+            user2_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user1_id, user2_id),
+            FOREIGN KEY (user1_id) REFERENCES users(user_id) ON DELETE CASCADE,
+            FOREIGN KEY (user2_id) REFERENCES users(user_id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''',
+    # Таблица платежей
+    'payments': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )
+    ''',
+    # Таблица заблокированных пользователей (раньше создавалась в update_database.py)
+    'banned_users': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            user_id INTEGER PRIMARY KEY,
+            reason TEXT,
+            banned_by INTEGER,
+            banned_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+    # Жалобы на анкеты (раньше создавалась только в update_database.py)
+    'reports': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            reported_user_id INTEGER NOT NULL,
+            reporter_user_id INTEGER NOT NULL,
+            reason TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+}
+
+# Колонки старых схем, которые при пересоздании таблицы не переносятся
+OBSOLETE_COLUMNS = {
+    'likes': ('id',),  # ключ лайка теперь - пара (from_user_id, to_user_id)
+}
+
+
+# Условие «анкета видна» - ровно в таком виде, чтобы SQLite брал частичные индексы
+VISIBLE_USER = 'COALESCE(is_hidden, 0) = 0'
+
+# Индексы под реальные условия запросов: ленты анкет (пол, город, знак среди
+# видимых), подбора по классу профиля, фейков, лайков и платежей
+INDEXES = {
+    'idx_users_visible_gender': f'users(gender) WHERE {VISIBLE_USER}',
+    'idx_users_visible_gender_city_zodiac': f'users(gender, city, zodiac) WHERE {VISIBLE_USER}',
+    'idx_users_visible_gender_zodiac': f'users(gender, zodiac) WHERE {VISIBLE_USER}',
+    'idx_users_profile_class': 'users(profile_class)',
+    'idx_users_fake': 'users(is_fake) WHERE is_fake = 1',
+    'idx_users_registered_at': 'users(registered_at)',
+    'idx_likes_to': 'likes(to_user_id)',
+    'idx_mutual_user2': 'mutual_likes(user2_id)',
+    'idx_payments_user': 'payments(user_id, created_at)',
+    'idx_users_photo_path': 'users(photo_path) WHERE photo_path IS NOT NULL',
+}
+# Одноколоночные индексы, которые заменены составными
+OBSOLETE_INDEXES = ('idx_users_gender', 'idx_users_city', 'idx_users_zodiac')
+
+# Полнотекстовый поиск анкет (FTS5): rowid = user_id. unicode61 сам приводит
+# кириллицу к нижнему регистру, «ё» заменяем на «е» и в тексте, и в запросе.
+SEARCH_COLUMNS = ('name', 'city', 'bio')
+
+
+def _search_text(value: str) -> str:
+    return f"replace(replace({value}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+def _search_insert(prefix: str) -> str:
+    values = ', '.join(_search_text(f'{prefix}.{column}') for column in SEARCH_COLUMNS)
+    return f"INSERT INTO users_fts (rowid, {', '.join(SEARCH_COLUMNS)}) VALUES ({prefix}.user_id, {values});"
+
+
+SEARCH_SCHEMA = [
+    f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            {', '.join(SEARCH_COLUMNS)},
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''',
+    f'''
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+            {_search_insert('new')}
+        END
+    ''',
+    '''
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+            DELETE FROM users_fts WHERE rowid = old.user_id;
+        END
+    ''',
+    f'''
+        CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF user_id, {', '.join(SEARCH_COLUMNS)} ON users BEGIN
+            DELETE FROM users_fts WHERE rowid = old.user_id;
+            {_search_insert('new')}
+        END
+    ''',
+]
+
+
+# Счётчики лайков на пользователя, их ведут триггеры на likes и mutual_likes.
+# Взаимная пара удаляет лайк из likes, но остаётся отправленным и полученным
+# лайком для обоих: sent = likes(от него) + mutual, received = likes(ему) + mutual.
+LIKE_COUNTER_COLUMNS = ('likes_sent', 'likes_received', 'mutual_count')
+
+
+def _counter_change(user: str, sent: int, received: int, mutual: int) -> str:
+    return f'''
+        INSERT INTO like_counters (user_id, likes_sent, likes_received, mutual_count)
+        VALUES ({user}, {sent}, {received}, {mutual})
+        ON CONFLICT (user_id) DO UPDATE SET
+            likes_sent = likes_sent + excluded.likes_sent,
+            likes_received = likes_received + excluded.likes_received,
+            mutual_count = mutual_count + excluded.mutual_count;
+    '''
+
+
+LIKE_COUNTER_SCHEMA = [
+    '''
+        CREATE TABLE IF NOT EXISTS like_counters (
+            user_id INTEGER PRIMARY KEY,
+            likes_sent INTEGER NOT NULL DEFAULT 0,
+            likes_received INTEGER NOT NULL DEFAULT 0,
+            mutual_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''',
+    f'''
+        CREATE TRIGGER IF NOT EXISTS like_counters_like_insert AFTER INSERT ON likes BEGIN
+            {_counter_change('new.from_user_id', 1, 0, 0)}
+            {_counter_change('new.to_user_id', 0, 1, 0)}
+        END
+    ''',
+    f'''
+        CREATE TRIGGER IF NOT EXISTS like_counters_like_delete AFTER DELETE ON likes BEGIN
+            {_counter_change('old.from_user_id', -1, 0, 0)}
+            {_counter_change('old.to_user_id', 0, -1, 0)}
+        END
+    ''',
+    f'''
+        CREATE TRIGGER IF NOT EXISTS like_counters_mutual_insert AFTER INSERT ON mutual_likes BEGIN
+            {_counter_change('new.user1_id', 1, 1, 1)}
+            {_counter_change('new.user2_id', 1, 1, 1)}
+        END
+    ''',
+    f'''
+        CREATE TRIGGER IF NOT EXISTS like_counters_mutual_delete AFTER DELETE ON mutual_likes BEGIN
+            {_counter_change('old.user1_id', -1, -1, -1)}
+            {_counter_change('old.user2_id', -1, -1, -1)}
+        END
+    ''',
+    # Лайки удалённой анкеты удаляются вместе с ней: триггеры выше уменьшают
+    # счётчики её партнёров, затем удаляется строка самой анкеты
+    '''
+        CREATE TRIGGER IF NOT EXISTS like_counters_user_delete AFTER DELETE ON users BEGIN
+            DELETE FROM likes WHERE from_user_id = old.user_id OR to_user_id = old.user_id;
+            DELETE FROM mutual_likes WHERE user1_id = old.user_id OR user2_id = old.user_id;
+            DELETE FROM like_counters WHERE user_id = old.user_id;
+        END
+    ''',
+]
+
+# Лайки и взаимности, у которых одной из анкет уже нет
+ORPHANED_LIKES = {
+    'likes': 'from_user_id NOT IN (SELECT user_id FROM users) OR to_user_id NOT IN (SELECT user_id FROM users)',
+    'mutual_likes': 'user1_id NOT IN (SELECT user_id FROM users) OR user2_id NOT IN (SELECT user_id FROM users)',
+}
+
+# Счётчики, посчитанные заново по likes и mutual_likes (для сверки)
+ACTUAL_LIKE_COUNTS = '''
+    SELECT user_id, SUM(sent) AS likes_sent, SUM(received) AS likes_received,
+           SUM(mutual) AS mutual_count
+    FROM (
+        SELECT from_user_id AS user_id, to_user_id AS partner_id,
+               1 AS sent, 0 AS received, 0 AS mutual FROM likes
+        UNION ALL SELECT to_user_id, from_user_id, 0, 1, 0 FROM likes
+        UNION ALL SELECT user1_id, user2_id, 1, 1, 1 FROM mutual_likes
+        UNION ALL SELECT user2_id, user1_id, 1, 1, 1 FROM mutual_likes
+    )
+    WHERE user_id IN (SELECT user_id FROM users)
+      AND partner_id IN (SELECT user_id FROM users)
+    GROUP BY user_id
+'''
+
+
+def search_match_query(query: str) -> Optional[str]:
+    """
+    Строка поиска -> запрос FTS5: каждое слово ищется по префиксу,
+    все слова должны найтись. None, если слов в строке нет.
+    """
+    words = re.findall(r'\w+', query.replace('ё', 'е').replace('Ё', 'Е'))
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def ordered_pair(user1_id, user2_id):
+    """Пара ID для mutual_likes: меньший ID первым (по числу, не по строке)"""
+    user1_id, user2_id = str(user1_id), str(user2_id)
+    try:
+        if int(user1_id) > int(user2_id):
+            return user2_id, user1_id
+    except ValueError:
+        return tuple(sorted([user1_id, user2_id]))
+    return user1_id, user2_id
+
+
+@lru_cache(maxsize=256)
+def _id_positions(columns):
+    return tuple(i for i, name in enumerate(columns) if name in USER_ID_COLUMNS)
+
+
+def _row_factory(cursor, values):
+    """sqlite3.Row, в котором ID пользователей - строки (как при TEXT-ключах)"""
+    positions = _id_positions(tuple(column[0] for column in cursor.description))
+    if positions:
+        values = list(values)
+        for i in positions:
+            if values[i] is not None:
+                values[i] = str(values[i])
+        values = tuple(values)
+    return sqlite3.Row(cursor, values)
+
+
+class ConnectionPool:
+    """
+    Ограниченный пул соединений SQLite.
+    Соединения создаются по мере надобности (не больше size), выдаются через
+    checkout() и возвращаются через checkin(). Если все заняты, checkout ждёт.
+    """
+    
+    def __init__(self, db_file: str, size: int = 8, timeout: float = 30,
+                 pragmas: Optional[Dict[str, Any]] = None):
+        self.db_file = db_file
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._connections = []
+        self.checkouts = 0
+        self.waits = 0
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_file,
+            check_same_thread=False,
+            timeout=self.pragmas.get('busy_timeout', 10000) / 1000
+        )
+        conn.row_factory = _row_factory
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+    
+    def checkout(self) -> sqlite3.Connection:
+        """Взять соединение из пула (ждёт до timeout секунд, если все заняты)"""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if len(self._connections) < self.size:
+                    conn = self._connect()
+                    self._connections.append(conn)
+            if conn is None:
+                with self._lock:
+                    self.waits += 1
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError(
+                        f"Нет свободных соединений с БД (пул из {self.size})"
+                    )
+        with self._lock:
+            self.checkouts += 1
+        return conn
+    
+    def checkin(self, conn: sqlite3.Connection):
+        """Вернуть соединение в пул; незавершённая транзакция откатывается"""
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+    
+    def close_all(self):
+        """Закрыть все соединения пула"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                break
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                print(f"Ошибка закрытия соединения с БД: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        """Размер пула, открытые и свободные соединения, ожидания"""
+        return {
+            'size': self.size,
+            'open': len(self._connections),
+            'idle': self._idle.qsize(),
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+        }
+
+
+def writes(method):
+    """Метод Database пишет в базу: AsyncDatabase выполняет его потоком-писателем"""
+    method.writes = True
+    return method
+
+
+def pooled(method):
+    """Метод Database получает соединение из пула на время вызова"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.connection():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class Database:
-    def __init__(self, db_file='bot_database.db', photos_dir='photos'):
+    def __init__(self, db_file='bot_database.db', photos_dir='photos',
+                 pool_size: int = 8, pragmas: Optional[Dict[str, Any]] = None,
+                 user_cache_size: int = 10000, user_cache_ttl: Optional[float] = 300):
         self.db_file = db_file
         self.photos_dir = photos_dir
+        self.pool = ConnectionPool(db_file, size=pool_size, pragmas=pragmas)
         self._local = threading.local()
         
+        # Строки users в памяти: get_user, get_user_profile, get_user_photo_path
+        self.user_cache = LRUCache(maxsize=user_cache_size, ttl=user_cache_ttl)
+        self._user_cache_generation = 0
+        self._user_cache_lock = threading.Lock()
+        self.distribution = None  # CompatibilityDistribution, см. attach_distribution
+        self.like_writer = None  # LikeWriter: отложенная запись лайков
+        self.search_enabled = False  # есть ли FTS5 (иначе search_users через LIKE)
+        
         # Создаем папку для фотографий
         os.makedirs(photos_dir, exist_ok=True)
         
         self.init_database()
+        
+        # Фото хранятся по хэшу содержимого, одинаковые - один раз
+        self.photo_store = PhotoStore(self, photos_dir)
+    
+    @contextmanager
+    def connection(self):
+        """
+        Соединение из пула на время блока with. Вложенные вызовы в том же
+        потоке получают то же соединение, в пул оно возвращается на выходе
+        из внешнего блока.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+        
+        conn = self.pool.checkout()
+        self._local.conn = conn
+        self._local.depth = 1
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._local.depth = 0
+            self.pool.checkin(conn)
     
     def get_connection(self):
-        """Получаем соединение с БД для текущего потока"""
-        if not hasattr(self._local, 'conn'):
-            self._local.conn = sqlite3.connect(
-                self.db_file, 
-                check_same_thread=False,
-                timeout=10
-            )
-            self._local.conn.row_factory = sqlite3.Row
-        return self._local.conn
+        """Соединение текущего потока (выдаётся пулом внутри connection())"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            raise RuntimeError("Соединение с БД берётся только внутри Database.connection()")
+        return conn
     
+    @writes
+    @pooled
     def init_database(self):
         """Инициализация всех таблиц"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        # Таблица пользователей (обновленная)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id TEXT PRIMARY KEY,
-                balance INTEGER DEFAULT 3,
-                registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                name TEXT NOT NULL,
-                gender TEXT NOT NULL,
-                birthday TEXT NOT NULL,
-                age INTEGER NOT NULL,
-                photo_id TEXT,  -- Telegram file_id (для совместимости)
-                photo_path TEXT,  -- Локальный путь к фото
-                bio TEXT NOT NULL,
-                zodiac TEXT NOT NULL,
-                city TEXT,
-                is_fake INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        for table in TABLE_SCHEMAS:
+            cursor.execute(TABLE_SCHEMAS[table].format(table=table))
         
-        # ... остальные таблицы без изменений ...
-        # Таблица лайков
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS likes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                from_user_id TEXT NOT NULL,
-                to_user_id TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(from_user_id, to_user_id),
-                FOREIGN KEY (from_user_id) REFERENCES users(user_id) ON DELETE CASCADE,
-                FOREIGN KEY (to_user_id) REFERENCES users(user_id) ON DELETE CASCADE
-            )
-        ''')
+        # Новые поля в существующих базах
+        self._add_column_if_missing(cursor, 'users', 'is_hidden', 'INTEGER DEFAULT 0')
+        self._add_column_if_missing(cursor, 'users', 'profile_class', 'INTEGER')
+        self._add_column_if_missing(cursor, 'users', 'photo_thumb_path', 'TEXT')
         
-        # Таблица взаимных симпатий
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS mutual_likes (
-                user1_id TEXT NOT NULL,
-                user2_id TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user1_id, user2_id),
-                FOREIGN KEY (user1_id) REFERENCES users(user_id) ON DELETE CASCADE,
-                FOREIGN KEY (user2_id) REFERENCES users(user_id) ON DELETE CASCADE
-            )
-        ''')
+        # Старые базы с TEXT-ключами переводим на INTEGER
+        conn.commit()
+        self._migrate_integer_keys(conn)
         
-        # Таблица платежей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                amount INTEGER NOT NULL,
-                description TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
-            )
-        ''')
+        # Индексы (по from_user_id и user1_id ищет первичный ключ)
+        for name in OBSOLETE_INDEXES:
+            cursor.execute(f'DROP INDEX IF EXISTS {name}')
+        for name, definition in INDEXES.items():
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {definition}')
         
-        # Индексы
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_gender ON users(gender)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_city ON users(city)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_zodiac ON users(zodiac)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_likes_from ON likes(from_user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_likes_to ON likes(to_user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_mutual_user1 ON mutual_likes(user1_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_mutual_user2 ON mutual_likes(user2_id)')
+        # Проставляем класс профиля пользователям, сохранённым до его появления.
+        # Номера классов зависят от таблиц классов: при их смене (другая
+        # формула) классы пересчитываются у всех
+        cursor.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        classes_version = tables_fingerprint()
+        cursor.execute("SELECT value FROM meta WHERE key = 'profile_classes'")
+        stored_version = cursor.fetchone()
+        where = 'birthday IS NOT NULL'
+        if stored_version is not None and stored_version['value'] == classes_version:
+            where += ' AND profile_class IS NULL'
+        elif stored_version is not None:
+            print("🔄 Таблицы классов изменились, пересчитываем классы профилей...")
+        cursor.execute(f'SELECT user_id, birthday FROM users WHERE {where}')
+        updates = []
+        for row in cursor.fetchall():
+            profile_class = get_date_class(row['birthday'])
+            updates.append((profile_class, row['user_id'], profile_class))
+        # Дата вне таблицы - класс NULL (и старый номер не остаётся)
+        cursor.executemany(
+            'UPDATE users SET profile_class = ? WHERE user_id = ? AND profile_class IS NOT ?',
+            updates
+        )
+        cursor.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('profile_classes', ?)",
+            (classes_version,)
+        )
         
         conn.commit()
+        
+        self.search_enabled = self._init_search(conn)
+        self._init_like_counters(conn)
+        self.check_query_plans()
+    
+    @writes
+    def _init_search(self, conn) -> bool:
+        """
+        Таблица users_fts и триггеры, которые держат её в соответствии с users.
+        При первом создании таблица заполняется из users. False, если SQLite
+        собран без FTS5.
+        """
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_fts'")
+        created = cursor.fetchone() is None
+        try:
+            for statement in SEARCH_SCHEMA:
+                cursor.execute(statement)
+            if created:
+                columns = ', '.join(SEARCH_COLUMNS)
+                values = ', '.join(_search_text(column) for column in SEARCH_COLUMNS)
+                cursor.execute(
+                    f'INSERT INTO users_fts (rowid, {columns}) SELECT user_id, {values} FROM users'
+                )
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            print(f"ℹ️ Полнотекстовый поиск недоступен ({e}), поиск анкет через LIKE")
+            return False
+        return True
+    
+    @writes
+    def _init_like_counters(self, conn):
+        """Таблица like_counters и её триггеры; новая таблица заполняется сверкой"""
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'like_counters'")
+        created = cursor.fetchone() is None
+        # Триггер удаления анкеты пересоздаётся: в старых базах он не трогал лайки
+        cursor.execute('DROP TRIGGER IF EXISTS like_counters_user_delete')
+        for statement in LIKE_COUNTER_SCHEMA:
+            cursor.execute(statement)
+        
+        # Лайки анкет, удалённых до этого триггера. Счётчики могли быть уже
+        # сверены без них, поэтому после удаления - снова сверка
+        orphaned = 0
+        for table, where in ORPHANED_LIKES.items():
+            cursor.execute(f'DELETE FROM {table} WHERE {where}')
+            orphaned += cursor.rowcount
+        conn.commit()
+        if orphaned:
+            print(f"🔧 Удалены лайки удалённых анкет: {orphaned}")
+        if created or orphaned:
+            self.reconcile_like_counters()
+    
+    @writes
+    def _migrate_integer_keys(self, conn):
+        """
+        Перевод таблиц с TEXT-ключами пользователей на INTEGER.
+        Таблица с TEXT-ключами или устаревшими колонками (OBSOLETE_COLUMNS)
+        пересоздаётся по TABLE_SCHEMAS и заполняется из старой, всё в одной
+        транзакции. Строки, чей ID не целое число, не переносятся: старая
+        таблица тогда остаётся под именем <таблица>_legacy.
+        """
+        cursor = conn.cursor()
+        outdated = {}
+        for table in TABLE_SCHEMAS:
+            cursor.execute(f"PRAGMA table_info({table})")
+            old_columns = {row['name']: row['type'] for row in cursor.fetchall()}
+            text_keys = any(
+                column in USER_ID_COLUMNS and column_type.upper() != 'INTEGER'
+                for column, column_type in old_columns.items()
+            )
+            if text_keys or set(OBSOLETE_COLUMNS.get(table, ())) & set(old_columns):
+                outdated[table] = old_columns
+        if not outdated:
+            return
+        
+        print(f"🔄 Перевод ключей пользователей с TEXT на INTEGER: {', '.join(outdated)}...")
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            for table, old_columns in outdated.items():
+                for column in OBSOLETE_COLUMNS.get(table, ()):
+                    old_columns.pop(column, None)
+                legacy = f'{table}_legacy'
+                
+                # Индексы уезжают вместе с переименованной таблицей - удаляем их
+                cursor.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                    (table,)
+                )
+                for row in cursor.fetchall():
+                    cursor.execute(f'DROP INDEX {row["name"]}')
+                cursor.execute(f'ALTER TABLE {table} RENAME TO {legacy}')
+                cursor.execute(TABLE_SCHEMAS[table].format(table=table))
+                
+                cursor.execute(f"PRAGMA table_info({table})")
+                new_columns = [row['name'] for row in cursor.fetchall()]
+                # Колонки, добавленные в старую таблицу вручную, сохраняем
+                for column, column_type in old_columns.items():
+                    if column not in new_columns:
+                        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+                        new_columns.append(column)
+                
+                columns = [column for column in new_columns if column in old_columns]
+                id_columns = [column for column in columns if column in USER_ID_COLUMNS]
+                select = ', '.join(
+                    f'CAST({column} AS INTEGER)' if column in id_columns else column
+                    for column in columns
+                )
+                # Целое число, записанное строкой без лишних символов ('123', '-9...')
+                valid = ' AND '.join(
+                    f'({column} IS NULL OR CAST(CAST({column} AS INTEGER) AS TEXT) = {column})'
+                    for column in id_columns
+                ) or '1'
+                cursor.execute(
+                    f'INSERT OR IGNORE INTO {table} ({", ".join(columns)}) '
+                    f'SELECT {select} FROM {legacy} WHERE {valid}'
+                )
+                cursor.execute(f'SELECT COUNT(*) FROM {legacy} WHERE NOT ({valid})')
+                skipped = cursor.fetchone()[0]
+                
+                if table == 'mutual_likes':
+                    # Пары упорядочивались как строки, теперь - как числа
+                    cursor.execute(
+                        'UPDATE OR REPLACE mutual_likes SET user1_id = user2_id, user2_id = user1_id '
+                        'WHERE user1_id > user2_id'
+                    )
+                
+                if skipped:
+                    print(f"⚠️ {table}: {skipped} строк с нечисловыми ID оставлены в {legacy}")
+                else:
+                    cursor.execute(f'DROP TABLE {legacy}')
+            conn.commit()
+            print("✅ Ключи пользователей переведены на INTEGER")
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ Ошибка перевода ключей на INTEGER: {e}")
+            raise
+        
+        self.invalidate_user()
+    
+    def _add_column_if_missing(self, cursor, table: str, column: str, definition: str):
+        """Добавить колонку в таблицу, если её ещё нет"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
     
     # === Методы для пользователей ===
+    @pooled
     def user_exists(self, user_id: str) -> bool:
         """Проверить, существует ли пользователь"""
         conn = self.get_connection()
@@ -111,31 +676,80 @@ class Database:
         return cursor.fetchone() is not None
     
     def get_user(self, user_id: str) -> Optional[Dict]:
-        """Получить пользователя по ID"""
+        """Получить пользователя по ID (через кэш строк)"""
+        user = self._get_cached_user(user_id)
+        return dict(user) if user else None
+    
+    def _get_cached_user(self, user_id: str) -> Optional[Dict]:
+        key = str(user_id)
+        user = self.user_cache.get(key)
+        if user is not None:
+            return user
+        
+        # Если пока читали строку, её успели изменить - в кэш не кладём
+        generation = self._user_cache_generation
+        user = self._load_user(user_id)
+        if user is not None:
+            with self._user_cache_lock:
+                if generation == self._user_cache_generation:
+                    self.user_cache.set(key, user)
+        return user
+    
+    @pooled
+    def _load_user(self, user_id: str) -> Optional[Dict]:
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
         row = cursor.fetchone()
         return dict(row) if row else None
     
+    def invalidate_user(self, user_id: str = None):
+        """Сбросить строку пользователя в кэше (без user_id - весь кэш)"""
+        with self._user_cache_lock:
+            self._user_cache_generation += 1
+            if user_id is None:
+                self.user_cache.clear()
+            else:
+                self.user_cache.delete(str(user_id))
+    
+    def user_cache_stats(self) -> Dict[str, Any]:
+        """Счётчики кэша строк пользователей"""
+        return self.user_cache.stats()
+    
     # === Дополнительные методы ===
     
     # === Новые методы для работы с фотографиями ===
     
-    def save_user_photo(self, user_id: str, photo_file: bytes, photo_id: str = None) -> str:
+    @writes
+    def store_photo(self, photo: Union[bytes, Dict, None],
+                    pin: bool = False) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Кладёт фото в хранилище: байты как есть или результат
+        image_pipeline.process_image (фото + уменьшенная копия с размерами).
+        Возвращает (photo_path, photo_thumb_path) для save_user(photo_paths=...).
+        pin=True - фото для анкеты, которой ещё нет (регистрация): файлы не
+        удаляются, пока save_user(photo_paths=...) не запишет их в анкету.
+        """
+        if not photo:
+            return None, None
+        if isinstance(photo, dict):
+            photo_path = self.photo_store.put(photo['photo'], photo['width'], photo['height'], pin=pin)
+            thumb_path = self.photo_store.put(
+                photo['thumb'], photo['thumb_width'], photo['thumb_height'], pin=pin
+            )
+            return photo_path, thumb_path
+        return self.photo_store.put(photo, pin=pin), None
+    
+    @writes
+    @pooled
+    def save_user_photo(self, user_id: str, photo_file: Union[bytes, Dict], photo_id: str = None) -> str:
         """
         Сохранить фотографию пользователя локально.
         Возвращает путь к сохраненному файлу.
         """
         try:
-            # Генерируем имя файла
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{user_id}_{timestamp}.jpg"
-            filepath = os.path.join(self.photos_dir, filename)
-            
-            # Сохраняем файл
-            with open(filepath, 'wb') as f:
-                f.write(photo_file)
+            # Сохраняем файл (такое же фото уже может лежать в хранилище)
+            filepath, thumb_path = self.store_photo(photo_file)
             
             # Обновляем запись в базе
             conn = self.get_connection()
@@ -144,56 +758,88 @@ class Database:
             current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             cursor.execute('''
                 UPDATE users 
-                SET photo_path = ?, photo_id = ?, updated_at = ?
+                SET photo_path = ?, photo_thumb_path = ?, photo_id = ?, updated_at = ?
                 WHERE user_id = ?
-            ''', (filepath, photo_id, current_time, user_id))
+            ''', (filepath, thumb_path, photo_id, current_time, user_id))
             
             # Если пользователя еще нет, создаем запись
             if cursor.rowcount == 0:
                 # Создаем минимальную запись пользователя
                 cursor.execute('''
-                    INSERT INTO users (user_id, name, photo_path, photo_id, updated_at)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, f"User_{user_id[:8]}", filepath, photo_id, current_time))
+                    INSERT INTO users (user_id, name, photo_path, photo_thumb_path, photo_id, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (user_id, f"User_{user_id[:8]}", filepath, thumb_path, photo_id, current_time))
             
             conn.commit()
+            self.invalidate_user(user_id)
             return filepath
             
         except Exception as e:
             print(f"Ошибка сохранения фото пользователя {user_id}: {e}")
             return None
     
-    def get_user_photo_path(self, user_id: str) -> Optional[str]:
-        """Получить путь к фотографии пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT photo_path FROM users WHERE user_id = ?', 
-            (user_id,)
-        )
-        row = cursor.fetchone()
-        return row[0] if row and row[0] else None
+    def get_user_photo_path(self, user_id: str, variant: str = 'photo') -> Optional[str]:
+        """
+        Получить путь к фотографии пользователя.
+        variant='thumb' - уменьшенная копия для ленты (если её нет - само фото).
+        """
+        user = self._get_cached_user(user_id)
+        if not user:
+            return None
+        if variant == 'thumb' and user.get('photo_thumb_path'):
+            return user['photo_thumb_path']
+        return user['photo_path'] or None
     
-    def get_user_photo_file(self, user_id: str) -> Optional[bytes]:
-        """Получить фотографию пользователя как байты"""
-        photo_path = self.get_user_photo_path(user_id)
-        if not photo_path or not os.path.exists(photo_path):
+    def get_photo_file_id(self, photo_path: str) -> Optional[str]:
+        """
+        file_id, под которым Telegram уже хранит файл photo_path:
+        по нему фото отправляется без повторной загрузки
+        """
+        try:
+            return self.photo_store.get_file_id(photo_path)
+        except Exception as e:
+            print(f"Ошибка чтения file_id фото {photo_path}: {e}")
+            return None
+    
+    @writes
+    def set_photo_file_id(self, photo_path: str, file_id: Optional[str]) -> bool:
+        """
+        Запомнить file_id для файла photo_path (None - забыть).
+        Файл в хранилище не меняется, поэтому file_id общий для всех анкет с этим фото.
+        """
+        try:
+            return self.photo_store.set_file_id(photo_path, file_id)
+        except Exception as e:
+            print(f"Ошибка сохранения file_id фото {photo_path}: {e}")
+            return False
+    
+    def open_user_photo(self, user_id: str, variant: str = 'photo') -> Optional[BinaryIO]:
+        """
+        Открыть фотографию пользователя на чтение (файл закрывает вызывающий).
+        Файл передаётся в bot.send_photo как есть, без чтения в bytes.
+        """
+        photo_path = self.get_user_photo_path(user_id, variant)
+        if not photo_path:
             return None
         
         try:
-            with open(photo_path, 'rb') as f:
-                return f.read()
+            return open(photo_path, 'rb')
+        except FileNotFoundError:
+            return None
         except Exception as e:
             print(f"Ошибка чтения фото пользователя {user_id}: {e}")
             return None
     
+    @writes
+    @pooled
     def delete_user_photo(self, user_id: str) -> bool:
         """Удалить фотографию пользователя"""
         try:
             photo_path = self.get_user_photo_path(user_id)
             
-            # Удаляем файл
-            if photo_path and os.path.exists(photo_path):
+            # Файл из хранилища удалит sweep, когда на него не останется ссылок;
+            # старый файл вне хранилища удаляем сразу
+            if photo_path and not self.photo_store.contains(photo_path) and os.path.exists(photo_path):
                 os.remove(photo_path)
             
             # Обновляем запись в базе
@@ -203,11 +849,12 @@ class Database:
             
             cursor.execute('''
                 UPDATE users 
-                SET photo_path = NULL, photo_id = NULL, updated_at = ?
+                SET photo_path = NULL, photo_thumb_path = NULL, photo_id = NULL, updated_at = ?
                 WHERE user_id = ?
             ''', (current_time, user_id))
             
             conn.commit()
+            self.invalidate_user(user_id)
             return True
             
         except Exception as e:
@@ -216,65 +863,82 @@ class Database:
 
     def get_all_photo_paths(self) -> List[str]:
         """Получить все пути к фотографиям (для обслуживания)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT photo_path FROM users WHERE photo_path IS NOT NULL')
-        return [row[0] for row in cursor.fetchall() if row[0]]
+        paths = []
+        for row in self.iter_users(('photo_path', 'photo_thumb_path')):
+            paths.extend(path for path in (row['photo_path'], row['photo_thumb_path']) if path)
+        return paths
     
+    @writes
     def cleanup_orphaned_photos(self) -> int:
-        """Удалить фото, которые не привязаны к пользователям"""
+        """Удалить фото, на которые не ссылается ни одна анкета"""
         try:
-            # Получаем все фото из базы
-            db_photos = set(self.get_all_photo_paths())
-            
-            # Получаем все файлы в папке photos
-            actual_photos = set()
-            for root, dirs, files in os.walk(self.photos_dir):
-                for file in files:
-                    if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                        actual_photos.add(os.path.join(root, file))
-            
-            # Находим фото, которых нет в базе
-            orphaned = actual_photos - db_photos
-            
-            # Удаляем их
-            for photo_path in orphaned:
-                try:
-                    os.remove(photo_path)
-                except Exception as e:
-                    print(f"Ошибка удаления фото {photo_path}: {e}")
-            
-            return len(orphaned)
-            
+            return self.photo_store.sweep()
         except Exception as e:
             print(f"Ошибка очистки фото: {e}")
             return 0
     
+    @writes
+    def migrate_photos_to_store(self) -> int:
+        """
+        Переносит фото, сохранённые до хранилища ({user_id}_{время}.jpg),
+        в хранилище по хэшу. Возвращает число перенесённых анкет.
+        """
+        moved = 0
+        for row in self.iter_users(('photo_path',)):
+            photo_path = row['photo_path']
+            if not photo_path or self.photo_store.contains(photo_path):
+                continue
+            try:
+                with open(photo_path, 'rb') as f:
+                    new_path = self.photo_store.put(f.read())
+            except OSError as e:
+                print(f"Не удалось перенести фото {photo_path}: {e}")
+                continue
+            
+            with self.connection() as conn:
+                conn.execute(
+                    'UPDATE users SET photo_path = ? WHERE user_id = ? AND photo_path = ?',
+                    (new_path, row['user_id'], photo_path)
+                )
+                conn.commit()
+            self.invalidate_user(row['user_id'])
+            
+            try:
+                os.remove(photo_path)
+            except OSError:
+                pass
+            moved += 1
+        return moved
+    
+    @writes
+    @pooled
     def save_user(self, user_id: str, name: str, gender: str, birthday: str, age: int,
                   bio: str, zodiac: str, balance: int = 3, 
-                  photo_file: bytes = None, photo_id: str = None,
-                  city: str = None, is_fake: int = 0) -> bool:
-        """Сохранить или обновить пользователя с фотографией"""
+                  photo_file: Union[bytes, Dict] = None, photo_id: str = None,
+                  city: str = None, is_fake: int = 0,
+                  photo_paths: Tuple[Optional[str], Optional[str]] = None) -> bool:
+        """
+        Сохранить или обновить пользователя с фотографией.
+        Фото - байты/результат обработки (photo_file) или пути уже
+        сохранённого через store_photo фото (photo_paths).
+        """
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
             
             current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            profile_class = get_date_class(birthday)
             
             # Если есть фото, сохраняем его
-            photo_path = None
-            if photo_file:
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                filename = f"{user_id}_{timestamp}.jpg"
-                photo_path = os.path.join(self.photos_dir, filename)
-                
-                # Сохраняем файл
-                with open(photo_path, 'wb') as f:
-                    f.write(photo_file)
+            if photo_paths and self.photo_store.contains(photo_paths[0]):
+                photo_path, thumb_path = photo_paths
+            else:
+                photo_path, thumb_path = self.store_photo(photo_file)
             
             # Проверяем, существует ли пользователь
-            cursor.execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,))
-            user_exists = cursor.fetchone() is not None
+            cursor.execute('SELECT profile_class FROM users WHERE user_id = ?', (user_id,))
+            existing = cursor.fetchone()
+            user_exists = existing is not None
             
             if user_exists:
                 # Обновляем существующего пользователя
@@ -284,6 +948,8 @@ class Database:
                 if photo_path:
                     update_fields.append('photo_path = ?')
                     params.append(photo_path)
+                    update_fields.append('photo_thumb_path = ?')
+                    params.append(thumb_path)
                 
                 if photo_id:
                     update_fields.append('photo_id = ?')
@@ -295,6 +961,8 @@ class Database:
                 params.append(gender)
                 update_fields.append('birthday = ?')
                 params.append(birthday)
+                update_fields.append('profile_class = ?')
+                params.append(profile_class)
                 update_fields.append('age = ?')
                 params.append(age)
                 update_fields.append('bio = ?')
@@ -320,15 +988,28 @@ class Database:
                 # Создаем нового пользователя
                 cursor.execute('''
                     INSERT INTO users 
-                    (user_id, name, gender, birthday, age, photo_id, photo_path, bio, zodiac, 
-                     city, is_fake, balance, registered_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    (user_id, name, gender, birthday, age, photo_id, photo_path, photo_thumb_path, bio, zodiac, 
+                     city, is_fake, balance, profile_class, registered_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (
-                    user_id, name, gender, birthday, age, photo_id, photo_path, bio, zodiac,
-                    city, is_fake, balance, current_time, current_time
+                    user_id, name, gender, birthday, age, photo_id, photo_path, thumb_path, bio, zodiac,
+                    city, is_fake, balance, profile_class, current_time, current_time
                 ))
             
             conn.commit()
+            self.invalidate_user(user_id)
+            
+            # Фото уже в анкете (ссылку считает триггер) - закрепление не нужно
+            if photo_paths:
+                self.photo_store.unpin(*photo_paths)
+            
+            # Обновляем распределение совместимости: новая анкета или смена даты
+            if self.distribution:
+                old_class = existing['profile_class'] if user_exists else None
+                if not user_exists or old_class != profile_class:
+                    self.distribution.remove_user(old_class)
+                    self.distribution.add_user(profile_class)
+            
             return True
             
         except Exception as e:
@@ -337,6 +1018,8 @@ class Database:
                 conn.rollback()
             return False
     
+    @writes
+    @pooled
     def update_user_balance(self, user_id: str, delta: int) -> bool:
         """Обновить баланс пользователя"""
         try:
@@ -347,11 +1030,13 @@ class Database:
                 (delta, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id)
             )
             conn.commit()
+            self.invalidate_user(user_id)
             return cursor.rowcount > 0
         except Exception as e:
             print(f"Ошибка обновления баланса пользователя {user_id}: {e}")
             return False
     
+    @pooled
     def get_user_count(self) -> int:
         """Получить общее количество пользователей"""
         conn = self.get_connection()
@@ -359,6 +1044,7 @@ class Database:
         cursor.execute('SELECT COUNT(*) FROM users')
         return cursor.fetchone()[0]
     
+    @pooled
     def get_all_users(self, exclude_user_id: str = None) -> List[Dict]:
         """Получить всех пользователей (кроме указанного)"""
         conn = self.get_connection()
@@ -371,6 +1057,7 @@ class Database:
         
         return [dict(row) for row in cursor.fetchall()]
     
+    @pooled
     def get_users_by_filters(self, exclude_user_id: str = None, gender: str = None, 
                             zodiac: str = None, city_filter: str = None) -> List[Dict]:
         """Получить пользователей с фильтрами"""
@@ -403,6 +1090,184 @@ class Database:
         cursor.execute(query, params)
         return [dict(row) for row in cursor.fetchall()]
     
+    def iter_users(self, columns=('user_id',), exclude_user_id: str = None, gender: str = None,
+                   zodiac: str = None, city: str = None, is_fake: int = None,
+                   page_size: int = USER_PAGE_SIZE) -> Iterator[sqlite3.Row]:
+        """
+        Потоковый обход пользователей: только нужные колонки, страницами
+        по page_size строк по ключу user_id (без OFFSET). Соединение берётся
+        из пула на одну страницу, поэтому память и занятые соединения
+        не зависят от размера таблицы.
+        """
+        for column in columns:
+            if not column.isidentifier():
+                raise ValueError(f"Недопустимое имя колонки: {column}")
+        select = ', '.join(dict.fromkeys(('user_id',) + tuple(columns)))
+        
+        where = 'user_id > ?'
+        params = []
+        
+        if exclude_user_id:
+            where += ' AND user_id != ?'
+            params.append(exclude_user_id)
+        
+        if gender:
+            where += ' AND gender = ?'
+            params.append(gender)
+        
+        if zodiac:
+            where += ' AND zodiac = ?'
+            params.append(zodiac)
+        
+        if city:
+            where += ' AND city = ?'
+            params.append(city)
+        
+        if is_fake is not None:
+            where += ' AND COALESCE(is_fake, 0) = ?'
+            params.append(is_fake)
+        
+        last_id = MIN_USER_ID
+        while True:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    f'SELECT {select} FROM users WHERE {where} ORDER BY user_id LIMIT ?',
+                    [last_id] + params + [page_size]
+                )
+                rows = cursor.fetchall()
+            
+            yield from rows
+            
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1]['user_id']
+    
+    def iter_user_ids(self, **filters) -> Iterator[str]:
+        """ID пользователей (фильтры как у iter_users)"""
+        for row in self.iter_users(('user_id',), **filters):
+            yield row['user_id']
+    
+    def iter_browse_candidates(self, user_id: str, gender: str = None, zodiac: str = None,
+                               city: str = None, page_size: int = USER_PAGE_SIZE) -> Iterator[sqlite3.Row]:
+        """
+        Анкеты для просмотра одним запросом на страницу: фильтры по полу,
+        знаку и городу, а также исключение себя, скрытых, заблокированных
+        и уже лайкнутых анкет выполняются в SQL. Строки - (user_id, city).
+        """
+        self._flush_likes()
+        query, params = self._browse_query(user_id, gender, zodiac, city)
+        
+        last_id = MIN_USER_ID
+        while True:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(query, [last_id] + params + [page_size])
+                rows = cursor.fetchall()
+            
+            yield from rows
+            
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1]['user_id']
+    
+    def _browse_query(self, user_id: str, gender: str = None, zodiac: str = None, city: str = None):
+        """
+        Запрос страницы ленты анкет и его параметры (кроме первого - ключа
+        страницы - и последнего - LIMIT)
+        """
+        where = f'''
+            user_id > ?
+            AND user_id != ?
+            AND {VISIBLE_USER}
+            AND user_id NOT IN (SELECT user_id FROM banned_users)
+            AND user_id NOT IN (SELECT to_user_id FROM likes WHERE from_user_id = ?)
+            AND user_id NOT IN (SELECT user2_id FROM mutual_likes WHERE user1_id = ?)
+            AND user_id NOT IN (SELECT user1_id FROM mutual_likes WHERE user2_id = ?)
+        '''
+        params = [user_id] * 4
+        
+        if gender:
+            where += ' AND gender = ?'
+            params.append(gender)
+        
+        if zodiac:
+            where += ' AND zodiac = ?'
+            params.append(zodiac)
+        
+        if city:
+            where += ' AND city = ?'
+            params.append(city)
+        
+        return f'SELECT user_id, city FROM users WHERE {where} ORDER BY user_id LIMIT ?', params
+    
+    @pooled
+    def get_top_compatible_users(self, user_id: str, limit: int = 10, gender: str = None,
+                                 zodiac: str = None, city_filter: str = None) -> List[Dict]:
+        """
+        Самые совместимые с пользователем анкеты с учётом фильтров.
+        Классы профилей группируются в полосы с одинаковым баллом, и полосы
+        запрашиваются по индексу profile_class от лучшей к худшей, пока не
+        наберётся limit анкет - остальные строки не читаются вовсе.
+        Скрытые и заблокированные анкеты исключаются.
+        К каждой анкете добавляется поле 'compatibility' (процент).
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT birthday, city FROM users WHERE user_id = ?', (user_id,))
+        user_row = cursor.fetchone()
+        if not user_row:
+            return []
+        
+        user_class = get_date_class(user_row['birthday'])
+        if user_class is None:
+            return []
+        
+        where = f'''
+            user_id != ?
+            AND {VISIBLE_USER}
+            AND user_id NOT IN (SELECT user_id FROM banned_users)
+        '''
+        params = [user_id]
+        
+        # Унарный плюс не даёт SQLite взять индекс по полу/знаку/городу
+        # вместо idx_users_profile_class: полоса классов всегда выборочнее
+        if gender:
+            where += ' AND +gender = ?'
+            params.append(gender)
+        
+        if zodiac:
+            where += ' AND +zodiac = ?'
+            params.append(zodiac)
+        
+        if city_filter == "same_city" and user_row['city']:
+            where += ' AND +city = ?'
+            params.append(user_row['city'])
+        
+        # Проценты всех классов относительно класса пользователя
+        percentages = class_percentages(user_class)
+        
+        users = []
+        for percentage in np.unique(percentages)[::-1]:
+            band = np.flatnonzero(percentages == percentage).tolist()
+            placeholders = ', '.join('?' * len(band))
+            cursor.execute(
+                f'SELECT * FROM users WHERE profile_class IN ({placeholders}) AND {where} LIMIT ?',
+                band + params + [limit - len(users)]
+            )
+            
+            for row in cursor.fetchall():
+                user = dict(row)
+                user['compatibility'] = float(percentage)
+                users.append(user)
+            
+            if len(users) >= limit:
+                break
+        
+        return users
+    
+    @pooled
     def get_fake_users_count(self):
         """Возвращает количество фейковых анкет"""
         conn = self.get_connection()
@@ -411,22 +1276,79 @@ class Database:
         result = cursor.fetchone()
         return result[0] if result else 0
 
+    @writes
+    @pooled
     def delete_all_fake_users(self):
         """Удаляет все фейковые анкеты"""
+        # Накопленные лайки - в базу, чтобы триггер удаления убрал и их
+        self._flush_likes()
+        
         conn = self.get_connection()
         cursor = conn.cursor()
+        cursor.execute('SELECT user_id FROM users WHERE is_fake = 1')
+        fake_ids = [row[0] for row in cursor.fetchall()]
         cursor.execute('DELETE FROM users WHERE is_fake = 1')
-        return cursor.rowcount
+        deleted = cursor.rowcount
+        conn.commit()
+        self.invalidate_user()
+        
+        if self.like_writer and fake_ids:
+            self.like_writer.forget_users(fake_ids)
+        
+        if self.distribution and deleted:
+            self.distribution.rebuild(self.get_profile_class_counts())
+        
+        return deleted
+    
+    @pooled
+    def get_profile_class_counts(self) -> Dict[int, int]:
+        """Количество пользователей в каждом классе профиля"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT profile_class, COUNT(*) FROM users
+            WHERE profile_class IS NOT NULL
+            GROUP BY profile_class
+        ''')
+        return {row[0]: row[1] for row in cursor.fetchall()}
+    
+    @writes
+    def attach_distribution(self, distribution):
+        """
+        Подключает распределение совместимости: строит его по текущей базе,
+        дальше оно обновляется при сохранении и удалении анкет.
+        """
+        distribution.rebuild(self.get_profile_class_counts())
+        self.distribution = distribution
     
     # === Методы для лайков ===
+    @writes
     def add_like(self, from_user_id: str, to_user_id: str) -> bool:
         """Добавить лайк и проверить взаимность, возвращает True если лайк взаимный"""
+        if self.like_writer:
+            return self.like_writer.add_like(from_user_id, to_user_id)
+        return self._write_like(from_user_id, to_user_id)
+    
+    def _flush_likes(self):
+        """Дописывает в базу лайки, накопленные LikeWriter, перед чтением"""
+        if self.like_writer:
+            self.like_writer.flush()
+    
+    @writes
+    def flush_likes(self) -> int:
+        """Дописать в базу лайки, накопленные LikeWriter; возвращает число операций"""
+        return self.like_writer.flush() if self.like_writer else 0
+    
+    @writes
+    @pooled
+    def _write_like(self, from_user_id: str, to_user_id: str) -> bool:
+        """Запись лайка сразу, со своей транзакцией"""
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
             
             # Проверяем, существует ли уже взаимный лайк
-            user1, user2 = sorted([from_user_id, to_user_id])
+            user1, user2 = ordered_pair(from_user_id, to_user_id)
             cursor.execute(
                 'SELECT 1 FROM mutual_likes WHERE user1_id = ? AND user2_id = ?',
                 (user1, user2)
@@ -471,13 +1393,19 @@ class Database:
             conn.rollback()
             return False
     
-    def get_mutual_likes(self, user_id: str) -> List[Dict]:
-        """Получить всех пользователей, с которыми есть взаимная симпатия"""
+    @pooled
+    def get_mutual_likes(self, user_id: str, include_received: bool = False) -> List[Dict]:
+        """
+        Получить всех пользователей, с которыми есть взаимная симпатия.
+        С include_received=True добавляются и те, кто лайкнул пользователя
+        без ответа. Поле 'like_type' - 'mutual' или 'received'.
+        """
+        self._flush_likes()
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT u.* FROM users u
+        query = '''
+            SELECT u.*, 'mutual' AS like_type FROM users u
             WHERE u.user_id IN (
                 SELECT 
                     CASE 
@@ -487,16 +1415,59 @@ class Database:
                 FROM mutual_likes 
                 WHERE user1_id = ? OR user2_id = ?
             )
-        ''', (user_id, user_id, user_id))
+        '''
+        params = [user_id, user_id, user_id]
+        
+        if include_received:
+            query += '''
+            UNION ALL
+            SELECT u.*, 'received' AS like_type FROM users u
+            WHERE u.user_id IN (SELECT from_user_id FROM likes WHERE to_user_id = ?)
+            '''
+            params.append(user_id)
+        
+        cursor.execute(query, params)
         
         return [dict(row) for row in cursor.fetchall()]
     
+    @pooled
+    def get_mutual_compatibility_report(self, user_id: str, include_received: bool = False) -> List[Dict]:
+        """
+        Совместимость пользователя со всеми взаимными симпатиями (и, по желанию,
+        входящими лайками) за один запрос и один пакетный расчёт.
+        Возвращает анкеты по убыванию совместимости с полями 'compatibility'
+        и 'details' (матрица, стихии, ключевые числа).
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT birthday FROM users WHERE user_id = ?', (user_id,))
+        user_row = cursor.fetchone()
+        if not user_row:
+            return []
+        
+        users = self.get_mutual_likes(user_id, include_received)
+        if not users:
+            return []
+        
+        result = calculate_compatibility_batch(
+            user_row['birthday'], [user['birthday'] for user in users], details=True
+        )
+        for i, user in enumerate(users):
+            user['compatibility'] = float(result['percentage'][i])
+            user['details'] = {key: float(values[i]) for key, values in result['details'].items()}
+        
+        users.sort(key=lambda user: user['compatibility'], reverse=True)
+        return users
+    
+    @pooled
     def is_mutual_like(self, user1_id: str, user2_id: str) -> bool:
         """Проверить, есть ли взаимная симпатия между двумя пользователями"""
+        self._flush_likes()
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        user1, user2 = sorted([user1_id, user2_id])
+        user1, user2 = ordered_pair(user1_id, user2_id)
         cursor.execute(
             'SELECT 1 FROM mutual_likes WHERE user1_id = ? AND user2_id = ?',
             (user1, user2)
@@ -505,18 +1476,81 @@ class Database:
         return cursor.fetchone() is not None
     
     def get_like_count(self, user_id: str, direction: str = 'sent') -> int:
-        """Получить количество отправленных или полученных лайков"""
+        """
+        Количество отправленных ('sent'), полученных ('received') лайков
+        или взаимных симпатий ('mutual'). Взаимные симпатии входят и в
+        отправленные, и в полученные.
+        """
+        column = {'sent': 'likes_sent', 'received': 'likes_received', 'mutual': 'mutual_count'}[direction]
+        return self.get_like_counts(user_id)[column]
+    
+    @pooled
+    def get_like_counts(self, user_id: str) -> Dict[str, int]:
+        """Все счётчики лайков пользователя одним чтением из like_counters"""
+        self._flush_likes()
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        if direction == 'sent':
-            cursor.execute('SELECT COUNT(*) FROM likes WHERE from_user_id = ?', (user_id,))
-        else:  # 'received'
-            cursor.execute('SELECT COUNT(*) FROM likes WHERE to_user_id = ?', (user_id,))
+        cursor.execute(
+            f'SELECT {", ".join(LIKE_COUNTER_COLUMNS)} FROM like_counters WHERE user_id = ?',
+            (user_id,)
+        )
+        row = cursor.fetchone()
+        if not row:
+            return {column: 0 for column in LIKE_COUNTER_COLUMNS}
+        return dict(row)
+    
+    @writes
+    @pooled
+    def reconcile_like_counters(self) -> int:
+        """
+        Сверка like_counters с likes и mutual_likes: счётчики, разошедшиеся
+        с реальными данными, перезаписываются. Возвращает число исправленных
+        пользователей.
+        """
+        self._flush_likes()
+        conn = self.get_connection()
+        cursor = conn.cursor()
         
-        return cursor.fetchone()[0]
+        try:
+            # Запись блокируется на время сверки, чтобы лайки не проскочили между запросами
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('DROP TABLE IF EXISTS temp.actual_like_counts')
+            cursor.execute(f'CREATE TEMP TABLE actual_like_counts AS {ACTUAL_LIKE_COUNTS}')
+            
+            # Расходящиеся и лишние строки
+            cursor.execute('''
+                INSERT OR REPLACE INTO like_counters (user_id, likes_sent, likes_received, mutual_count)
+                SELECT a.user_id, a.likes_sent, a.likes_received, a.mutual_count
+                FROM actual_like_counts a
+                LEFT JOIN like_counters c ON c.user_id = a.user_id
+                WHERE c.user_id IS NULL
+                   OR c.likes_sent != a.likes_sent
+                   OR c.likes_received != a.likes_received
+                   OR c.mutual_count != a.mutual_count
+            ''')
+            fixed = cursor.rowcount
+            cursor.execute('''
+                DELETE FROM like_counters
+                WHERE user_id NOT IN (SELECT user_id FROM actual_like_counts)
+                  AND (likes_sent != 0 OR likes_received != 0 OR mutual_count != 0)
+            ''')
+            fixed += cursor.rowcount
+            
+            cursor.execute('DROP TABLE temp.actual_like_counts')
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Ошибка сверки счётчиков лайков: {e}")
+            return 0
+        
+        if fixed:
+            print(f"🔧 Исправлены счётчики лайков у {fixed} пользователей")
+        return fixed
     
     # === Методы для платежей ===
+    @writes
+    @pooled
     def add_payment(self, user_id: str, amount: int, description: str = None) -> bool:
         """Добавить запись о платеже"""
         try:
@@ -534,6 +1568,7 @@ class Database:
             print(f"Ошибка добавления платежа для пользователя {user_id}: {e}")
             return False
     
+    @pooled
     def get_user_payments(self, user_id: str) -> List[Dict]:
         """Получить историю платежей пользователя"""
         conn = self.get_connection()
@@ -581,11 +1616,29 @@ class Database:
             "is_fake": user.get("is_fake", 0)
         }
     
+    @pooled
     def search_users(self, query: str, limit: int = 20) -> List[Dict]:
-        """Поиск пользователей по имени или городу"""
+        """
+        Поиск пользователей по имени, городу и описанию.
+        С FTS5 - по началам слов без учёта регистра, лучшие совпадения первыми;
+        без FTS5 - подстрокой по имени и городу.
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        if self.search_enabled:
+            match = search_match_query(query)
+            if match is None:
+                return []
+            cursor.execute('''
+                SELECT u.* FROM users_fts
+                JOIN users u ON u.user_id = users_fts.rowid
+                WHERE users_fts MATCH ?
+                ORDER BY rank
+                LIMIT ?
+            ''', (match, limit))
+            return [dict(row) for row in cursor.fetchall()]
+        
         search_term = f"%{query}%"
         cursor.execute('''
             SELECT * FROM users 
@@ -595,6 +1648,7 @@ class Database:
         
         return [dict(row) for row in cursor.fetchall()]
     
+    @pooled
     def get_recent_users(self, limit: int = 10) -> List[Dict]:
         """Получить недавно зарегистрированных пользователей"""
         conn = self.get_connection()
@@ -608,8 +1662,69 @@ class Database:
         
         return [dict(row) for row in cursor.fetchall()]
     
+    def _hot_queries(self) -> Dict[str, str]:
+        """Частые запросы бота в том виде, в каком их выполняют методы выше"""
+        queries = {
+            'get_user': 'SELECT * FROM users WHERE user_id = ?',
+            'top_compatible_band': f'''
+                SELECT * FROM users WHERE profile_class IN (?, ?, ?)
+                AND user_id != ? AND {VISIBLE_USER}
+                AND user_id NOT IN (SELECT user_id FROM banned_users)
+                AND +gender = ? LIMIT ?
+            ''',
+            'mutual_likes': '''
+                SELECT u.* FROM users u WHERE u.user_id IN (
+                    SELECT CASE WHEN user1_id = ? THEN user2_id ELSE user1_id END
+                    FROM mutual_likes WHERE user1_id = ? OR user2_id = ?
+                )
+            ''',
+            'received_likes': 'SELECT u.* FROM users u WHERE u.user_id IN (SELECT from_user_id FROM likes WHERE to_user_id = ?)',
+            'is_mutual_like': 'SELECT 1 FROM mutual_likes WHERE user1_id = ? AND user2_id = ?',
+            'like_counts': 'SELECT likes_sent, likes_received, mutual_count FROM like_counters WHERE user_id = ?',
+            'fake_users': 'SELECT COUNT(*) FROM users WHERE is_fake = 1',
+            'user_payments': 'SELECT * FROM payments WHERE user_id = ? ORDER BY created_at DESC',
+        }
+        if self.search_enabled:
+            queries['search_users'] = '''
+                SELECT u.* FROM users_fts JOIN users u ON u.user_id = users_fts.rowid
+                WHERE users_fts MATCH ? ORDER BY rank LIMIT ?
+            '''
+        # Лента анкет с типичными сочетаниями фильтров
+        for filters in ({'gender': 'female'},
+                        {'gender': 'female', 'city': 'city'},
+                        {'gender': 'female', 'zodiac': 'zodiac'},
+                        {'gender': 'female', 'zodiac': 'zodiac', 'city': 'city'}):
+            queries[f"browse[{', '.join(filters)}]"] = self._browse_query('0', **filters)[0]
+        return queries
+
+    @pooled
+    def check_query_plans(self) -> Dict[str, List[str]]:
+        """
+        EXPLAIN QUERY PLAN для частых запросов: предупреждает, если какой-то
+        из них читает таблицу целиком вместо поиска по индексу.
+        Возвращает {запрос: [шаги плана с полным просмотром]}.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        full_scans = {}
+        for name, query in self._hot_queries().items():
+            try:
+                cursor.execute(f'EXPLAIN QUERY PLAN {query}', [None] * query.count('?'))
+                details = [row['detail'] for row in cursor.fetchall()]
+            except sqlite3.Error as e:
+                print(f"⚠️ Не удалось получить план запроса {name}: {e}")
+                continue
+            scans = [
+                detail for detail in details
+                if detail.startswith('SCAN ') and not detail.startswith('SCAN CONSTANT ROW')
+                and 'VIRTUAL TABLE' not in detail
+            ]
+            if scans:
+                full_scans[name] = scans
+                print(f"⚠️ Запрос {name} читает таблицу целиком: {'; '.join(scans)}")
+        return full_scans
+
     def close(self):
-        """Закрыть соединение с БД"""
-        if hasattr(self._local, 'conn'):
-            self._local.conn.close()
-            del self._local.conn
\ No newline at end of file
+        """Закрыть все соединения с БД"""
+        self.pool.close_all()
\ No newline at end of file
@@ -0,0 +1,154 @@
+'''
+Обработка фотографий анкет в отдельных процессах.
+
+Telegram присылает самое большое PhotoSize как есть. Перед сохранением фото
+приводится к JPEG с ограничением по стороне (поворот по EXIF применяется,
+сами метаданные - EXIF, GPS, ICC - не сохраняются), и рядом делается
+уменьшенная копия для ленты анкет. Декодирование и сжатие занимают CPU,
+поэтому выполняются в ProcessPoolExecutor, а не в потоке обработчика.
+
+Без Pillow фото сохраняется как есть (без уменьшенной копии).
+'''
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from typing import Any, Callable, Dict, Optional, Union
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не установлен
+    Image = None
+
+# Основное фото: не больше PHOTO_MAX_SIDE по длинной стороне
+PHOTO_MAX_SIDE = 1280
+PHOTO_QUALITY = 85
+# Уменьшенная копия для ленты анкет
+THUMB_MAX_SIDE = 480
+THUMB_QUALITY = 80
+# Фото больше стольких пикселей не декодируем (защита от «бомб»)
+MAX_PIXELS = 40_000_000
+
+
+def _encode_jpeg(image, max_side: int, quality: int):
+    image = image.copy()
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    buffer = BytesIO()
+    # Без exif/icc_profile: метаданные в файл не попадают
+    image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue(), image.size
+
+
+def _ready() -> bool:
+    return True
+
+
+def process_image(data: bytes) -> Dict:
+    """
+    Фото -> {'photo', 'width', 'height', 'size', 'thumb', 'thumb_width',
+    'thumb_height', 'thumb_size'}. Выполняется в процессе пула.
+    ValueError, если это не изображение.
+    """
+    try:
+        with Image.open(BytesIO(data)) as source:
+            if source.width * source.height > MAX_PIXELS:
+                raise ValueError(f"Слишком большое изображение: {source.width}x{source.height}")
+            image = ImageOps.exif_transpose(source).convert('RGB')
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Не удалось прочитать изображение: {e}")
+
+    photo, (width, height) = _encode_jpeg(image, PHOTO_MAX_SIDE, PHOTO_QUALITY)
+    thumb, (thumb_width, thumb_height) = _encode_jpeg(image, THUMB_MAX_SIDE, THUMB_QUALITY)
+    return {
+        'photo': photo,
+        'width': width,
+        'height': height,
+        'size': len(photo),
+        'thumb': thumb,
+        'thumb_width': thumb_width,
+        'thumb_height': thumb_height,
+        'thumb_size': len(thumb),
+    }
+
+
+class ImagePipeline:
+    """
+    Пул процессов для process_image.
+    submit() возвращает Future сразу; resolve() в момент сохранения анкеты
+    дожидается результата, а если это не изображение, отдаёт None - такие
+    байты в хранилище не попадают.
+    """
+
+    def __init__(self, workers: int = 2, timeout: float = 30):
+        self.timeout = timeout
+        self.enabled = Image is not None
+        self._executor = None
+        # Сохранение результатов (база, файлы) - не в служебном потоке пула
+        # процессов: он раздаёт результаты всех задач и не должен ждать базу
+        self._saver = ThreadPoolExecutor(1, thread_name_prefix='photo-save')
+        if not self.enabled:
+            print("ℹ️ Pillow не установлен, фото сохраняются без обработки")
+            return
+
+        # forkserver/spawn заново выполняют модуль бота в каждом процессе,
+        # поэтому fork. Процессы запускаются сразу, и пул надо создавать до
+        # любых потоков (в том числе TeleBot) и соединений с базой: fork
+        # после них унаследовал бы захваченные блокировки
+        context = None
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        self._executor = ProcessPoolExecutor(workers, mp_context=context)
+        self._executor.submit(_ready).result()
+
+    def submit(self, data: bytes) -> Future:
+        """Запускает обработку фото в пуле процессов"""
+        if not self.enabled:
+            future = Future()
+            future.set_result(data)
+            return future
+        return self._executor.submit(process_image, data)
+
+    def resolve(self, photo: Union[bytes, Future, None]) -> Union[bytes, Dict, None]:
+        """
+        Результат обработки для Database.save_user / save_user_photo:
+        dict с вариантами фото или None, если обработать не удалось
+        """
+        if not isinstance(photo, Future):
+            return photo
+        try:
+            return photo.result(timeout=self.timeout)
+        except Exception as e:
+            print(f"⚠️ Ошибка обработки фото: {e}")
+            return None
+
+    def store(self, data: bytes, save: Callable[[Union[bytes, Dict]], Any]) -> Future:
+        """
+        Обработка и сохранение в фоне: когда фото готово, вызывается
+        save(результат resolve). Возвращает Future с тем, что вернул save
+        (например пути из Database.store_photo), или с None, если это не
+        изображение - тогда save не вызывается. Байты фото живут только до
+        сохранения - держать Future дальше ничего не стоит.
+        """
+        stored = Future()
+
+        def save_processed(processed):
+            try:
+                photo = self.resolve(processed)
+                stored.set_result(save(photo) if photo is not None else None)
+            except Exception as e:
+                stored.set_exception(e)
+
+        self.submit(data).add_done_callback(
+            lambda processed: self._saver.submit(save_processed, processed)
+        )
+        return stored
+
+    def process(self, data: Optional[bytes]) -> Union[bytes, Dict, None]:
+        """Обработать и дождаться результата"""
+        if not data:
+            return data
+        return self.resolve(self.submit(data))
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+        self._saver.shutdown(wait=wait)
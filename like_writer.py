@@ -0,0 +1,205 @@
+'''
+Отложенная запись лайков с групповым коммитом.
+
+Database.add_like делает до пяти запросов и commit на каждое нажатие «❤️ Лайк».
+LikeWriter отвечает сразу по индексу лайков в памяти (есть ли взаимность),
+а запись в базу копит и выполняет одной транзакцией раз в flush_interval
+секунд или когда накопилось max_batch операций. Операции пишутся строго в
+порядке поступления, поэтому для каждой пары порядок сохраняется.
+
+При удалении пользователей Database вызывает forget_users: иначе индекс
+помнил бы лайки, которых в базе уже нет, и следующий лайк получил бы
+неверную взаимность.
+'''
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from database import Database, ordered_pair
+
+
+class LikeWriter:
+    """Индекс лайков в памяти + фоновый поток группового коммита"""
+
+    def __init__(self, db: Database, flush_interval: float = 0.2, max_batch: int = 500):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+
+        self._lock = threading.Lock()          # индекс и очередь
+        self._flush_lock = threading.Lock()    # один сброс в базу за раз
+        self._wakeup = threading.Condition(self._lock)
+        self._queue: List[Tuple[str, str, str]] = []  # (операция, от кого, кому)
+        self._stopped = False
+
+        self.flushes = 0
+        self.flushed_ops = 0
+
+        self._likes, self._mutual = self._load_index()
+
+        self._thread = threading.Thread(target=self._run, name='like-writer', daemon=True)
+        self._thread.start()
+
+        # Чтения Database сначала дописывают накопленные лайки
+        db.like_writer = self
+
+    def _load_index(self):
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT from_user_id, to_user_id FROM likes')
+            likes = {(str(row[0]), str(row[1])) for row in cursor.fetchall()}
+            cursor.execute('SELECT user1_id, user2_id FROM mutual_likes')
+            mutual = {(str(row[0]), str(row[1])) for row in cursor.fetchall()}
+        return likes, mutual
+
+    def add_like(self, from_user_id: str, to_user_id: str) -> bool:
+        """То же, что Database.add_like, но запись в базу откладывается"""
+        from_user_id, to_user_id = str(from_user_id), str(to_user_id)
+        pair = ordered_pair(from_user_id, to_user_id)
+
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("LikeWriter уже остановлен")
+
+            if pair in self._mutual:
+                return True  # Уже есть взаимный лайк
+
+            if (to_user_id, from_user_id) in self._likes:
+                # Взаимность: оба лайка переходят в mutual_likes
+                self._likes.discard((to_user_id, from_user_id))
+                self._likes.discard((from_user_id, to_user_id))
+                self._mutual.add(pair)
+                self._queue.append(('mutual', from_user_id, to_user_id))
+                is_mutual = True
+            else:
+                if (from_user_id, to_user_id) in self._likes:
+                    return False  # Повторный лайк, писать нечего
+                self._likes.add((from_user_id, to_user_id))
+                self._queue.append(('like', from_user_id, to_user_id))
+                is_mutual = False
+
+            if len(self._queue) >= self.max_batch:
+                self._wakeup.notify()
+
+        return is_mutual
+
+    def is_mutual_like(self, user1_id: str, user2_id: str) -> bool:
+        """Проверка взаимности по индексу в памяти"""
+        pair = ordered_pair(user1_id, user2_id)
+        with self._lock:
+            return pair in self._mutual
+
+    def forget_users(self, user_ids: Iterable) -> int:
+        """
+        Убирает из индекса и очереди лайки удалённых пользователей.
+        Возвращает число убранных записей.
+        """
+        user_ids = {str(user_id) for user_id in user_ids}
+        if not user_ids:
+            return 0
+
+        with self._lock:
+            before = len(self._likes) + len(self._mutual) + len(self._queue)
+            self._likes = {like for like in self._likes if not user_ids.intersection(like)}
+            self._mutual = {pair for pair in self._mutual if not user_ids.intersection(pair)}
+            # Несохранённые лайки удалённых пользователей в базу уже не пишем
+            self._queue = [
+                operation for operation in self._queue
+                if operation[1] not in user_ids and operation[2] not in user_ids
+            ]
+            return before - len(self._likes) - len(self._mutual) - len(self._queue)
+
+    @property
+    def pending(self) -> int:
+        """Операций, ещё не записанных в базу"""
+        with self._lock:
+            return len(self._queue)
+
+    def flush(self) -> int:
+        """Записывает накопленные операции одной транзакцией, возвращает их число"""
+        with self._lock:
+            if not self._queue:
+                return 0
+
+        # Соединение берём до _flush_lock: методы Database вызывают flush, уже
+        # держа соединение из пула, и при занятом пуле сброс, ждущий соединение
+        # под _flush_lock, и они, ждущие _flush_lock, ждали бы друг друга
+        try:
+            with self.db.connection() as conn:
+                return self._flush(conn)
+        except Exception as e:
+            print(f"Ошибка записи лайков: {e}")
+            return 0
+
+    def _flush(self, conn) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._queue = self._queue, []
+            if not batch:
+                return 0
+
+            try:
+                cursor = conn.cursor()
+                for operation, from_user_id, to_user_id in batch:
+                    if operation == 'like':
+                        cursor.execute(
+                            'INSERT OR IGNORE INTO likes (from_user_id, to_user_id) VALUES (?, ?)',
+                            (from_user_id, to_user_id)
+                        )
+                    else:
+                        cursor.execute(
+                            'DELETE FROM likes WHERE (from_user_id = ? AND to_user_id = ?) OR (from_user_id = ? AND to_user_id = ?)',
+                            (from_user_id, to_user_id, to_user_id, from_user_id)
+                        )
+                        cursor.execute(
+                            'INSERT OR IGNORE INTO mutual_likes (user1_id, user2_id) VALUES (?, ?)',
+                            ordered_pair(from_user_id, to_user_id)
+                        )
+                conn.commit()
+            except Exception as e:
+                print(f"Ошибка записи лайков ({len(batch)} операций): {e}")
+                conn.rollback()
+                # Возвращаем операции в начало очереди, порядок сохраняется
+                with self._lock:
+                    self._queue = batch + self._queue
+                return 0
+
+            with self._lock:
+                self.flushes += 1
+                self.flushed_ops += len(batch)
+            return len(batch)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._stopped and len(self._queue) < self.max_batch:
+                    self._wakeup.wait(self.flush_interval)
+                stopped = self._stopped
+
+            flushed = self.flush()
+            if stopped:
+                return
+            if not flushed and self.pending >= self.max_batch:
+                # База недоступна - не крутимся впустую до следующего интервала
+                time.sleep(self.flush_interval)
+
+    def close(self):
+        """Останавливает фоновый поток, дописав все накопленные лайки"""
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        self._thread.join()
+        self.flush()
+        if self.db.like_writer is self:
+            self.db.like_writer = None
+
+    def stats(self) -> Dict[str, int]:
+        """Счётчики: сбросов, записанных операций, ожидающих"""
+        with self._lock:
+            return {
+                'pending': len(self._queue),
+                'flushes': self.flushes,
+                'flushed_ops': self.flushed_ops,
+                'likes': len(self._likes),
+                'mutual': len(self._mutual),
+            }
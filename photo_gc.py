@@ -0,0 +1,214 @@
+'''
+Фоновая сборка мусора в папке фото.
+
+PhotoStore.sweep() удаляет файлы, у которых в таблице photos не осталось
+ссылок. Но на диске могут лежать и файлы, о которых база не знает: старые
+фото, от которых остался файл после сбоя, недописанные *.tmp. PhotoCollector
+периодически обходит папку через os.scandir порциями по chunk_size файлов,
+для каждой порции одним запросом по индексам (photos.path,
+users.photo_path) узнаёт, какие файлы ещё нужны, и удаляет остальные не
+быстрее deletes_per_second. Один проход ограничен max_files: следующий
+продолжает с той папки, где остановился прошлый.
+'''
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Set
+
+from photo_store import PHOTO_EXTENSION, SWEEP_GRACE_SECONDS
+
+# Файлов в одной порции (и в одном запросе к базе, меньше лимита переменных SQLite)
+GC_CHUNK_SIZE = 500
+# Файлов за один проход; остальные - в следующий
+GC_MAX_FILES = 200_000
+# Ограничения нагрузки на диск
+GC_DELETES_PER_SECOND = 50
+GC_CHUNK_PAUSE = 0.05
+# Раз в сколько секунд запускать проход
+GC_INTERVAL = 60 * 60
+
+
+class PhotoCollector:
+    """Инкрементальный обход папки фото + удаление файлов, на которые нет ссылок"""
+
+    def __init__(self, db, chunk_size: int = GC_CHUNK_SIZE, max_files: int = GC_MAX_FILES,
+                 deletes_per_second: float = GC_DELETES_PER_SECOND,
+                 chunk_pause: float = GC_CHUNK_PAUSE, min_age: float = SWEEP_GRACE_SECONDS):
+        self.db = db
+        self.photos_dir = db.photo_store.photos_dir
+        self.chunk_size = chunk_size
+        self.max_files = max_files
+        self.deletes_per_second = deletes_per_second
+        self.chunk_pause = chunk_pause
+        # Свежие файлы не трогаем: put() пишет файл до коммита строки photos
+        self.min_age = min_age
+
+        self._lock = threading.Lock()  # один проход за раз
+        self._stop = threading.Event()
+        self._thread = None
+        # Папки, которые ещё предстоит обойти в текущем круге
+        self._pending_dirs: List[str] = []
+
+        self.runs = 0
+        self.rounds = 0  # полных обходов папки
+        self.scanned = 0
+        self.deleted = 0
+        self.bytes_freed = 0
+        self.errors = 0
+        self.swept = 0
+        self.last_run_at: Optional[float] = None
+        self.last_run_seconds = 0.0
+        self.running = False
+
+    def _iter_entries(self) -> Iterator[os.DirEntry]:
+        """Файлы папки фото; останавливается на границе папки после max_files"""
+        if not self._pending_dirs:
+            self._pending_dirs = [self.photos_dir]
+
+        scanned = 0
+        while self._pending_dirs and not self._stop.is_set():
+            if scanned >= self.max_files:
+                return
+            directory = self._pending_dirs.pop()
+            subdirs = []
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            scanned += 1
+                            yield entry
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.errors += 1
+                print(f"Ошибка чтения папки {directory}: {e}")
+            # В обратном порядке: pop() берёт папки по возрастанию
+            self._pending_dirs.extend(sorted(subdirs, reverse=True))
+
+        if not self._pending_dirs:
+            self.rounds += 1
+
+    def _referenced(self, paths: List[str]) -> Set[str]:
+        """Какие из путей ещё нужны (оба запроса идут по индексам)"""
+        placeholders = ', '.join('?' * len(paths))
+        with self.db.connection() as conn:
+            referenced = {
+                row[0] for row in conn.execute(
+                    f'SELECT path FROM photos WHERE path IN ({placeholders})', paths
+                )
+            }
+            # Старые фото вне хранилища (photo_thumb_path всегда из хранилища)
+            referenced.update(
+                row[0] for row in conn.execute(
+                    f'SELECT photo_path FROM users WHERE photo_path IN ({placeholders})', paths
+                )
+            )
+        return referenced
+
+    def _collect_chunk(self, chunk: List[os.DirEntry]) -> int:
+        referenced = self._referenced([entry.path for entry in chunk])
+        cutoff = time.time() - self.min_age
+        removed = 0
+        for entry in chunk:
+            if entry.path in referenced:
+                continue
+            if not (entry.name.endswith(PHOTO_EXTENSION) or entry.name.endswith('.tmp')):
+                continue
+            try:
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime > cutoff:
+                    continue
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                self.errors += 1
+                print(f"Ошибка удаления фото {entry.path}: {e}")
+                continue
+            removed += 1
+            self.deleted += 1
+            self.bytes_freed += stat.st_size
+            # Не больше deletes_per_second удалений в секунду
+            if self.deletes_per_second and self._stop.wait(1 / self.deletes_per_second):
+                break
+        return removed
+
+    def collect(self) -> int:
+        """
+        Один проход: до max_files файлов порциями по chunk_size.
+        Возвращает число удалённых файлов.
+        """
+        with self._lock:
+            self.running = True
+            started = time.time()
+            removed = 0
+            try:
+                chunk = []
+                for entry in self._iter_entries():
+                    chunk.append(entry)
+                    self.scanned += 1
+                    if len(chunk) >= self.chunk_size:
+                        removed += self._collect_chunk(chunk)
+                        chunk = []
+                        if self._stop.wait(self.chunk_pause):
+                            break
+                if chunk and not self._stop.is_set():
+                    removed += self._collect_chunk(chunk)
+            finally:
+                self.runs += 1
+                self.last_run_at = started
+                self.last_run_seconds = time.time() - started
+                self.running = False
+        return removed
+
+    def run_once(self) -> int:
+        """Сначала файлы без ссылок по таблице photos, потом обход диска"""
+        try:
+            self.swept += self.db.photo_store.sweep()
+        except Exception as e:
+            self.errors += 1
+            print(f"Ошибка очистки фото: {e}")
+        return self.collect()
+
+    def _run(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                removed = self.run_once()
+                if removed:
+                    print(f"🧹 Удалено потерянных файлов фото: {removed}")
+            except Exception as e:
+                self.errors += 1
+                print(f"Ошибка сборки мусора в фото: {e}")
+
+    def start(self, interval: float = GC_INTERVAL):
+        """Запускает проходы раз в interval секунд в фоновом потоке"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, args=(interval,), name='photo-gc', daemon=True
+            )
+            self._thread.start()
+
+    def close(self):
+        """Останавливает фоновый поток (текущий проход прерывается между файлами)"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> Dict:
+        """Прогресс и счётчики сборщика"""
+        return {
+            'running': self.running,
+            'runs': self.runs,
+            'rounds': self.rounds,
+            'scanned': self.scanned,
+            'deleted': self.deleted,
+            'bytes_freed': self.bytes_freed,
+            'swept': self.swept,
+            'errors': self.errors,
+            'pending_dirs': len(self._pending_dirs),
+            'last_run_at': self.last_run_at,
+            'last_run_seconds': self.last_run_seconds,
+        }
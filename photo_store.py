@@ -0,0 +1,283 @@
+'''
+Хранилище фотографий по содержимому.
+
+Файл называется SHA-256 своего содержимого и лежит в двухуровневом дереве
+папок по первым символам хэша (photos/ab/cd/abcd....jpg), поэтому одинаковые
+фото (повторное сохранение, общая заглушка у фейков) хранятся один раз.
+В таблице photos на каждый файл - число анкет, которые на него ссылаются.
+Его ведут триггеры на users.photo_path и users.photo_thumb_path: удаление фото у анкеты - это просто
+уменьшение счётчика, а файлы с нулём ссылок удаляет sweep().
+'''
+import hashlib
+import os
+import threading
+from typing import Dict, Optional
+
+from cache import LRUCache
+
+# Первые символы хэша -> папки: 256 * 256 папок хватит на миллионы фото
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+PHOTO_EXTENSION = '.jpg'
+# Сколько file_id держать в памяти
+FILE_ID_CACHE_SIZE = 10000
+# Файл без ссылок удаляется не сразу: между put() и записью photo_path
+# в анкету счётчик ещё нулевой
+SWEEP_GRACE_SECONDS = 600
+# Закреплённое фото (регистрация ещё идёт) не удаляется столько секунд;
+# если за это время оно не попало в анкету, регистрация считается брошенной
+PIN_SECONDS = 24 * 60 * 60
+
+
+def _ref_change(path: str, delta: int) -> str:
+    return f'''
+        UPDATE photos SET refcount = refcount + ({delta}), updated_at = CURRENT_TIMESTAMP
+        WHERE path = {path};
+    '''
+
+
+def _ref_triggers(column: str, prefix: str):
+    """Триггеры, которые ведут счётчик ссылок по колонке users.<column>"""
+    return [
+        f'''
+            CREATE TRIGGER IF NOT EXISTS {prefix}_insert AFTER INSERT ON users
+            WHEN new.{column} IS NOT NULL BEGIN
+                {_ref_change(f'new.{column}', 1)}
+            END
+        ''',
+        f'''
+            CREATE TRIGGER IF NOT EXISTS {prefix}_update AFTER UPDATE OF {column} ON users
+            WHEN old.{column} IS NOT new.{column} BEGIN
+                {_ref_change(f'old.{column}', -1)}
+                {_ref_change(f'new.{column}', 1)}
+            END
+        ''',
+        f'''
+            CREATE TRIGGER IF NOT EXISTS {prefix}_delete AFTER DELETE ON users
+            WHEN old.{column} IS NOT NULL BEGIN
+                {_ref_change(f'old.{column}', -1)}
+            END
+        ''',
+    ]
+
+
+# Колонки users, ссылающиеся на файлы хранилища: фото и его уменьшенная копия
+REF_COLUMNS = {'photo_path': 'photos_ref', 'photo_thumb_path': 'photos_thumb_ref'}
+
+PHOTO_SCHEMA = [
+    '''
+        CREATE TABLE IF NOT EXISTS photos (
+            hash TEXT PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            width INTEGER,
+            height INTEGER,
+            file_id TEXT  -- file_id, под которым Telegram уже хранит этот файл
+        ) WITHOUT ROWID
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_photos_unreferenced ON photos(updated_at) WHERE refcount <= 0',
+    # Фото, сохранённые до появления анкеты (см. put(pin=True))
+    '''
+        CREATE TABLE IF NOT EXISTS photo_pins (
+            path TEXT PRIMARY KEY,
+            pinned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    ''',
+] + [
+    trigger for column, prefix in REF_COLUMNS.items() for trigger in _ref_triggers(column, prefix)
+]
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class PhotoStore:
+    """Файлы фото по хэшу содержимого + счётчики ссылок в таблице photos"""
+
+    def __init__(self, db, photos_dir: str):
+        self.db = db
+        self.photos_dir = photos_dir
+        # put() и sweep() не должны пересечься на одном файле
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.deduplicated = 0
+        self.swept = 0
+        # Файл по пути не меняется, поэтому file_id можно держать в памяти
+        self._file_ids = LRUCache(maxsize=FILE_ID_CACHE_SIZE)
+        self.init_table()
+
+    def init_table(self):
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            for statement in PHOTO_SCHEMA:
+                cursor.execute(statement)
+            # Поля, появившиеся после создания таблицы
+            for column, definition in (('width', 'INTEGER'), ('height', 'INTEGER'), ('file_id', 'TEXT')):
+                self.db._add_column_if_missing(cursor, 'photos', column, definition)
+            conn.commit()
+
+    def path_for(self, digest: str) -> str:
+        """Путь файла с данным хэшем"""
+        shards = [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+        return os.path.join(self.photos_dir, *shards, digest + PHOTO_EXTENSION)
+
+    def put(self, data: bytes, width: Optional[int] = None, height: Optional[int] = None,
+            pin: bool = False) -> str:
+        """
+        Сохраняет фото (если такого ещё нет) и возвращает его путь для
+        users.photo_path. Ссылку засчитывает триггер при записи пути в анкету.
+        pin=True - фото закрепляется до unpin() (не дольше PIN_SECONDS), чтобы
+        sweep не удалил его, пока анкета, которая на него сошлётся, не сохранена.
+        """
+        digest = content_hash(data)
+        path = self.path_for(digest)
+
+        # Файл пишется до транзакции: запись в базу не ждёт диска
+        written = not os.path.exists(path) and self._write_file(path, data)
+
+        with self._lock:
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
+                # Файл уже есть: продлеваем ему жизнь, если он ждёт удаления
+                cursor.execute(
+                    '''
+                        INSERT INTO photos (hash, path, size, width, height) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (hash) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+                        WHERE refcount <= 0
+                    ''',
+                    (digest, path, len(data), width, height)
+                )
+                if pin:
+                    cursor.execute(
+                        'INSERT OR REPLACE INTO photo_pins (path, pinned_at) VALUES (?, CURRENT_TIMESTAMP)',
+                        (path,)
+                    )
+                conn.commit()
+
+        # sweep() мог удалить файл до транзакции; теперь строка свежая и он её не тронет
+        if not os.path.exists(path):
+            written = self._write_file(path, data)
+
+        if written:
+            self.stored += 1
+        else:
+            self.deduplicated += 1
+        return path
+
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> bool:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Через временный файл: читатели не увидят недописанное фото
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
+
+    def unpin(self, *paths: Optional[str]):
+        """Снять закрепление (фото уже в анкете или больше не нужно)"""
+        paths = [(path,) for path in paths if path]
+        if not paths:
+            return
+        with self.db.connection() as conn:
+            conn.executemany('DELETE FROM photo_pins WHERE path = ?', paths)
+            conn.commit()
+
+    def contains(self, path: Optional[str]) -> bool:
+        """Лежит ли файл в хранилище (а не старым файлом {user_id}_{время}.jpg)"""
+        if not path:
+            return False
+        with self.db.connection() as conn:
+            return conn.execute('SELECT 1 FROM photos WHERE path = ?', (path,)).fetchone() is not None
+
+    def get_file_id(self, path: str) -> Optional[str]:
+        """Telegram file_id файла (если он уже отправлялся)"""
+        file_id = self._file_ids.get(path)
+        if file_id is None:
+            with self.db.connection() as conn:
+                row = conn.execute('SELECT file_id FROM photos WHERE path = ?', (path,)).fetchone()
+            file_id = row['file_id'] if row else None
+            if file_id:
+                self._file_ids.set(path, file_id)
+        return file_id
+
+    def set_file_id(self, path: str, file_id: Optional[str]) -> bool:
+        """Запомнить file_id файла (None - забыть, например если Telegram его не принял)"""
+        self._file_ids.delete(path)
+        with self.db.connection() as conn:
+            cursor = conn.execute('UPDATE photos SET file_id = ? WHERE path = ?', (file_id, path))
+            conn.commit()
+        if file_id and cursor.rowcount:
+            self._file_ids.set(path, file_id)
+        return cursor.rowcount > 0
+
+    def sweep(self, grace_seconds: float = SWEEP_GRACE_SECONDS) -> int:
+        """Удаляет файлы, на которые дольше grace_seconds не ссылается ни одна анкета"""
+        with self._lock:
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
+                # Закрепления брошенных регистраций
+                cursor.execute(
+                    "DELETE FROM photo_pins WHERE pinned_at <= datetime('now', ?)",
+                    (f'-{PIN_SECONDS} seconds',)
+                )
+                cursor.execute(
+                    "SELECT hash, path FROM photos WHERE refcount <= 0 AND updated_at <= datetime('now', ?) "
+                    "AND path NOT IN (SELECT path FROM photo_pins)",
+                    (f'-{int(grace_seconds)} seconds',)
+                )
+                unreferenced = cursor.fetchall()
+                cursor.executemany(
+                    'DELETE FROM photos WHERE hash = ? AND refcount <= 0',
+                    [(row['hash'],) for row in unreferenced]
+                )
+                conn.commit()
+
+            removed = 0
+            for row in unreferenced:
+                self._file_ids.delete(row['path'])
+                try:
+                    os.remove(row['path'])
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Ошибка удаления фото {row['path']}: {e}")
+            self.swept += removed
+        return removed
+
+    def recount(self) -> int:
+        """Пересчёт счётчиков ссылок по users; возвращает число исправленных"""
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            actual = ' + '.join(
+                f'(SELECT COUNT(*) FROM users WHERE users.{column} = photos.path)'
+                for column in REF_COLUMNS
+            )
+            actual = f'({actual})'
+            cursor.execute(
+                f'UPDATE photos SET refcount = {actual}, updated_at = CURRENT_TIMESTAMP '
+                f'WHERE refcount != {actual}'
+            )
+            fixed = cursor.rowcount
+            conn.commit()
+        return fixed
+
+    def stats(self) -> Dict[str, int]:
+        """Файлы и байты в хранилище, сколько сохранений обошлось без записи"""
+        with self.db.connection() as conn:
+            row = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refcount), 0) FROM photos'
+            ).fetchone()
+        return {
+            'files': row[0],
+            'bytes': row[1],
+            'references': row[2],
+            'stored': self.stored,
+            'deduplicated': self.deduplicated,
+            'swept': self.swept,
+        }
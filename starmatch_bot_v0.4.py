@@ -11,6 +11,11 @@ import os
 from components import *
 import logging
 from database import Database
+from cache import CompatibilityCache
+from like_writer import LikeWriter
+from views import ViewStore
+from image_pipeline import ImagePipeline
+from photo_gc import PhotoCollector
 import threading
 import requests
 from io import BytesIO
@@ -29,6 +34,10 @@ GROUP_ID = -1001928901997
 MECHANIC_PRICE = 5
 MATCH_PRICE = 0  # стоимость проверки совместимости
 
+# Формула итогового процента совместимости (см. components/strategies.py)
+SCORING_STRATEGY = "matrix"
+SCORING_AB_STRATEGIES = ()  # например ("average",) - считать для сравнения
+
 REQUIRED_CHANNEL = "@StarrMatch"  # Или ID: -1001234567890
 CHANNEL_INVITE_LINK = "https://t.me/StarrMatch"  # Ссылка для вступления
 CHANNEL_NAME = "StarMatch"
@@ -46,10 +55,74 @@ ADMINS = {1734217491, 5503413808}  # Telegram ID
 def is_admin(user_id: int) -> bool:
     return user_id in ADMINS
 
+# Обработка фото (сжатие, уменьшенная копия) в отдельных процессах.
+# Пул создаётся первым, до TeleBot (он сразу запускает рабочие потоки),
+# базы и фоновых потоков: процессы не унаследуют ни потоки, ни соединения
+IMAGE_WORKERS = 2
+image_pipeline = ImagePipeline(workers=IMAGE_WORKERS)
+
 bot = telebot.TeleBot(TOKEN)
 
+# Файл с заранее посчитанными профилями дат рождения
+PROFILE_TABLE_FILE = 'profile_table.bin'
+# Префикс файлов таблицы совместимости классов профилей
+CLASS_TABLES_PREFIX = os.path.join('numerology_cache', 'profile_classes')
+
+# Таблицы профилей и классов - до базы: она проставляет классы профилей,
+# и без загруженных из файлов таблиц построила бы их заново в памяти
+load_profile_table(PROFILE_TABLE_FILE)
+load_class_tables(CLASS_TABLES_PREFIX)
+
+# Размер пула соединений с БД (не меньше числа потоков обработчиков)
+DB_POOL_SIZE = 8
+# Кэш анкет в памяти: сколько строк держать и сколько секунд они живут
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+
 # Инициализация базы данных
-db = Database('bot_database.db', photos_dir='user_photos')
+db = Database('bot_database.db', photos_dir='user_photos', pool_size=DB_POOL_SIZE,
+              user_cache_size=USER_CACHE_SIZE, user_cache_ttl=USER_CACHE_TTL)
+
+# Лайки пишутся в базу пачками (db.add_like отвечает сразу из памяти)
+LIKE_FLUSH_INTERVAL = 0.2  # секунд между групповыми коммитами
+LIKE_FLUSH_BATCH = 500     # или раньше, если накопилось столько операций
+like_writer = LikeWriter(db, flush_interval=LIKE_FLUSH_INTERVAL, max_batch=LIKE_FLUSH_BATCH)
+
+# Фоновая уборка папки фото: раз в столько секунд, не больше стольких удалений в секунду
+PHOTO_GC_INTERVAL = 60 * 60
+PHOTO_GC_DELETES_PER_SECOND = 50
+photo_gc = PhotoCollector(db, deletes_per_second=PHOTO_GC_DELETES_PER_SECOND)
+
+# Как часто сверять счётчики лайков и ссылок на фото с таблицами (секунд)
+LIKE_COUNTERS_RECONCILE_INTERVAL = 6 * 60 * 60
+
+
+def reconcile_counters_loop():
+    """Фоновая сверка счётчиков лайков и ссылок на фото: исправляет расхождения, если они появились"""
+    while True:
+        time.sleep(LIKE_COUNTERS_RECONCILE_INTERVAL)
+        try:
+            db.reconcile_like_counters()
+        except Exception as e:
+            print(f"⚠️ Ошибка сверки счётчиков лайков: {e}")
+        try:
+            fixed = db.photo_store.recount()
+            if fixed:
+                print(f"🔧 Исправлено счётчиков ссылок на фото: {fixed}")
+        except Exception as e:
+            print(f"⚠️ Ошибка сверки ссылок на фото: {e}")
+
+
+# Просмотренные анкеты (не показываются повторно до «Начать заново»)
+view_store = ViewStore(db)
+
+# Кэш результатов совместимости (память + таблица в БД)
+set_active_strategy(SCORING_STRATEGY)
+set_ab_strategies(SCORING_AB_STRATEGIES)
+compat_cache = CompatibilityCache(db)
+
+# Распределение совместимости по базе для «топ N%» (создаётся при запуске)
+compat_distribution = None
 
 # Хранилище для временных данных
 temp_data = {}
@@ -92,7 +165,8 @@ def setup_bot_menu():
         types.BotCommand("myprofile", "👤 Моя анкета"),
         types.BotCommand("help", "❓ Помощь и инструкции"),
         types.BotCommand("browse", "👀 Начать просмотр анкет"),
-        types.BotCommand("compatibility", "💝 Проверить совместимость")
+        types.BotCommand("compatibility", "💝 Проверить совместимость"),
+        types.BotCommand("mutual_report", "📊 Совместимость с симпатиями")
     ]
     
     try:
@@ -101,6 +175,69 @@ def setup_bot_menu():
     except Exception as e:
         print(f"❌ Ошибка настройки меню команд: {e}")
 
+# === ОТПРАВКА АНКЕТ С ФОТО ===
+def send_profile_photo(chat_id, profile_id, profile_data, caption, keyboard, variant='photo'):
+    """
+    Отправляет анкету с фото. Локальное фото загружается в Telegram один раз:
+    полученный file_id запоминается для этого файла, и дальше фото
+    отправляется по нему. Если Telegram не принимает сохранённый file_id,
+    фото загружается заново. Без локального фото - photo_id или только текст.
+    variant='thumb' - уменьшенная копия (лента анкет).
+    """
+    photo_path = db.get_user_photo_path(profile_id, variant)
+    if photo_path:
+        file_id = db.get_photo_file_id(photo_path)
+        if file_id:
+            try:
+                return bot.send_photo(
+                    chat_id,
+                    file_id,
+                    caption=caption,
+                    parse_mode="Markdown",
+                    reply_markup=keyboard
+                )
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 400:
+                    raise
+                print(f"file_id фото {photo_path} больше не действует, загружаем заново: {e}")
+                db.set_photo_file_id(photo_path, None)
+        
+        # Файл передаётся в запрос открытым, без чтения в bytes
+        photo_file = db.open_user_photo(profile_id, variant)
+        if photo_file is not None:
+            try:
+                with photo_file:
+                    msg = bot.send_photo(
+                        chat_id,
+                        photo_file,
+                        caption=caption,
+                        parse_mode="Markdown",
+                        reply_markup=keyboard
+                    )
+                if msg.photo:
+                    db.set_photo_file_id(photo_path, msg.photo[-1].file_id)
+                return msg
+            except Exception as e:
+                print(f"Ошибка отправки локального фото {photo_path}: {e}")
+    
+    # Запасной вариант: Telegram file_id из анкеты
+    photo_id = profile_data.get('photo_id')
+    if photo_id:
+        return bot.send_photo(
+            chat_id,
+            photo_id,
+            caption=caption,
+            parse_mode="Markdown",
+            reply_markup=keyboard
+        )
+    return bot.send_message(
+        chat_id,
+        caption,
+        parse_mode="Markdown",
+        reply_markup=keyboard
+    )
+
+
 # === ОБРАБОТЧИКИ КОМАНД ИЗ МЕНЮ ===
 @bot.message_handler(commands=["myprofile"])
 def myprofile_command(message: Message):
@@ -120,8 +257,8 @@ def myprofile_command(message: Message):
     
     city_text = f"🏙️ *Город:* {user_data.get('city', 'не указан')}\n" if user_data.get('city') else ""
     
-    # Получаем количество взаимных симпатий
-    mutual_count = len(db.get_mutual_likes(user_id))
+    # Счётчики лайков (одна строка like_counters)
+    like_counts = db.get_like_counts(user_id)
     
     caption = (
         f"👤 *{user_data['name']}*\n"
@@ -132,54 +269,66 @@ def myprofile_command(message: Message):
         f"♈ *Знак зодиака:* {user_data['zodiac']}\n\n"
         f"📝 *О себе:*\n{user_data['bio']}\n\n"
         f"💰 *Баланс:* {user_data['balance']} монет\n"
-        f"❤️ *Взаимных симпатий:* {mutual_count}"
+        f"❤️ *Взаимных симпатий:* {like_counts['mutual_count']}\n"
+        f"💌 *Лайков получено:* {like_counts['likes_received']}\n"
+        f"👍 *Лайков отправлено:* {like_counts['likes_sent']}"
     )
     
-    # Пытаемся отправить локальное фото
-    photo_path = db.get_user_photo_path(user_id)
-    if photo_path:
-        try:
-            with open(photo_path, 'rb') as photo_file:
-                bot.send_photo(
-                    message.chat.id,
-                    photo_file,
-                    caption=caption,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-        except Exception as e:
-            print(f"Ошибка отправки локального фото профиля: {e}")
-            # Запасной вариант: используем photo_id
-            if user_data.get('photo_id'):
-                bot.send_photo(
-                    message.chat.id,
-                    user_data['photo_id'],
-                    caption=caption,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-            else:
-                bot.send_message(
-                    message.chat.id,
-                    caption,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-    elif user_data.get('photo_id'):
-        bot.send_photo(
-            message.chat.id,
-            user_data['photo_id'],
-            caption=caption,
-            parse_mode="Markdown",
-            reply_markup=keyboard
-        )
-    else:
-        bot.send_message(
-            message.chat.id,
-            caption,
-            parse_mode="Markdown",
-            reply_markup=keyboard
-        )
+    send_profile_photo(message.chat.id, user_id, user_data, caption, keyboard)
+
+
+def build_browse_queue(user_id, user_city=None, gender=None, zodiac=None, city_filter=None):
+    """
+    Очередь ID анкет для просмотра. Фильтры и исключения (своя, скрытые,
+    заблокированные, уже лайкнутые анкеты) применяются в SQL, из базы
+    читаются только user_id и city. Сначала свой город, внутри групп -
+    вперемешку.
+    """
+    city = user_city if city_filter == "same_city" else None
+    if city_filter == "same_city" and not user_city:
+        return []
+    
+    same_city_ids = []
+    other_city_ids = []
+    
+    for row in db.iter_browse_candidates(user_id, gender=gender, zodiac=zodiac, city=city):
+        if user_city and row['city'] == user_city:
+            same_city_ids.append(row['user_id'])
+        else:
+            other_city_ids.append(row['user_id'])
+    
+    # Уже просмотренные анкеты не показываем
+    same_city_ids = view_store.filter_unseen(user_id, same_city_ids)
+    other_city_ids = view_store.filter_unseen(user_id, other_city_ids)
+    
+    # Перемешиваем внутри каждой группы для разнообразия
+    random.shuffle(same_city_ids)
+    random.shuffle(other_city_ids)
+    
+    return same_city_ids + other_city_ids
+
+
+def rebuild_browse_queue(user_id):
+    """Пересобирает очередь просмотра под текущие фильтры пользователя"""
+    user_data = db.get_user(user_id)
+    user_city = user_data.get("city") if user_data else None
+    
+    with temp_data_lock:
+        filters = temp_data.get(user_id, {})
+        gender = filters.get('filter_gender')
+        zodiac = filters.get('filter_zodiac')
+        city_filter = filters.get('filter_city')
+    
+    user_ids = build_browse_queue(user_id, user_city, gender, zodiac, city_filter)
+    
+    with temp_data_lock:
+        if user_id not in temp_data:
+            temp_data[user_id] = {}
+        temp_data[user_id]['browse_queue'] = user_ids
+        temp_data[user_id]['current_index'] = 0
+        temp_data[user_id]['browse_queue_stale'] = False
+    
+    return user_ids
 
 
 @bot.message_handler(commands=["browse"])
@@ -194,50 +343,29 @@ def browse_command(message: Message):
     user_data = db.get_user(user_id)
     user_city = user_data.get("city") if user_data else None
     
-    # Получаем список анкет (кроме своей) с фильтрами из БД
-    other_users = db.get_users_by_filters(
-        exclude_user_id=user_id,
-        gender=None,
-        zodiac=None,
-        city_filter=None
-    )
+    # Очередь анкет (кроме своей): сначала свой город, внутри групп - вперемешку
+    user_ids = build_browse_queue(user_id, user_city)
     
-    if not other_users:
+    if not user_ids:
+        # Всё уже просмотрено - предлагаем начать заново
+        if view_store.seen_count(user_id):
+            show_no_more_profiles(user_id, message.chat.id)
+            return
         bot.send_message(message.chat.id, "😔 Пока нет других анкет")
         return
     
-    # Сортируем анкеты: сначала из того же города, потом остальные
-    if user_city:
-        same_city_users = []
-        other_city_users = []
-        
-        for user in other_users:
-            if user.get("city") == user_city:
-                same_city_users.append(user)
-            else:
-                other_city_users.append(user)
-        
-        # Перемешиваем внутри каждой группы для разнообразия
-        random.shuffle(same_city_users)
-        random.shuffle(other_city_users)
-        
-        other_users = same_city_users + other_city_users
-    else:
-        # Если город не указан, просто перемешиваем все анкеты
-        random.shuffle(other_users)
-    
     # Инициализируем очередь просмотра
     with temp_data_lock:
         if user_id not in temp_data:
             temp_data[user_id] = {}
         
         # Сохраняем только ID пользователей в очереди
-        user_ids = [user["user_id"] for user in other_users]
-        temp_data[user_id]['browse_queue'] = user_ids.copy()
+        temp_data[user_id]['browse_queue'] = user_ids
         temp_data[user_id]['current_index'] = 0
         temp_data[user_id]['filter_gender'] = None
         temp_data[user_id]['filter_zodiac'] = None
         temp_data[user_id]['filter_city'] = None
+        temp_data[user_id]['browse_queue_stale'] = False
     
     show_next_profile(user_id, message.chat.id)
 
@@ -802,25 +930,34 @@ def get_photo(message: Message):
     photo_id = message.photo[-1].file_id
     
     # Скачиваем фото для локального сохранения
+    photo_paths = None
     try:
         file_info = bot.get_file(photo_id)
         downloaded_file = bot.download_file(file_info.file_path)
         
-        # Сохраняем фото локально через базу данных
-        photo_path = db.save_user_photo(user_id, downloaded_file, photo_id)
+        # Обработка идёт в пуле процессов, файл записывается в хранилище один
+        # раз, в temp_data остаются только пути. До конца регистрации фото
+        # закреплено и уборкой не удаляется
+        stored = image_pipeline.store(downloaded_file, lambda photo: db.store_photo(photo, pin=True))
+        del downloaded_file
+        photo_paths = stored.result(timeout=image_pipeline.timeout)
         
-        if photo_path:
-            print(f"✅ Фото сохранено локально: {photo_path}")
+        if photo_paths is None:
+            # Не изображение: в хранилище ничего не попало
+            bot.send_message(
+                message.chat.id,
+                "❌ Не удалось обработать фото. Пожалуйста, отправьте другую фотографию."
+            )
+            return
         
     except Exception as e:
         print(f"⚠️ Не удалось сохранить фото локально: {e}")
-        photo_path = None
     
     with temp_data_lock:
         if user_id not in temp_data:
             temp_data[user_id] = {}
         temp_data[user_id]["photo_id"] = photo_id
-        temp_data[user_id]["photo_file"] = downloaded_file if 'downloaded_file' in locals() else None
+        temp_data[user_id]["photo_paths"] = photo_paths  # Пути фото в хранилище
     
     bot.send_message(
         message.chat.id,
@@ -1045,7 +1182,7 @@ def complete_registration(user_id, chat_id):
         gender=user_temp_data["gender"],
         birthday=user_temp_data["birthday"],
         age=user_temp_data["age"],
-        photo_file=user_temp_data.get("photo_file"),  # Передаем байты фото
+        photo_paths=user_temp_data.get("photo_paths"),  # Уже сохранённое фото
         photo_id=user_temp_data.get("photo_id"),
         bio=user_temp_data["bio"],
         zodiac=user_temp_data["zodiac"],
@@ -1145,6 +1282,10 @@ def show_mutual_likes(call: CallbackQuery):
             )
         )
     
+    keyboard.add(
+        InlineKeyboardButton("📊 Совместимость со всеми", callback_data="mutual_report_mutual_open"),
+        InlineKeyboardButton("📊 + входящие лайки", callback_data="mutual_report_all_open")
+    )
     keyboard.add(InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu"))
     
     bot.edit_message_text(
@@ -1203,53 +1344,142 @@ def show_mutual_profile(call: CallbackQuery):
     else:
         caption += "⚠️ *Нет взаимной симпатии*"
     
-    # Пытаемся отправить локальное фото
-    photo_path = db.get_user_photo_path(target_id)
-    if photo_path:
-        try:
-            with open(photo_path, 'rb') as photo_file:
-                bot.send_photo(
-                    call.message.chat.id,
-                    photo_file,
-                    caption=caption,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-        except Exception as e:
-            print(f"Ошибка отправки локального фото в mutual: {e}")
-            # Запасной вариант
-            if target_data.get('photo_id'):
-                bot.send_photo(
-                    call.message.chat.id,
-                    target_data['photo_id'],
-                    caption=caption,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-            else:
-                bot.send_message(
-                    call.message.chat.id,
-                    caption,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-    elif target_data.get('photo_id'):
-        bot.send_photo(
-            call.message.chat.id,
-            target_data['photo_id'],
-            caption=caption,
+    send_profile_photo(call.message.chat.id, target_id, target_data, caption, keyboard)
+    
+    bot.answer_callback_query(call.id)
+
+MUTUAL_REPORT_PAGE_SIZE = 10
+
+def build_mutual_report(user_id, include_received):
+    """
+    Считает отчёт о совместимости со всеми симпатиями и сохраняет его
+    во временные данные для листания страниц. Списывает MATCH_PRICE один раз
+    и только за непустой отчёт.
+    Возвращает список анкет или None, если не хватает средств.
+    """
+    user_data = db.get_user(user_id)
+    if not user_data or user_data['balance'] < MATCH_PRICE:
+        return None
+    
+    try:
+        report = db.get_mutual_compatibility_report(user_id, include_received)
+    except Exception as e:
+        print(f"Ошибка расчёта отчёта совместимости для {user_id}: {e}")
+        raise
+    
+    # Пустой отчёт («пока нет взаимных симпатий») бесплатный
+    if report:
+        db.update_user_balance(user_id, -MATCH_PRICE)
+    
+    with temp_data_lock:
+        if user_id not in temp_data:
+            temp_data[user_id] = {}
+        temp_data[user_id]['mutual_report'] = (include_received, report)
+    
+    return report
+
+def send_mutual_report(user_id, chat_id, include_received=False, page=0, message_id=None,
+                       is_entry=False):
+    """
+    Отправляет (или обновляет) страницу отчёта о совместимости с симпатиями.
+    Отчёт считается (и оплачивается) только при открытии (is_entry=True),
+    листание в любую сторону берёт его из временных данных.
+    """
+    if is_entry:
+        report = build_mutual_report(user_id, include_received)
+        if report is None:
+            bot.send_message(chat_id, f"❌ Недостаточно средств! Нужно: {MATCH_PRICE} монет")
+            return
+    else:
+        with temp_data_lock:
+            cached = temp_data.get(user_id, {}).get('mutual_report')
+        if not cached or cached[0] != include_received:
+            bot.send_message(chat_id, "⌛ Отчёт устарел, откройте его заново из списка симпатий")
+            return
+        report = cached[1]
+    
+    if not report:
+        bot.send_message(chat_id, "❤️ У вас пока нет взаимных симпатий")
+        return
+    
+    mode = "all" if include_received else "mutual"
+    pages = (len(report) + MUTUAL_REPORT_PAGE_SIZE - 1) // MUTUAL_REPORT_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    start = page * MUTUAL_REPORT_PAGE_SIZE
+    
+    lines = []
+    for number, user in enumerate(report[start:start + MUTUAL_REPORT_PAGE_SIZE], start=start + 1):
+        city_text = f" ({user['city']})" if user.get('city') else ""
+        like_mark = "💖" if user['like_type'] == 'mutual' else "💌"
+        lines.append(f"{number}. {like_mark} {user.get('name', 'Пользователь')}{city_text} - `{user['compatibility']:.1f}%`")
+    
+    text = (
+        "📊 *Совместимость с вашими симпатиями*\n\n"
+        + "\n".join(lines)
+        + f"\n\nСтраница {page + 1} из {pages}"
+    )
+    if include_received:
+        text += "\n💖 - взаимная симпатия, 💌 - вас лайкнули"
+    
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"mutual_report_{mode}_{page - 1}"))
+    if page < pages - 1:
+        nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"mutual_report_{mode}_{page + 1}"))
+    if nav_buttons:
+        keyboard.row(*nav_buttons)
+    keyboard.add(
+        InlineKeyboardButton("⬅️ Назад к списку", callback_data="show_mutual_likes"),
+        InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
+    )
+    
+    if message_id:
+        bot.edit_message_text(
+            text,
+            chat_id=chat_id,
+            message_id=message_id,
             parse_mode="Markdown",
             reply_markup=keyboard
         )
     else:
-        bot.send_message(
+        bot.send_message(chat_id, text, parse_mode="Markdown", reply_markup=keyboard)
+
+@bot.message_handler(commands=["mutual_report"])
+def mutual_report_command(message: Message):
+    """Совместимость со всеми взаимными симпатиями одним сообщением"""
+    user_id = str(message.from_user.id)
+    
+    if not db.user_exists(user_id):
+        bot.send_message(message.chat.id, "❌ Сначала создайте анкету через /start")
+        return
+    
+    try:
+        send_mutual_report(user_id, message.chat.id, is_entry=True)
+    except Exception as e:
+        bot.send_message(message.chat.id, f"❌ Ошибка расчёта: {str(e)}")
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("mutual_report_"))
+def mutual_report_callback(call: CallbackQuery):
+    user_id = str(call.from_user.id)
+    _, _, mode, page = call.data.split("_")
+    # "open" - кнопка из списка симпатий: отчёт считается заново
+    is_entry = page == "open"
+    
+    try:
+        # Текстовое сообщение (список симпатий, страница отчёта) правим на месте
+        send_mutual_report(
+            user_id,
             call.message.chat.id,
-            caption,
-            parse_mode="Markdown",
-            reply_markup=keyboard
+            include_received=(mode == "all"),
+            page=0 if is_entry else int(page),
+            message_id=call.message.message_id if call.message.text else None,
+            is_entry=is_entry
         )
-    
-    bot.answer_callback_query(call.id)
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        print(f"Ошибка отчёта совместимости для {user_id}: {e}")
+        bot.answer_callback_query(call.id, "❌ Ошибка расчёта")
 
 # Обработчик для показа контактов
 @bot.callback_query_handler(func=lambda call: call.data.startswith("show_contacts_"))
@@ -1319,8 +1549,8 @@ def show_my_profile(call: CallbackQuery):
     
     city_text = f"🏙️ *Город:* {user_data.get('city', 'не указан')}\n" if user_data.get('city') else ""
     
-    # Получаем количество взаимных симпатий
-    mutual_count = len(db.get_mutual_likes(user_id))
+    # Счётчики лайков (одна строка like_counters)
+    like_counts = db.get_like_counts(user_id)
     
     caption = (
         f"👤 *{user_data['name']}*\n"
@@ -1331,7 +1561,9 @@ def show_my_profile(call: CallbackQuery):
         f"♈ *Знак зодиака:* {user_data['zodiac']}\n\n"
         f"📝 *О себе:*\n{user_data['bio']}\n\n"
         f"💰 *Баланс:* {user_data['balance']} монет\n"
-        f"❤️ *Взаимных симпатий:* {mutual_count}"
+        f"❤️ *Взаимных симпатий:* {like_counts['mutual_count']}\n"
+        f"💌 *Лайков получено:* {like_counts['likes_received']}\n"
+        f"👍 *Лайков отправлено:* {like_counts['likes_sent']}"
     )
     
     if user_data.get('photo_id'):
@@ -1464,137 +1696,84 @@ def start_browsing(call: CallbackQuery):
     user_data = db.get_user(user_id)
     user_city = user_data.get("city") if user_data else None
     
-    # Получаем список анкет (кроме своей) с фильтрами из БД
-    other_users = db.get_users_by_filters(
-        exclude_user_id=user_id,
-        gender=None,
-        zodiac=None,
-        city_filter=None
-    )
+    # Очередь анкет (кроме своей): сначала свой город, внутри групп - вперемешку
+    user_ids = build_browse_queue(user_id, user_city)
     
-    if not other_users:
+    if not user_ids:
+        # Всё уже просмотрено - предлагаем начать заново
+        if view_store.seen_count(user_id):
+            show_no_more_profiles(user_id, call.message.chat.id)
+            bot.answer_callback_query(call.id)
+            return
         bot.answer_callback_query(call.id, "😔 Пока нет других анкет")
         return
     
-    # Сортируем анкеты: сначала из того же города, потом остальные
-    if user_city:
-        same_city_users = []
-        other_city_users = []
-        
-        for user in other_users:
-            if user.get("city") == user_city:
-                same_city_users.append(user)
-            else:
-                other_city_users.append(user)
-        
-        # Перемешиваем внутри каждой группы для разнообразия
-        random.shuffle(same_city_users)
-        random.shuffle(other_city_users)
-        
-        other_users = same_city_users + other_city_users
-    else:
-        # Если город не указан, просто перемешиваем все анкеты
-        random.shuffle(other_users)
-    
     # Инициализируем очередь просмотра
     with temp_data_lock:
         if user_id not in temp_data:
             temp_data[user_id] = {}
         
         # Сохраняем только ID пользователей в очереди
-        user_ids = [user["user_id"] for user in other_users]
-        temp_data[user_id]['browse_queue'] = user_ids.copy()
+        temp_data[user_id]['browse_queue'] = user_ids
         temp_data[user_id]['current_index'] = 0
         temp_data[user_id]['filter_gender'] = None
         temp_data[user_id]['filter_zodiac'] = None
         temp_data[user_id]['filter_city'] = None
+        temp_data[user_id]['browse_queue_stale'] = False
     
     show_next_profile(user_id, call.message.chat.id)
     bot.answer_callback_query(call.id)
 
+@bot.callback_query_handler(func=lambda call: call.data == "browse_restart")
+def restart_browsing(call: CallbackQuery):
+    """«Начать заново»: забываем просмотренные анкеты и строим очередь с нуля"""
+    view_store.reset(str(call.from_user.id))
+    start_browsing(call)
+
 def show_next_profile(user_id, chat_id):
-    """Показывает следующую анкету с учетом фильтров"""
+    """Показывает следующую анкету (очередь уже отфильтрована в SQL)"""
     with temp_data_lock:
         if user_id not in temp_data or 'browse_queue' not in temp_data[user_id]:
             bot.send_message(chat_id, "❌ Ошибка. Начните просмотр заново.")
             return
         
-        queue = temp_data[user_id]['browse_queue']
+        queue_stale = temp_data[user_id].get('browse_queue_stale')
     
-    # Проверяем, что есть анкеты для просмотра
-    if not queue:
-        show_no_more_profiles(user_id, chat_id)
-        return
+    # Фильтры менялись - пересобираем очередь одним запросом
+    if queue_stale:
+        rebuild_browse_queue(user_id)
     
-    # Получаем или инициализируем индекс
     with temp_data_lock:
+        queue = temp_data[user_id]['browse_queue']
         current_idx = temp_data[user_id].get('current_index', 0)
     
-    # Если индекс выходит за пределы, показываем сообщение о завершении
-    if current_idx >= len(queue):
-        show_no_more_profiles(user_id, chat_id)
-        return
-    
-    # Пытаемся найти подходящую анкету
-    profile_found = False
-    profile_id = None
-    found_idx = current_idx
-    
-    while found_idx < len(queue) and not profile_found:
-        profile_id = queue[found_idx]
+    # Пропускаем анкеты, удалённые после построения очереди
+    user_data = None
+    while current_idx < len(queue):
+        profile_id = queue[current_idx]
         user_data = db.get_user(profile_id)
-        
-        if not user_data:
-            found_idx += 1
-            continue
-            
-        # Применяем фильтры
-        filter_passed = True
-        
-        # Фильтр по полу
-        with temp_data_lock:
-            filter_gender = temp_data[user_id].get('filter_gender')
-            filter_zodiac = temp_data[user_id].get('filter_zodiac')
-            filter_city = temp_data[user_id].get('filter_city')
-        
-        if filter_gender and user_data.get('gender') != filter_gender:
-            filter_passed = False
-        
-        # Фильтр по знаку зодиака
-        if filter_passed and filter_zodiac and user_data.get('zodiac') != filter_zodiac:
-            filter_passed = False
-        
-        # Фильтр по городу
-        if filter_passed and filter_city:
-            if filter_city == "same_city":
-                # Показывать только из своего города
-                current_user_data = db.get_user(user_id)
-                user_city = current_user_data.get("city") if current_user_data else None
-                if user_data.get('city') != user_city:
-                    filter_passed = False
-        
-        if filter_passed:
-            profile_found = True
-        else:
-            found_idx += 1
+        if user_data:
+            break
+        current_idx += 1
     
-    if not profile_found:
-        # Если не нашли подходящих анкет
+    if not user_data:
         show_no_more_profiles(user_id, chat_id)
         return
     
     # Обновляем индекс для следующего вызова
     with temp_data_lock:
-        temp_data[user_id]['current_index'] = found_idx + 1
+        temp_data[user_id]['current_index'] = current_idx + 1
+    
+    view_store.mark_seen(user_id, profile_id)
     
     # Отображаем анкету
-    display_profile(user_id, chat_id, profile_id, user_data, found_idx, len(queue))
+    display_profile(user_id, chat_id, profile_id, user_data, current_idx, len(queue))
 
 def show_no_more_profiles(user_id, chat_id):
     """Показывает сообщение о том, что анкеты закончились"""
     keyboard = InlineKeyboardMarkup(row_width=2)
     keyboard.add(
-        InlineKeyboardButton("🔄 Начать заново", callback_data="browse_start"),
+        InlineKeyboardButton("🔄 Начать заново", callback_data="browse_restart"),
         InlineKeyboardButton("⚙️ Изменить фильтры", callback_data="set_filters"),
         InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
     )
@@ -1610,7 +1789,7 @@ def show_no_more_profiles(user_id, chat_id):
     if has_filters:
         response_text += "Попробуйте изменить фильтры, чтобы увидеть больше анкет."
     else:
-        response_text += "Нажмите 'Начать заново', чтобы посмотреть снова."
+        response_text += "Нажмите 'Начать заново', чтобы посмотреть просмотренные анкеты снова."
     
     # Просто отправляем новое сообщение
     bot.send_message(
@@ -1659,58 +1838,8 @@ def display_profile(user_id, chat_id, profile_id, user_data, current_idx, total_
         f"📝 *О себе:*\n{user_data.get('bio', 'Не указано')}\n\n"
     )
     
-    # Получаем путь к локальной фотографии
-    photo_path = db.get_user_photo_path(profile_id)
-    
     # Всегда отправляем новое сообщение
-    if photo_path:
-        try:
-            # Отправляем локальное фото
-            with open(photo_path, 'rb') as photo_file:
-                msg = bot.send_photo(
-                    chat_id,
-                    photo_file,
-                    caption=caption,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-        except Exception as e:
-            print(f"Ошибка отправки локального фото {photo_path}: {e}")
-            # Если локальное фото не найдено, пытаемся использовать photo_id из базы
-            photo_id = user_data.get('photo_id')
-            if photo_id:
-                msg = bot.send_photo(
-                    chat_id,
-                    photo_id,
-                    caption=caption,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-            else:
-                msg = bot.send_message(
-                    chat_id,
-                    caption,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-    else:
-        # Используем photo_id из базы как запасной вариант
-        photo_id = user_data.get('photo_id')
-        if photo_id:
-            msg = bot.send_photo(
-                chat_id,
-                photo_id,
-                caption=caption,
-                parse_mode="Markdown",
-                reply_markup=keyboard
-            )
-        else:
-            msg = bot.send_message(
-                chat_id,
-                caption,
-                parse_mode="Markdown",
-                reply_markup=keyboard
-            )
+    msg = send_profile_photo(chat_id, profile_id, user_data, caption, keyboard, variant='thumb')
     
     # Сохраняем ID последнего сообщения (но не удаляем предыдущие)
     with temp_data_lock:
@@ -1763,7 +1892,7 @@ def handle_profile_actions(call: CallbackQuery):
                 return
                 
             date2 = target_data['birthday']
-            result = calculate_compatibility(date1, date2)
+            result = compat_cache.get_compatibility(date1, date2)
             
             # Сохраняем результат во временные данные
             with temp_data_lock:
@@ -1971,6 +2100,11 @@ def handle_filter_selection(call: CallbackQuery):
                             temp_data[user_id]['filter_zodiac'] = sign
                         break
         
+        # Очередь просмотра пересоберётся под новые фильтры
+        with temp_data_lock:
+            if 'browse_queue' in temp_data[user_id]:
+                temp_data[user_id]['browse_queue_stale'] = True
+        
         # Обновляем интерфейс фильтров
         try:
             set_filters(call)
@@ -1986,10 +2120,8 @@ def handle_filter_selection(call: CallbackQuery):
 def save_filters(call: CallbackQuery):
     user_id = str(call.from_user.id)
     
-    # Сбрасываем индекс просмотра при сохранении фильтров
-    with temp_data_lock:
-        if user_id in temp_data and 'browse_queue' in temp_data[user_id]:
-            temp_data[user_id]['current_index'] = 0
+    # Пересобираем очередь просмотра под сохранённые фильтры
+    rebuild_browse_queue(user_id)
     
     bot.answer_callback_query(call.id, "✅ Фильтры сохранены!")
     # Возвращаемся к просмотру
@@ -2178,7 +2310,7 @@ def get_date2_and_calculate_match(message: Message):
     
     try:
         # Рассчитываем совместимость
-        result = calculate_compatibility(date1, date_str)
+        result = compat_cache.get_compatibility(date1, date_str)
         
         # Сохраняем результат
         with temp_data_lock:
@@ -2247,12 +2379,21 @@ def format_match_result(date1, date2, result):
     elif max_score - min_score > 20:
         imbalance_warning = "\nℹ️ *Заметка:* Показатели различаются довольно сильно."
     
+    # Место результата среди всех пар анкет в базе
+    top_line = ""
+    if compat_distribution:
+        top = compat_distribution.top_percent(result['percentage'])
+        if top is not None:
+            top_text = f"{top:.1f}" if top < 10 else f"{top:.0f}"
+            top_line = f"📊 *Среди всех пар StarMatch:* топ `{top_text}%`\n"
+    
     return (
         f"{emoji} *РЕЗУЛЬТАТ СОВМЕСТИМОСТИ*\n\n"
         f"📅 *Дата 1:* `{date1}`\n"
         f"📅 *Дата 2:* `{date2}`\n"
         f"🎯 *Главный показатель (МАТРИЦА):* `{matrix_score:.1f}%`\n"
-        f"🏆 *Уровень совместимости:* {level}\n\n"
+        f"🏆 *Уровень совместимости:* {level}\n"
+        f"{top_line}\n"
         f"{imbalance_warning}\n"
         f"💡 *Совет:* {advice}\n\n"
         f"_Нажмите 'Что означают эти проценты?' для подробного объяснения_"
@@ -2543,6 +2684,7 @@ def help_command(message: Message):
 /start - регистрация и создание анкеты
 /help - эта справка
 /balance - проверить баланс
+/mutual_report - совместимость со всеми взаимными симпатиями
 
 *Для администратора:*
 /add_coins <user_id> <amount> - пополнить баланс пользователя
@@ -2579,6 +2721,34 @@ def balance_command(message: Message):
     else:
         bot.send_message(message.chat.id, "❌ Сначала создайте анкету через /start")
 
+@bot.message_handler(commands=["cache_stats"])
+def cache_stats_command(message: Message):
+    """Статистика кэша совместимости (для администратора)"""
+    user_id = str(message.from_user.id)
+    
+    if not is_admin(int(user_id)):
+        bot.send_message(message.chat.id, "❌ Эта команда только для администратора.")
+        return
+    
+    stats = compat_cache.stats()
+    user_stats = db.user_cache_stats()
+    bot.send_message(
+        message.chat.id,
+        f"📊 *Кэш совместимости*\n\n"
+        f"• Версия формулы: `{stats['formula_version']}`\n"
+        f"• Записей в памяти: {stats['memory_size']}\n"
+        f"• Попаданий в память: {stats['memory_hits']}\n"
+        f"• Попаданий в БД: {stats['db_hits']}\n"
+        f"• Промахов: {stats['misses']}\n"
+        f"• Доля попаданий: {stats['hit_rate']:.1%}\n\n"
+        f"👤 *Кэш анкет*\n\n"
+        f"• Записей: {user_stats['size']} из {user_stats['maxsize']}\n"
+        f"• Попаданий: {user_stats['hits']}\n"
+        f"• Промахов: {user_stats['misses']}\n"
+        f"• Доля попаданий: {user_stats['hit_rate']:.1%}",
+        parse_mode="Markdown"
+    )
+
 @bot.message_handler(commands=["fake"])
 def fake_command(message: Message):
     """Команда для создания фейковой анкеты с фото"""
@@ -2712,6 +2882,12 @@ def fake_command(message: Message):
                 else:
                     print(f"⚠️ Локальное фото-заглушка не найдено: {photo_path}")
         
+        # Обработанное фото для локального сохранения
+        processed_photo = image_pipeline.process(photo_file_bytes)
+        if photo_file_bytes and processed_photo is None:
+            bot.send_message(message.chat.id, "❌ Не удалось обработать фото. Укажите другое.")
+            return
+        
         # Создаем фейковый профиль в базе данных с локальным фото
         success = db.save_user(
             user_id=fake_user_id,
@@ -2719,7 +2895,7 @@ def fake_command(message: Message):
             gender=gender,
             birthday=birthday,
             age=age,
-            photo_file=photo_file_bytes,  # Байты фото для локального сохранения
+            photo_file=processed_photo,
             photo_id=photo_id,  # Telegram file_id как запасной вариант
             bio=bio,
             zodiac=zodiac,
@@ -2729,12 +2905,12 @@ def fake_command(message: Message):
         )
         
         if success:
-            # Получаем путь к сохраненному фото для отображения
-            saved_photo_path = db.get_user_photo_path(fake_user_id)
+            # Сохранённое фото для отображения
+            photo_file = db.open_user_photo(fake_user_id)
             
             # Отправляем подтверждение администратору
-            if saved_photo_path and os.path.exists(saved_photo_path):
-                with open(saved_photo_path, 'rb') as photo_file:
+            if photo_file is not None:
+                with photo_file:
                     bot.send_photo(
                         message.chat.id,
                         photo_file,
@@ -3214,14 +3390,27 @@ if __name__ == "__main__":
     # Настраиваем меню команд
     setup_bot_menu()
     
-    # Очищаем потерянные фото при запуске
+    # Распределение совместимости по всем парам анкет, дальше обновляется само
+    compat_distribution = CompatibilityDistribution()
+    db.attach_distribution(compat_distribution)
+    
+    # Старые фото переносим в хранилище по хэшу, фото без ссылок удаляем
     try:
+        moved_count = db.migrate_photos_to_store()
+        if moved_count > 0:
+            print(f"📦 Фото перенесено в хранилище: {moved_count}")
         orphaned_count = db.cleanup_orphaned_photos()
         if orphaned_count > 0:
             print(f"🧹 Очищено потерянных фото: {orphaned_count}")
     except Exception as e:
         print(f"⚠️ Ошибка при очистке фото: {e}")
     
+    # Периодическая уборка файлов фото, на которые нет ссылок
+    photo_gc.start(PHOTO_GC_INTERVAL)
+    
+    # Периодическая сверка счётчиков лайков и ссылок на фото
+    threading.Thread(target=reconcile_counters_loop, name='counters', daemon=True).start()
+    
     bot.add_custom_filter(StateFilter(bot))
     
     print("🤖 Бот для знакомств запущен!")
@@ -3242,5 +3431,12 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"  ⚠️ Ошибка подключения к базе данных: {e}")
     
-    bot.polling(none_stop=True)
-
+    try:
+        bot.polling(none_stop=True)
+    finally:
+        # Дописываем накопленные лайки и просмотры и закрываем все соединения пула
+        like_writer.close()
+        view_store.close()
+        photo_gc.close()
+        image_pipeline.shutdown()
+        db.close()
@@ -0,0 +1,97 @@
+'''
+LikeWriter и чтения Database на маленьком пуле соединений.
+
+Методы Database держат соединение из пула и ждут сброса лайков, а сброс из
+другого потока берёт своё соединение; на пуле из двух соединений они не
+должны ждать друг друга. Запуск: python -m unittest test_like_writer
+'''
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from database import Database
+from like_writer import LikeWriter
+
+USERS = [str(1000 + i) for i in range(10)]
+FAKE_USERS = USERS[::5]
+REAL_USERS = [user_id for user_id in USERS if user_id not in FAKE_USERS]
+# Ожидание соединения из пула; тест должен уложиться намного быстрее
+POOL_TIMEOUT = 3
+
+
+class LikeWriterPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.tmp, 'test.db'),
+                           photos_dir=os.path.join(self.tmp, 'photos'), pool_size=2)
+        for user_id in USERS:
+            self.db.save_user(user_id, 'Тест', 'male', '01.01.1990', 30, '', 'Козерог',
+                              is_fake=int(user_id in FAKE_USERS))
+        self.db.pool.timeout = POOL_TIMEOUT
+        # Фоновый сброс не мешает: сбрасываем вручную
+        self.writer = LikeWriter(self.db, flush_interval=3600, max_batch=10 ** 6)
+
+    def tearDown(self):
+        self.writer.close()
+        self.db.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _queue_likes(self):
+        for fake_id in FAKE_USERS:
+            for user_id in REAL_USERS[:3]:
+                self.writer.add_like(fake_id, user_id)
+                self.writer.add_like(user_id, fake_id)
+        for from_user, to_user in zip(REAL_USERS, REAL_USERS[1:]):
+            self.writer.add_like(from_user, to_user)
+
+    def test_reads_alongside_flush(self):
+        calls = [
+            lambda: self.db.get_mutual_likes(REAL_USERS[0], include_received=True),
+            lambda: self.db.is_mutual_like(REAL_USERS[0], REAL_USERS[1]),
+            lambda: self.db.get_like_counts(REAL_USERS[1]),
+            self.db.reconcile_like_counters,
+            self.db.delete_all_fake_users,
+        ]
+        for call in calls:
+            with self.subTest(call=call):
+                self._queue_likes()
+                errors = []
+                holding = threading.Barrier(3)
+
+                def reader():
+                    try:
+                        # Оба соединения пула заняты читателями...
+                        with self.db.connection():
+                            holding.wait()
+                            # ...пока сброс из другого потока ждёт соединение
+                            time.sleep(0.2)
+                            call()
+                    except Exception as e:
+                        errors.append(e)
+
+                def flusher():
+                    holding.wait()
+                    self.writer.flush()
+
+                threads = [threading.Thread(target=reader) for _ in range(2)]
+                threads.append(threading.Thread(target=flusher))
+                started = time.time()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join(timeout=POOL_TIMEOUT * 2)
+
+                self.assertFalse(any(thread.is_alive() for thread in threads))
+                self.assertEqual(errors, [])
+                self.assertLess(time.time() - started, POOL_TIMEOUT / 2)
+                self.assertEqual(self.writer.pending, 0)
+
+        # Лайки удалённых фейков тоже удалены, счётчики сходятся
+        self.assertEqual(self.db.reconcile_like_counters(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,8 +26,8 @@ def update_database(db_name='bot_database.db'):
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS reports (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                reported_user_id TEXT NOT NULL,
-                reporter_user_id TEXT NOT NULL,
+                reported_user_id INTEGER NOT NULL,
+                reporter_user_id INTEGER NOT NULL,
                 reason TEXT,
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )
@@ -37,9 +37,9 @@ def update_database(db_name='bot_database.db'):
         # 3. Создаем таблицу banned_users
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS banned_users (
-                user_id TEXT PRIMARY KEY,
+                user_id INTEGER PRIMARY KEY,
                 reason TEXT,
-                banned_by TEXT,
+                banned_by INTEGER,
                 banned_at DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         ''')
@@ -0,0 +1,361 @@
+'''
+Просмотренные анкеты: компактные множества на каждого пользователя.
+
+Telegram ID разрежены, поэтому анкета получает плотный порядковый номер
+(таблица profile_ordinals, номера выдаются по порядку при первом
+просмотре), и множество строится по номерам. Оно хранится как в roaring
+bitmap: номера делятся на блоки по старшим битам (ordinal >> 16), в блоке
+лежат младшие 16 бит. Маленький блок хранится отсортированным массивом uint16
+(2 байта на анкету), большой - битовой картой на 8 КБ. В SQLite одна строка
+на (пользователь, блок), в памяти - LRU последних пользователей.
+
+mark_seen меняет только память: новые номера выдаются из счётчика, а они
+и изменённые блоки пишутся в базу фоновым потоком одной транзакцией раз в
+flush_interval секунд, как лайки в LikeWriter.
+'''
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from cache import LRUCache
+
+CHUNK_BITS = 16
+LOW_MASK = (1 << CHUNK_BITS) - 1
+# Битовая карта блока - 8192 байта; массив до ARRAY_LIMIT ID всегда короче
+BITMAP_BYTES = (1 << CHUNK_BITS) // 8
+ARRAY_LIMIT = BITMAP_BYTES // 2 - 1
+# ID в одном запросе к profile_ordinals (меньше лимита переменных SQLite)
+ORDINAL_QUERY_SIZE = 500
+# Анкета без номера (её ещё никто не смотрел)
+NO_ORDINAL = -1
+
+_EMPTY = np.empty(0, dtype=np.uint16)
+
+
+def encode_chunk(values: np.ndarray) -> bytes:
+    """Блок (отсортированный uint16) -> массив или битовая карта"""
+    if len(values) <= ARRAY_LIMIT:
+        return values.astype('<u2').tobytes()
+    bits = np.zeros(1 << CHUNK_BITS, dtype=np.uint8)
+    bits[values] = 1
+    return np.packbits(bits).tobytes()
+
+
+def decode_chunk(data: bytes) -> np.ndarray:
+    """Обратное преобразование: по размеру понятно, массив это или карта"""
+    if len(data) == BITMAP_BYTES:
+        bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+        return np.flatnonzero(bits).astype(np.uint16)
+    return np.frombuffer(data, dtype='<u2').astype(np.uint16)
+
+
+def _to_int(user_id):
+    try:
+        return int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class ViewStore:
+    """Кто какие анкеты уже видел (таблицы seen_profiles и profile_ordinals)"""
+
+    def __init__(self, db, cache_size: int = 1000, ordinal_cache_size: int = 100000,
+                 flush_interval: float = 1.0):
+        self.db = db
+        self.flush_interval = flush_interval
+        self._sets = LRUCache(maxsize=cache_size)  # viewer -> {блок: массив uint16}
+        self._ordinals = LRUCache(maxsize=ordinal_cache_size)  # ID анкеты -> номер
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # один сброс в базу за раз
+        self._wakeup = threading.Condition(self._lock)
+        # Изменённые, но ещё не записанные блоки: (viewer, блок) -> массив
+        self._dirty: Dict[Tuple[int, int], np.ndarray] = {}
+        # Выданные, но ещё не записанные номера: ID анкеты -> номер
+        self._new_ordinals: Dict[int, int] = {}
+        self._next_ordinal = 0
+        # Пользователи, чьи строки сейчас удаляет reset(): из базы не читаем
+        self._resetting: Set[int] = set()
+        self._stopped = False
+
+        self.flushes = 0
+        self.flushed_chunks = 0
+
+        self.init_table()
+
+        self._thread = threading.Thread(target=self._run, name='view-writer', daemon=True)
+        self._thread.start()
+
+    def init_table(self):
+        with self.db.connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS profile_ordinals (
+                    user_id INTEGER PRIMARY KEY,
+                    ordinal INTEGER NOT NULL UNIQUE
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS seen_profiles (
+                    viewer_id INTEGER NOT NULL,
+                    chunk INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (viewer_id, chunk)
+                ) WITHOUT ROWID
+            ''')
+            conn.commit()
+            row = conn.execute('SELECT COALESCE(MAX(ordinal), -1) + 1 FROM profile_ordinals').fetchone()
+            self._next_ordinal = row[0]
+
+    @staticmethod
+    def _query_ordinals(cursor, user_ids: List[int]) -> Dict[int, int]:
+        found = {}
+        for start in range(0, len(user_ids), ORDINAL_QUERY_SIZE):
+            part = user_ids[start:start + ORDINAL_QUERY_SIZE]
+            cursor.execute(
+                f'SELECT user_id, ordinal FROM profile_ordinals '
+                f'WHERE user_id IN ({", ".join("?" * len(part))})',
+                part
+            )
+            # user_id приходит строкой (см. Database), ordinal - числом
+            found.update((int(row[0]), row[1]) for row in cursor.fetchall())
+        return found
+
+    def _remember(self, found: Dict[int, int], user_ids: Iterable[int],
+                  create: bool = False) -> Dict[int, int]:
+        """
+        Кладёт номера из базы в кэш (вызывать под self._lock). Ещё не записанные
+        номера новее базы; create=True - выдать номер анкетам, у которых его нет.
+        """
+        result = {}
+        for user_id in user_ids:
+            ordinal = self._new_ordinals.get(user_id, found.get(user_id, NO_ORDINAL))
+            if ordinal == NO_ORDINAL and create:
+                ordinal = self._next_ordinal
+                self._next_ordinal += 1
+                self._new_ordinals[user_id] = ordinal
+            self._ordinals.set(user_id, ordinal)
+            result[user_id] = ordinal
+        return result
+
+    def _ordinal(self, user_id: int, create: bool = False) -> Optional[int]:
+        """Номер анкеты; create=True - выдать (в памяти), если его ещё нет"""
+        ordinal = self._ordinals.get(user_id)
+        if ordinal is None:
+            with self.db.connection() as conn:
+                found = self._query_ordinals(conn.cursor(), [user_id])
+            with self._lock:
+                ordinal = self._remember(found, [user_id], create)[user_id]
+        elif ordinal == NO_ORDINAL and create:
+            with self._lock:
+                ordinal = self._remember({}, [user_id], create)[user_id]
+        return None if ordinal == NO_ORDINAL else ordinal
+
+    def _ordinals_of(self, user_ids: List[int]) -> np.ndarray:
+        """Номера для списка ID (NO_ORDINAL - анкету ещё никто не смотрел)"""
+        result = np.empty(len(user_ids), dtype=np.int64)
+        missing = []
+        for i, user_id in enumerate(user_ids):
+            ordinal = self._ordinals.get(user_id)
+            if ordinal is None:
+                missing.append(i)
+            else:
+                result[i] = ordinal
+
+        if missing:
+            missing_ids = list({user_ids[i] for i in missing})
+            with self.db.connection() as conn:
+                found = self._query_ordinals(conn.cursor(), missing_ids)
+            with self._lock:
+                found = self._remember(found, missing_ids)
+            for i in missing:
+                result[i] = found[user_ids[i]]
+        return result
+
+    def _load(self, viewer: int) -> Dict[int, np.ndarray]:
+        chunks = self._sets.get(viewer)
+        if chunks is None:
+            rows = []
+            if viewer not in self._resetting:
+                with self.db.connection() as conn:
+                    rows = conn.execute(
+                        'SELECT chunk, data FROM seen_profiles WHERE viewer_id = ?', (viewer,)
+                    ).fetchall()
+            chunks = {row[0]: decode_chunk(row[1]) for row in rows}
+            # Ещё не записанные изменения новее строк в базе
+            for (dirty_viewer, chunk), values in self._dirty.items():
+                if dirty_viewer == viewer:
+                    chunks[chunk] = values
+            self._sets.set(viewer, chunks)
+        return chunks
+
+    def mark_seen(self, viewer_id, viewed_id) -> bool:
+        """Отмечает анкету просмотренной; False, если уже была отмечена"""
+        viewer, viewed = _to_int(viewer_id), _to_int(viewed_id)
+        if viewer is None or viewed is None:
+            return False
+
+        try:
+            ordinal = self._ordinal(viewed, create=True)
+        except Exception as e:
+            print(f"Ошибка чтения номера анкеты {viewed_id}: {e}")
+            return False
+
+        chunk, low = ordinal >> CHUNK_BITS, ordinal & LOW_MASK
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("ViewStore уже остановлен")
+            chunks = self._load(viewer)
+            values = chunks.get(chunk, _EMPTY)
+            position = int(np.searchsorted(values, low))
+            if position < len(values) and values[position] == low:
+                return False
+            values = np.insert(values, position, low)
+            chunks[chunk] = values
+            # В базу блок попадёт при следующем сбросе
+            self._dirty[(viewer, chunk)] = values
+        return True
+
+    def is_seen(self, viewer_id, viewed_id) -> bool:
+        """Видел ли пользователь анкету"""
+        viewer, viewed = _to_int(viewer_id), _to_int(viewed_id)
+        if viewer is None or viewed is None:
+            return False
+        ordinal = self._ordinal(viewed)
+        if ordinal is None:
+            return False
+        with self._lock:
+            values = self._load(viewer).get(ordinal >> CHUNK_BITS, _EMPTY)
+        position = int(np.searchsorted(values, ordinal & LOW_MASK))
+        return position < len(values) and values[position] == ordinal & LOW_MASK
+
+    def filter_unseen(self, viewer_id, user_ids: Iterable) -> List:
+        """
+        Оставляет из user_ids только непросмотренные (порядок сохраняется).
+        Проверка одним np.isin по всем просмотренным номерам, без поиска по каждому ID.
+        """
+        user_ids = list(user_ids)
+        viewer = _to_int(viewer_id)
+        if viewer is None or not user_ids:
+            return user_ids
+
+        with self._lock:
+            chunks = dict(self._load(viewer))
+        if not chunks:
+            return user_ids
+
+        # Все просмотренные номера одним массивом
+        seen_ordinals = np.concatenate([
+            (np.int64(chunk) << CHUNK_BITS) | values.astype(np.int64)
+            for chunk, values in chunks.items()
+        ])
+
+        numeric = [_to_int(user_id) for user_id in user_ids]
+        valid = [value for value in numeric if value is not None]
+        ordinals = iter(self._ordinals_of(valid))
+        candidate_ordinals = np.array(
+            [next(ordinals) if value is not None else NO_ORDINAL for value in numeric],
+            dtype=np.int64
+        )
+
+        keep = ~np.isin(candidate_ordinals, seen_ordinals) | (candidate_ordinals == NO_ORDINAL)
+        return [user_id for user_id, flag in zip(user_ids, keep) if flag]
+
+    def seen_count(self, viewer_id) -> int:
+        """Сколько анкет пользователь уже видел"""
+        viewer = _to_int(viewer_id)
+        if viewer is None:
+            return 0
+        with self._lock:
+            return sum(len(values) for values in self._load(viewer).values())
+
+    def reset(self, viewer_id):
+        """Забыть просмотры пользователя («Начать заново»)"""
+        viewer = _to_int(viewer_id)
+        if viewer is None:
+            return
+        # Сброс в базу не должен дописать блоки после удаления
+        with self._flush_lock:
+            with self._lock:
+                for key in [key for key in self._dirty if key[0] == viewer]:
+                    del self._dirty[key]
+                self._sets.set(viewer, {})
+                self._resetting.add(viewer)
+            # Базу трогаем уже без self._lock: mark_seen и is_seen не ждут диска
+            try:
+                with self.db.connection() as conn:
+                    conn.execute('DELETE FROM seen_profiles WHERE viewer_id = ?', (viewer,))
+                    conn.commit()
+            finally:
+                with self._lock:
+                    self._resetting.discard(viewer)
+
+    @property
+    def pending(self) -> int:
+        """Блоков и номеров, ещё не записанных в базу"""
+        with self._lock:
+            return len(self._dirty) + len(self._new_ordinals)
+
+    def flush(self) -> int:
+        """Записывает новые номера и изменённые блоки одной транзакцией, возвращает число блоков"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._dirty = self._dirty, {}
+                # Номера убираем из памяти только после коммита
+                ordinals = dict(self._new_ordinals)
+            if not batch and not ordinals:
+                return 0
+
+            try:
+                with self.db.connection() as conn:
+                    conn.executemany(
+                        'INSERT OR IGNORE INTO profile_ordinals (user_id, ordinal) VALUES (?, ?)',
+                        list(ordinals.items())
+                    )
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO seen_profiles (viewer_id, chunk, data) VALUES (?, ?, ?)',
+                        [(viewer, chunk, encode_chunk(values)) for (viewer, chunk), values in batch.items()]
+                    )
+                    conn.commit()
+            except Exception as e:
+                print(f"Ошибка записи просмотров ({len(batch)} блоков): {e}")
+                # Возвращаем блоки; изменённые за это время новее
+                with self._lock:
+                    batch.update(self._dirty)
+                    self._dirty = batch
+                return 0
+
+            with self._lock:
+                for user_id in ordinals:
+                    del self._new_ordinals[user_id]
+                self.flushes += 1
+                self.flushed_chunks += len(batch)
+            return len(batch)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._stopped:
+                    self._wakeup.wait(self.flush_interval)
+                stopped = self._stopped
+
+            self.flush()
+            if stopped:
+                return
+
+    def close(self):
+        """Останавливает фоновый поток, дописав все изменённые блоки"""
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        self._thread.join()
+        self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        """Счётчики: сбросов, записанных блоков, ожидающих"""
+        with self._lock:
+            return {
+                'pending': len(self._dirty),
+                'pending_ordinals': len(self._new_ordinals),
+                'flushes': self.flushes,
+                'flushed_chunks': self.flushed_chunks,
+            }